@@ -0,0 +1,118 @@
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from benchmarks.report import report, summarize
+from mlcourse_prac.config import CONFIG
+from mlcourse_prac.evaluate import compute_accuracies, compute_accuracy
+from mlcourse_prac.inference import configure_threads
+from mlcourse_prac.progress import Progress
+from mlcourse_prac.test_cache import cache_key, cache_root, CROP_SIZE
+
+
+class TinyModel:
+    def __init__(self, num_classes: int, device: str) -> None:
+        self.net = torch.nn.Sequential(
+            torch.nn.Conv2d(3, 8, kernel_size=7, stride=4),
+            torch.nn.ReLU(),
+            torch.nn.AdaptiveAvgPool2d(1),
+            torch.nn.Flatten(),
+            torch.nn.Linear(8, num_classes),
+        ).to(device)
+        self.net.eval()
+
+    def predict(self, images: torch.Tensor) -> torch.Tensor:
+        with torch.no_grad():
+            return self.net(images)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Microbenchmark of compute_accuracy')
+    parser.add_argument('--images', type=int, default=2048)
+    parser.add_argument('--classes', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=0, help='intra-op threads, 0 for default')
+    for flag in ['inference-mode', 'channels-last', 'bfloat16']:
+        parser.add_argument(f'--{flag}', action='store_true')
+    parser.add_argument('--cpu-shards', type=int, default=1, help='also time the sharded path')
+    parser.add_argument('--output', help='append the JSON result to this file')
+    args, _ = parser.parse_known_args()
+
+    root = Path(tempfile.mkdtemp())
+    CONFIG.read_dict(
+        {
+            'evaluation': {
+                'batch_size': str(args.batch_size),
+                'device': args.device,
+                'cpu_shards': str(args.cpu_shards),
+                'cpu_threads': str(args.threads),
+                'inference_mode': str(args.inference_mode),
+                'channels_last': str(args.channels_last),
+                'bfloat16': str(args.bfloat16),
+                'test_cache_dir': str(root / 'test_cache'),
+            }
+        }
+    )
+
+    # the cache is written directly, decoding images is measured by mlcourse-prepare-tests
+    test_subset_dir = root / 'clean'
+    test_subset_dir.mkdir()
+    cache_dir = cache_root() / cache_key(test_subset_dir)
+    cache_dir.mkdir(parents=True)
+    rng = np.random.default_rng(0)
+    images = np.lib.format.open_memmap(
+        cache_dir / 'images.npy',
+        mode='w+',
+        dtype=np.uint8,
+        shape=(args.images, 3, CROP_SIZE, CROP_SIZE),
+    )
+    images[:] = rng.integers(0, 256, images.shape, dtype=np.uint8)
+    images.flush()
+    del images
+    np.save(cache_dir / 'labels.npy', rng.integers(0, args.classes, args.images))
+
+    configure_threads()
+    model = TinyModel(args.classes, args.device)
+    # the first pass warms up the page cache and the device
+    accuracy = compute_accuracy(model, test_subset_dir)
+    durations = []
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        compute_accuracy(model, test_subset_dir)
+        if args.device.startswith('cuda'):
+            torch.cuda.synchronize()
+        durations.append(time.perf_counter() - started)
+
+    results = {
+        'images': args.images,
+        'batch_size': args.batch_size,
+        'device': args.device,
+        'threads': args.threads,
+        'inference_mode': args.inference_mode,
+        'channels_last': args.channels_last,
+        'bfloat16': args.bfloat16,
+        'seconds': summarize(durations),
+        'images_per_second': round(args.images / min(durations), 1),
+    }
+    if args.cpu_shards > 1 and args.device == 'cpu':
+        sharded_durations = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            sharded = compute_accuracies(model, {'clean': test_subset_dir}, Progress(root), 'bench')
+            sharded_durations.append(time.perf_counter() - started)
+        results['cpu_shards'] = args.cpu_shards
+        results['sharded_seconds'] = summarize(sharded_durations)
+        # the sharded path must reproduce the sequential accuracy exactly
+        results['identical'] = sharded['clean'] == accuracy
+
+    report('accuracy', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
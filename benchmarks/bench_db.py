@@ -0,0 +1,102 @@
+import argparse
+import random
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from benchmarks.report import report, summarize
+from mlcourse_prac.db import mlcourse_database
+
+
+def timed(timings: Dict[str, List[float]], name: str, function: Callable, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    timings[name].append((time.perf_counter() - started) * 1e6)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Microbenchmarks of the database queries')
+    parser.add_argument('--students', type=int, default=200)
+    parser.add_argument('--solutions', type=int, default=20, help='per student')
+    parser.add_argument('--repeat', type=int, default=500, help='calls of every read query')
+    parser.add_argument('--output', help='append the JSON result to this file')
+    args, _ = parser.parse_known_args()
+
+    mlcourse_database.db_file_path = str(Path(tempfile.mkdtemp()) / 'solutions.db')
+    rng = random.Random(0)
+    timings: Dict[str, List[float]] = defaultdict(list)
+
+    telegram_ids = list(range(1, args.students + 1))
+    for telegram_id in telegram_ids:
+        mlcourse_database.set_student_full_name(telegram_id, f'Студент {telegram_id}')
+        mlcourse_database.set_student_id(telegram_id, telegram_id)
+
+    # the write path every evaluated solution goes through
+    for _ in range(args.solutions):
+        for telegram_id in telegram_ids:
+            content_hash = f'{rng.getrandbits(64):016x}'
+            timed(
+                timings,
+                'submit_solution',
+                mlcourse_database.submit_solution,
+                telegram_id,
+                content_hash,
+                lambda solution_id: None,
+            )
+            solution_id, _, _ = timed(
+                timings,
+                'pull_next_solution',
+                mlcourse_database.pull_next_solution,
+                'w',
+                60,
+            )
+            timed(
+                timings,
+                'set_scores',
+                mlcourse_database.set_scores,
+                solution_id,
+                {'badnets': (rng.random(), rng.random())},
+            )
+
+    for _ in range(args.repeat):
+        telegram_id = rng.choice(telegram_ids)
+        timed(timings, 'get_student_info', mlcourse_database.get_student_info, telegram_id)
+        timed(
+            timings,
+            'get_unchecked_solution_status',
+            mlcourse_database.get_unchecked_solution_status,
+            telegram_id,
+        )
+        timed(timings, 'get_cache_stats', mlcourse_database.get_cache_stats, telegram_id)
+        timed(timings, 'get_status_snapshot', mlcourse_database.get_status_snapshot, telegram_id)
+        for best_or_latest in ['best', 'latest']:
+            timed(
+                timings,
+                f'get_top_solution.{best_or_latest}',
+                mlcourse_database.get_top_solution,
+                telegram_id,
+                'badnets',
+                best_or_latest,
+            )
+        timed(timings, 'requeue_expired_leases', mlcourse_database.requeue_expired_leases)
+
+    for _ in range(max(args.repeat // 10, 1)):
+        timed(timings, 'get_leaderboard', mlcourse_database.get_leaderboard, 'badnets')
+    timed(timings, 'rebuild_leaderboard', mlcourse_database.rebuild_leaderboard)
+
+    report(
+        'db',
+        {
+            'students': args.students,
+            'solutions': args.students * args.solutions,
+            'microseconds': {name: summarize(values, 1) for name, values in timings.items()},
+        },
+        args.output,
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,350 @@
+import argparse
+import configparser
+import io
+import os
+import random
+import secrets
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Dict, List
+
+import numpy as np
+from PIL import Image
+
+from benchmarks.report import report, summarize
+from benchmarks.stub_telegram import StubTelegramServer
+from benchmarks.stub_wordpress import StubWordpressServer
+from mlcourse_prac.db import mlcourse_database
+from mlcourse_prac.venv_cache import remove_read_only
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+NUM_CLASSES = 2
+IMAGE_SIZE = 32
+
+SOLUTION_TEMPLATE = '''import time
+
+import torch
+
+
+class Model:
+    def __init__(self, train_dir):
+        self.train_dir = train_dir
+
+    def train(self):
+        time.sleep({train_seconds})
+
+    def predict(self, images):
+        # variant {variant}
+        return torch.rand(len(images), {num_classes}, device=images.device)
+'''
+
+
+def make_dataset(data_dir: Path, images_per_class: int) -> None:
+    rng = np.random.default_rng(0)
+    for subset in ['train', 'test/clean', 'test/poisoned']:
+        for label in range(NUM_CLASSES):
+            class_dir = data_dir / 'badnets' / subset / f'class{label}'
+            class_dir.mkdir(parents=True)
+            for index in range(images_per_class):
+                pixels = rng.integers(0, 256, (IMAGE_SIZE, IMAGE_SIZE, 3), dtype=np.uint8)
+                Image.fromarray(pixels).save(class_dir / f'{index}.png')
+
+
+def solution_archive(variant: int, train_seconds: float) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as zf:
+        zf.writestr('requirements.txt', '')
+        zf.writestr(
+            'solution.py',
+            SOLUTION_TEMPLATE.format(
+                train_seconds=train_seconds, variant=variant, num_classes=NUM_CLASSES
+            ),
+        )
+    return buffer.getvalue()
+
+
+def write_config(
+    config_path: Path,
+    root: Path,
+    telegram: StubTelegramServer,
+    wordpress: StubWordpressServer,
+    args,
+) -> None:
+    config = configparser.ConfigParser()
+    config.read_dict(
+        {
+            'paths': {'data_dir': str(root / 'data'), 'solutions_dir': str(root / 'solutions')},
+            'telebot': {
+                'token': '123456:benchmark',
+                'mode': args.mode,
+                'upload_workers': '4',
+                'max_uploads_per_user': '1',
+                'db_workers': '4',
+                'api_url': telegram.url,
+                'max_solution_size_mb': '10',
+                'max_archive_entries': '1000',
+                'max_uncompressed_size_mb': '200',
+            },
+            'wordpress': {
+                'username': 'user',
+                'password': 'password',
+                'page_id': '1',
+                'url': wordpress.url,
+                'publish_debounce_seconds': str(args.debounce),
+                'request_timeout_seconds': '5',
+                'max_retries': '3',
+            },
+            'evaluation': {
+                'num_workers': str(args.workers),
+                'heartbeat_interval_seconds': '5',
+                'lease_timeout_seconds': '30',
+                'sleep_no_solutions_minutes': '1',
+                'run_timeout_minutes': '5',
+                'batch_size': '16',
+                'device': 'cpu',
+                'cpu_shards': str(args.cpu_shards),
+                'dataloader_num_workers': '0',
+                'test_cache_dir': str(root / 'solutions' / 'test_cache'),
+                'venv_cache_dir': str(root / 'solutions' / 'venv_cache'),
+                'venv_cache_budget_gb': '5',
+            },
+            'coordinator': {
+                'host': '127.0.0.1',
+                'port': str(args.coordinator_port),
+                'token': secrets.token_hex(32),
+                'url': f'http://127.0.0.1:{args.coordinator_port}',
+                'poll_interval_seconds': '5',
+            },
+            'scheduler': {'policy': args.policy},
+            'badnets': {'train_dir': 'badnets/train/', 'test_dir': 'badnets/test/'},
+            'lira': {
+                'clean_dir': 'lira/clean/',
+                'test_dir': 'lira/test/',
+                'model_path': 'lira/model.pt',
+            },
+        }
+    )
+    with open(config_path, 'w') as f:
+        config.write(f)
+
+    # mlcourse-worker runs as many processes as the evaluation section says
+    config['evaluation']['num_workers'] = str(args.remote_workers)
+    with open(config_path.with_name('worker.conf'), 'w') as f:
+        config.write(f)
+
+
+def is_result(text: str) -> bool:
+    return text.startswith('Последнее решение') or 'загрузи его заново' in text
+
+
+def is_submit_reply(text: str) -> bool:
+    return 'Решение принято' in text or 'уже проверялось' in text or 'MB!' in text
+
+
+def simulate_student(
+    telegram: StubTelegramServer, index: int, args, results: Dict[str, List[Any]]
+) -> None:
+    chat_id = 1000 + index
+    rng = random.Random(index)
+    name = 'Студент ' + ''.join('абвгдежзик'[int(digit)] for digit in str(index))
+    for text, reply in [
+        ('/start', 'Привет'),
+        (name, 'Теперь введи'),
+        (str(100000 + index), 'Теперь можно'),
+    ]:
+        start = telegram.sent_count(chat_id)
+        telegram.push_text(chat_id, text)
+        if telegram.wait_for_message(chat_id, lambda t: reply in t, start, args.timeout) is None:
+            results['errors'].append(f'student {index}: no reply to {text!r}')
+            return
+        # the bot registers the next step handler only after its reply has been sent, and
+        # telebot skips some of the next step handlers when several arrive in one batch
+        time.sleep(rng.uniform(0.5, 1.5))
+
+    variant = index * 1000
+    for _ in range(args.submissions):
+        # a share of the resubmissions repeats the previous archive and hits the result cache
+        if rng.random() >= args.repeat_rate:
+            variant += 1
+        start = telegram.sent_count(chat_id)
+        submitted = time.time()
+        telegram.push_document(chat_id, 'solution.zip', solution_archive(variant, args.train))
+        results['submitted'].append(submitted)
+
+        reply = telegram.wait_for_message(chat_id, is_submit_reply, start, args.timeout)
+        if reply is None:
+            results['errors'].append(f'student {index}: submission was not acknowledged')
+            return
+        if 'уже проверялось' in reply['text']:
+            results['cached'].append(reply['time'] - submitted)
+            continue
+
+        deadline = time.monotonic() + args.timeout
+        while True:
+            result = telegram.wait_for_message(chat_id, is_result, start, args.status_interval)
+            if result is not None:
+                break
+            if time.monotonic() > deadline:
+                results['errors'].append(f'student {index}: no result in {args.timeout} s')
+                return
+
+            status_start = telegram.sent_count(chat_id)
+            status_sent = time.time()
+            telegram.push_text(chat_id, '/status')
+            status = telegram.wait_for_message(
+                chat_id, lambda t: t.startswith('*Статус'), status_start, args.timeout
+            )
+            if status is not None:
+                results['status'].append(status['time'] - status_sent)
+
+        outcome = 'checked' if 'проверено' in result['text'] else 'failed'
+        results[outcome].append(result['time'] - submitted)
+        time.sleep(rng.uniform(0, 2 * args.think))
+
+
+def probe_lock_waits(db_path: Path, stop: threading.Event, waits: List[float]) -> None:
+    # how long a writer waits for the database, measured the same way a transaction would
+    while not db_path.exists() and not stop.is_set():
+        time.sleep(0.1)
+    connection = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+    while not stop.wait(0.05):
+        started = time.perf_counter()
+        connection.execute('BEGIN IMMEDIATE;')
+        waits.append(time.perf_counter() - started)
+        connection.execute('ROLLBACK;')
+    connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end load test of the bot and the checker')
+    parser.add_argument('--students', type=int, default=20)
+    parser.add_argument('--submissions', type=int, default=3, help='per student')
+    parser.add_argument('--repeat-rate', type=float, default=0.2)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument(
+        '--remote-workers', type=int, default=0, help='mlcourse-worker processes on localhost'
+    )
+    parser.add_argument('--coordinator-port', type=int, default=8470)
+    parser.add_argument('--mode', choices=['sync', 'async'], default='async', help='bot mode')
+    parser.add_argument('--policy', choices=['fifo', 'fair_share', 'sejf'], default='fair_share')
+    parser.add_argument('--cpu-shards', type=int, default=1, help='test processes on CPU')
+    parser.add_argument('--train', type=float, default=1.0, help='seconds the dummy model trains')
+    parser.add_argument('--think', type=float, default=2.0, help='mean seconds between attempts')
+    parser.add_argument('--status-interval', type=float, default=5.0)
+    parser.add_argument('--download-delay', type=float, default=0.0, help='seconds per archive')
+    parser.add_argument('--images-per-class', type=int, default=32)
+    parser.add_argument('--debounce', type=float, default=1.0)
+    parser.add_argument('--timeout', type=float, default=600.0)
+    parser.add_argument('--keep', action='store_true', help='keep the temporary directory')
+    parser.add_argument('--output', help='append the JSON result to this file')
+    args, _ = parser.parse_known_args()
+
+    root = Path(tempfile.mkdtemp(prefix='mlcourse-bench-'))
+    make_dataset(root / 'data', args.images_per_class)
+    (root / 'solutions').mkdir()
+    telegram = StubTelegramServer(download_delay_seconds=args.download_delay).start()
+    wordpress = StubWordpressServer().start()
+    config_path = root / 'mlcourse.conf'
+    write_config(config_path, root, telegram, wordpress, args)
+
+    db_path = root / 'solutions' / 'solutions.db'
+    environment = dict(
+        os.environ,
+        MLCOURSE_CONFIG=str(config_path),
+        PYTHONPATH=os.pathsep.join([str(REPO_DIR), os.environ.get('PYTHONPATH', '')]),
+    )
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'mlcourse_prac.server'],
+        env=environment,
+        cwd=root,
+        start_new_session=True,
+    )
+    worker = None
+    if args.remote_workers:
+        worker = subprocess.Popen(
+            [sys.executable, '-m', 'mlcourse_prac.worker'],
+            env=dict(environment, MLCOURSE_CONFIG=str(root / 'worker.conf')),
+            cwd=root,
+            start_new_session=True,
+        )
+
+    stop_probe = threading.Event()
+    lock_waits: List[float] = []
+    probe = threading.Thread(target=probe_lock_waits, args=(db_path, stop_probe, lock_waits))
+    probe.start()
+
+    results: Dict[str, List[Any]] = defaultdict(list)
+    started = time.time()
+    students = [
+        threading.Thread(target=simulate_student, args=(telegram, index, args, results))
+        for index in range(args.students)
+    ]
+    for student in students:
+        student.start()
+    for student in students:
+        student.join()
+    elapsed = time.time() - started
+
+    # the last results may still be waiting for the debounced publication
+    time.sleep(args.debounce + 1)
+    stop_probe.set()
+    probe.join()
+    os.killpg(server.pid, signal.SIGKILL)
+    server.wait()
+    if worker is not None:
+        os.killpg(worker.pid, signal.SIGKILL)
+        worker.wait()
+    telegram.stop()
+    wordpress.stop()
+
+    mlcourse_database.db_file_path = str(db_path)
+    stages = defaultdict(list)
+    for name, value in mlcourse_database.get_metrics(started):
+        stages[name].append(value)
+
+    evaluated = results['checked'] + results['failed']
+    report(
+        'load',
+        {
+            'students': args.students,
+            'workers': args.workers,
+            'remote_workers': args.remote_workers,
+            'mode': args.mode,
+            'policy': args.policy,
+            'cpu_shards': args.cpu_shards,
+            'submitted': len(results['submitted']),
+            'checked': len(results['checked']),
+            'failed': len(results['failed']),
+            'cached': len(results['cached']),
+            'errors': results['errors'][:10],
+            'elapsed_seconds': round(elapsed, 1),
+            'submissions_per_hour': round(len(evaluated) / elapsed * 3600, 1),
+            'latency_seconds': summarize(evaluated, 2),
+            'cached_latency_seconds': summarize(results['cached'], 3),
+            'status_latency_seconds': summarize(results['status'], 3),
+            'db_lock_wait_ms': summarize([wait * 1000 for wait in lock_waits], 2),
+            'leaderboard_posts': len(wordpress.posts),
+            'wordpress_requests': wordpress.requests_count,
+            'telegram_requests': telegram.requests_count,
+            'metrics': {name: summarize(values) for name, values in sorted(stages.items())},
+        },
+        args.output,
+    )
+
+    if args.keep:
+        print(f'Files are kept in {root}', file=sys.stderr)
+    else:
+        # cached environments are read-only
+        remove_read_only(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+import argparse
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from benchmarks.report import report
+from benchmarks.stub_wordpress import StubWordpressServer
+from mlcourse_prac.config import CONFIG
+from mlcourse_prac.db import mlcourse_database
+from mlcourse_prac.leaderboard import run_publisher, WordpressPublisher
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Leaderboard publisher against a stub WordPress')
+    parser.add_argument('--changes', type=int, default=200)
+    parser.add_argument('--distinct-every', type=int, default=3)
+    parser.add_argument('--interval', type=float, default=0.01)
+    parser.add_argument('--debounce', type=float, default=0.2)
+    parser.add_argument('--delay', type=float, default=0.05)
+    parser.add_argument('--failures', type=int, default=2)
+    parser.add_argument('--output', help='append the JSON result to this file')
+    args, _ = parser.parse_known_args()
+
+    # the publisher records its timings, keep them away from the real database
+    mlcourse_database.db_file_path = str(Path(tempfile.mkdtemp()) / 'solutions.db')
+    stub = StubWordpressServer(delay_seconds=args.delay, failures=args.failures).start()
+    CONFIG.read_dict(
+        {
+            'wordpress': {
+                'username': 'user',
+                'password': 'password',
+                'page_id': '1',
+                'url': stub.url,
+                'request_timeout_seconds': '5',
+                'max_retries': '5',
+            }
+        }
+    )
+
+    # only every n-th change alters the rendered page, the rest must not be posted
+    version = [0]
+    renders = [0]
+
+    def render() -> str:
+        renders[0] += 1
+        return f'<p>leaderboard version {version[0] // args.distinct_every}</p>'
+
+    changed = threading.Event()
+    publisher = WordpressPublisher()
+    threading.Thread(
+        target=run_publisher, args=(changed, render, publisher, args.debounce), daemon=True
+    ).start()
+
+    started = time.monotonic()
+    for _ in range(args.changes):
+        version[0] += 1
+        changed.set()
+        time.sleep(args.interval)
+
+    expected = f'<p>leaderboard version {version[0] // args.distinct_every}</p>'
+    while not stub.posts or stub.posts[-1]['json']['content'] != expected:
+        time.sleep(0.01)
+    elapsed = time.monotonic() - started
+    stub.stop()
+
+    report(
+        'publisher',
+        {
+            'changes': args.changes,
+            'renders': renders[0],
+            'posts': len(stub.posts),
+            'http_requests': stub.requests_count,
+            'seconds_to_converge': round(elapsed, 3),
+        },
+        args.output,
+    )
+
+
+if __name__ == '__main__':
+    main()
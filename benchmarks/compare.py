@@ -0,0 +1,63 @@
+import argparse
+import json
+from typing import Any, Dict, Iterator, Tuple
+
+from tabulate import tabulate
+
+
+def numeric_fields(results: Dict[str, Any], prefix: str = '') -> Iterator[Tuple[str, float]]:
+    for key, value in results.items():
+        if key in ['commit', 'time']:
+            continue
+        if isinstance(value, dict):
+            yield from numeric_fields(value, f'{prefix}{key}.')
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield prefix + key, value
+
+
+def load_latest(path: str) -> Dict[str, Dict[str, Any]]:
+    # the last run of every benchmark in the file
+    latest = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                results = json.loads(line)
+                latest[results['benchmark']] = results
+    return latest
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two files of benchmark results')
+    parser.add_argument('base')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=10.0, help='percent to flag a change')
+    args, _ = parser.parse_known_args()
+
+    base, new = load_latest(args.base), load_latest(args.new)
+    rows = []
+    for benchmark in sorted(base.keys() & new.keys()):
+        new_values = dict(numeric_fields(new[benchmark]))
+        for name, base_value in numeric_fields(base[benchmark]):
+            if name not in new_values:
+                continue
+            new_value = new_values[name]
+            change = (new_value - base_value) / base_value * 100 if base_value else 0.0
+            flag = '!' if abs(change) >= args.threshold else ''
+            rows.append([benchmark, name, base_value, new_value, f'{change:+.1f}%', flag])
+    print(
+        tabulate(
+            rows,
+            headers=[
+                'benchmark',
+                'value',
+                base[next(iter(base))]['commit'] if base else 'base',
+                new[next(iter(new))]['commit'] if new else 'new',
+                'change',
+                '',
+            ],
+        )
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+import json
+import subprocess
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional
+
+from mlcourse_prac.metrics import percentile
+
+
+def current_commit() -> Optional[str]:
+    completed = subprocess.run(
+        ['git', 'rev-parse', '--short', 'HEAD'],
+        capture_output=True,
+        text=True,
+        cwd=Path(__file__).resolve().parent,
+    )
+    return completed.stdout.strip() if completed.returncode == 0 else None
+
+
+def summarize(values: Iterable[float], digits: int = 4) -> Dict[str, Any]:
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+    summary = {'count': len(values)}
+    for q in [50, 90, 99]:
+        summary[f'p{q}'] = round(percentile(values, q), digits)
+    summary['max'] = round(values[-1], digits)
+    summary['mean'] = round(sum(values) / len(values), digits)
+    return summary
+
+
+def report(benchmark: str, results: Dict[str, Any], output: Optional[str] = None) -> None:
+    # one JSON object per line, so that runs of several commits can be appended to one file
+    line = json.dumps(
+        {'benchmark': benchmark, 'commit': current_commit(), 'time': int(time.time()), **results}
+    )
+    print(line)
+    if output is not None:
+        with open(output, 'a') as f:
+            f.write(line + '\n')
@@ -0,0 +1,165 @@
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import parse_qsl, urlsplit
+
+
+class StubTelegramServer:
+    # implements the part of the Bot API used by the bot, students are simulated by pushing updates
+    def __init__(self, download_delay_seconds: float = 0.0) -> None:
+        self.download_delay_seconds = download_delay_seconds
+        self.updates: List[Dict[str, Any]] = []
+        self.files: Dict[str, bytes] = {}
+        self.sent: Dict[int, List[Dict[str, Any]]] = {}
+        self.requests_count = 0
+        self.condition = threading.Condition()
+        self.ids = itertools.count(1)
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def handle_request(self):
+                url = urlsplit(self.path)
+                params = dict(parse_qsl(url.query))
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.headers.get('Content-Type', '').startswith('application/x-www-form'):
+                    params.update(parse_qsl(body.decode()))
+
+                with stub.condition:
+                    stub.requests_count += 1
+                parts = url.path.strip('/').split('/')
+                if parts[0] == 'file':
+                    # stands for a large archive on a slow link
+                    time.sleep(stub.download_delay_seconds)
+                    content = stub.files.get(parts[-1])
+                    self.respond(404 if content is None else 200, content or b'', 'application/zip')
+                    return
+
+                method = getattr(stub, 'api_' + parts[-1], None)
+                if method is None:
+                    result = {'ok': False, 'error_code': 404, 'description': 'Not Found'}
+                    self.respond(404, json.dumps(result).encode(), 'application/json')
+                    return
+                result = {'ok': True, 'result': method(params)}
+                self.respond(200, json.dumps(result).encode(), 'application/json')
+
+            def respond(self, status: int, content: bytes, content_type: str) -> None:
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = handle_request
+            do_POST = handle_request
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address
+        return f'http://{host}:{port}'
+
+    def start(self) -> 'StubTelegramServer':
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        with self.condition:
+            # releases the bot's long polling request
+            self.condition.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def message(self, chat_id: int, **fields: Any) -> Dict[str, Any]:
+        return {
+            'message_id': next(self.ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': f'Student{chat_id}'},
+            **fields,
+        }
+
+    def push_text(self, chat_id: int, text: str) -> None:
+        self.push_update(self.message(chat_id, text=text))
+
+    def push_document(self, chat_id: int, file_name: str, content: bytes) -> None:
+        file_id = f'file{next(self.ids)}'
+        self.files[file_id] = content
+        document = {
+            'file_id': file_id,
+            'file_unique_id': file_id,
+            'file_name': file_name,
+            'file_size': len(content),
+        }
+        self.push_update(self.message(chat_id, document=document))
+
+    def push_update(self, message: Dict[str, Any]) -> None:
+        with self.condition:
+            self.updates.append({'update_id': len(self.updates) + 1, 'message': message})
+            self.condition.notify_all()
+
+    def wait_for_message(
+        self, chat_id: int, predicate: Callable[[str], bool], start: int, timeout: float
+    ) -> Optional[Dict[str, Any]]:
+        # returns the first message to the chat at index start or later that matches
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                for sent in self.sent.get(chat_id, [])[start:]:
+                    if predicate(sent['text']):
+                        return sent
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+    def sent_count(self, chat_id: int) -> int:
+        with self.condition:
+            return len(self.sent.get(chat_id, []))
+
+    def api_getMe(self, params: Dict[str, str]) -> Dict[str, Any]:
+        return {'id': 1, 'is_bot': True, 'first_name': 'mlcourse', 'username': 'mlcourse_bot'}
+
+    def api_getUpdates(self, params: Dict[str, str]) -> List[Dict[str, Any]]:
+        offset = int(params.get('offset', 1))
+        limit = int(params.get('limit', 100))
+        deadline = time.monotonic() + float(params.get('timeout', 0))
+        with self.condition:
+            while len(self.updates) < offset and time.monotonic() < deadline:
+                self.condition.wait(deadline - time.monotonic())
+            return self.updates[max(offset - 1, 0) : max(offset - 1, 0) + limit]
+
+    def api_getFile(self, params: Dict[str, str]) -> Dict[str, Any]:
+        file_id = params['file_id']
+        return {
+            'file_id': file_id,
+            'file_unique_id': file_id,
+            'file_size': len(self.files[file_id]),
+            'file_path': f'documents/{file_id}',
+        }
+
+    def api_sendMessage(self, params: Dict[str, str]) -> Dict[str, Any]:
+        chat_id = int(params['chat_id'])
+        message = self.message(chat_id, text=params['text'])
+        with self.condition:
+            self.sent.setdefault(chat_id, []).append({'time': time.time(), 'text': params['text']})
+            self.condition.notify_all()
+        return message
+
+
+if __name__ == '__main__':
+    stub = StubTelegramServer().start()
+    print(f'Stub Telegram Bot API is listening on {stub.url}')
+    try:
+        stub.thread.join()
+    except KeyboardInterrupt:
+        stub.stop()
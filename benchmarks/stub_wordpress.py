@@ -0,0 +1,64 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List
+
+
+class StubWordpressServer:
+    # accepts page updates like the WordPress REST API, optionally slow or failing
+    def __init__(self, delay_seconds: float = 0.0, failures: int = 0) -> None:
+        self.delay_seconds = delay_seconds
+        self.failures_left = failures
+        self.posts: List[Dict[str, Any]] = []
+        self.requests_count = 0
+        self.lock = threading.Lock()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                time.sleep(stub.delay_seconds)
+                with stub.lock:
+                    stub.requests_count += 1
+                    failing = stub.failures_left > 0
+                    if failing:
+                        stub.failures_left -= 1
+                    else:
+                        stub.posts.append(
+                            {'path': self.path, 'time': time.time(), 'json': json.loads(body)}
+                        )
+
+                self.send_response(503 if failing else 200)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(b'{}')
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address
+        return f'http://{host}:{port}/wp-json/wp/v2/pages/'
+
+    def start(self) -> 'StubWordpressServer':
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == '__main__':
+    stub = StubWordpressServer().start()
+    print(f'Stub WordPress is listening on {stub.url}')
+    try:
+        stub.thread.join()
+    except KeyboardInterrupt:
+        stub.stop()
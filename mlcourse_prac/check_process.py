@@ -1,65 +1,433 @@
+import json
+import multiprocessing as mp
+import multiprocessing.connection
+import os
+import select
 import shutil
+import signal
+import socket
 import subprocess
+import sys
+import threading
 import time
 from pathlib import Path
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
 
 from mlcourse_prac.config import CONFIG
 from mlcourse_prac.db import mlcourse_database
-from mlcourse_prac.leaderboard import update_leaderboard
-from mlcourse_prac.telebot import init_telebot
+from mlcourse_prac.limits import describe_usage, RunResources
+from mlcourse_prac.metrics import JOB_STARTED_VARIABLE, Metrics
+from mlcourse_prac.notifications import Notifications
+from mlcourse_prac.outbox import queue_message
+from mlcourse_prac.progress import describe_progress, PROGRESS_FILE, read_progress
+from mlcourse_prac.report import read_report, REPORT_FILE
+from mlcourse_prac.run_log import RunLog
+from mlcourse_prac.store import enforce_retention
+from mlcourse_prac.submissions import remove_evaluation, take_submission
+from mlcourse_prac.test_cache import prepare_test_caches
 
 
-def check_process():
-    bot, _ = init_telebot()
+SAMPLING_INTERVAL_SECONDS = 1
+PIPE_DRAIN_SECONDS = 5
+PROGRESS_PREFIX = 'Последнее решение проверяется: '
+LOG_HINT = '\n\nПолный вывод проверки: /log'
+# sh reads a pipe byte by byte, the rest of stdin is left to the evaluator
+ATTACH_GATE = ['/bin/sh', '-c', 'read -r _ && exec "$@"', 'attach-gate']
 
-    while True:
-        oldest_new_solution = mlcourse_database.pull_oldest_new_solution()
-        if oldest_new_solution is None:
-            time.sleep(int(CONFIG['evaluation']['sleep_no_solutions_minutes']) * 60)
-            continue
 
-        telegram_id = oldest_new_solution[0]
-        all_solutions_dir = Path('/solutions')
-        original_dir = all_solutions_dir / str(telegram_id)
-        evaluation_dir = all_solutions_dir / 'evaluation' / str(telegram_id)
-        shutil.copytree(original_dir, evaluation_dir)
+class LeaseLost(Exception):
+    pass
 
-        shell_script_path = Path(__file__).resolve().parent / 'venv.sh'
-        shutil.copy(shell_script_path, evaluation_dir)
 
-        run_timeout_minutes = int(CONFIG['evaluation']['run_timeout_minutes'])
+class ResourceLimitExceeded(Exception):
+    pass
+
+
+class EvaluationResult(NamedTuple):
+    # everything the evaluator has left, remote workers send it to the coordinator as JSON
+    timed_out: bool
+    returncode: Optional[int]
+    # the end of stderr, the whole output is in the log of the run
+    stderr_tail: str
+    progress: Optional[Dict[str, Any]]
+    report: Dict[str, Any]
+    # description of the limit the run was killed at
+    limit_exceeded: Optional[str]
+    usage: Dict[str, float]
+
+
+def start_evaluator(
+    args: List[str],
+    cwd: Optional[Path] = None,
+    env: Optional[Dict[str, str]] = None,
+    resources: Optional[RunResources] = None,
+) -> subprocess.Popen:
+    # own session so that the whole process tree (bash, pip, python) can be killed at once
+    if resources is not None:
+        # the evaluator waits for a line on stdin until it is in the cgroup of the run,
+        # preexec_fn could deadlock the fork of a process with threads
+        args = ATTACH_GATE + args
+    process = subprocess.Popen(
+        args,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        # the output of a solution is not necessarily valid UTF-8, whatever the locale is
+        encoding='utf-8',
+        errors='replace',
+        cwd=cwd,
+        env=env,
+        start_new_session=True,
+    )
+    if resources is not None:
         try:
-            completed = subprocess.run(
-                ['/bin/bash', 'venv.sh'],
-                capture_output=True,
-                text=True,
-                timeout=run_timeout_minutes * 60,
-                cwd=evaluation_dir,
+            resources.attach(process.pid)
+        except BaseException:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+            raise
+        process.stdin.write('\n')
+        process.stdin.flush()
+    return process
+
+
+class WarmPool:
+    # evaluators started ahead of time that have already imported torch, created the CUDA
+    # context and loaded the test data, each of them takes one job and exits
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.processes: List[subprocess.Popen] = []
+
+    def fill(self) -> None:
+        self.processes = [process for process in self.processes if process.poll() is None]
+        while len(self.processes) < self.size:
+            self.processes.append(
+                start_evaluator([sys.executable, '-I', '-m', 'mlcourse_prac.warm_evaluator'])
             )
+
+    def take(self) -> Optional[subprocess.Popen]:
+        # an evaluator that is still warming up is left for the next job
+        for process in self.processes:
+            if process.poll() is not None:
+                continue
+            ready, _, _ = select.select([process.stdout], [], [], 0)
+            if ready and process.stdout.readline() == 'ready\n':
+                self.processes.remove(process)
+                return process
+        return None
+
+
+def run_solution(
+    evaluation_dir: Path,
+    warm_pool: WarmPool,
+    renew_lease: Callable[[], bool],
+    resources: RunResources,
+    run_log: RunLog,
+) -> int:
+    # returns the exit code, the output goes to run_log as it comes
+    run_timeout_seconds = int(CONFIG['evaluation']['run_timeout_minutes']) * 60
+    heartbeat_seconds = int(CONFIG['evaluation']['heartbeat_interval_seconds'])
+
+    process = warm_pool.take()
+    if process is not None:
+        resources.attach(process.pid)
+        job = json.dumps({'evaluation_dir': str(evaluation_dir), 'started': time.time()}) + '\n'
+    else:
+        environment = dict(os.environ, **{JOB_STARTED_VARIABLE: str(time.time())})
+        process = start_evaluator(['/bin/bash', 'venv.sh'], evaluation_dir, environment, resources)
+        job = ''
+    # the replacement warms up while this solution runs
+    warm_pool.fill()
+
+    try:
+        process.stdin.write(job)
+        process.stdin.close()
+    except BrokenPipeError:
+        # the warm evaluator has died, its exit code tells the rest
+        pass
+    readers = [run_log.follow(process.stdout), run_log.follow(process.stderr, to_tail=True)]
+
+    deadline = time.monotonic() + run_timeout_seconds
+    next_heartbeat = time.monotonic() + heartbeat_seconds
+    while True:
+        try:
+            process.wait(timeout=SAMPLING_INTERVAL_SECONDS)
+            break
         except subprocess.TimeoutExpired:
-            mlcourse_database.set_error_status(telegram_id)
-            bot.send_message(
+            run_log.relay_progress()
+            limit_exceeded = resources.sample(process.pid)
+            if time.monotonic() < next_heartbeat:
+                lease_renewed = True
+            else:
+                lease_renewed = renew_lease()
+                next_heartbeat = time.monotonic() + heartbeat_seconds
+            if lease_renewed and limit_exceeded is None and time.monotonic() < deadline:
+                continue
+
+            os.killpg(process.pid, signal.SIGKILL)
+            resources.kill()
+            process.wait()
+            drain_output(readers)
+            if not lease_renewed:
+                raise LeaseLost(evaluation_dir.name)
+            if limit_exceeded is not None:
+                raise ResourceLimitExceeded(limit_exceeded)
+            raise subprocess.TimeoutExpired(process.args, run_timeout_seconds)
+
+    drain_output(readers)
+    return process.returncode
+
+
+def drain_output(readers: List[threading.Thread]) -> None:
+    # a process that has escaped the session may keep the pipes open, it is not waited for
+    for reader in readers:
+        reader.join(PIPE_DRAIN_SECONDS)
+
+
+def run_evaluation(
+    evaluation_dir: Path,
+    metrics: Metrics,
+    warm_pool: WarmPool,
+    renew_lease: Callable[[], bool],
+    run_log: RunLog,
+) -> EvaluationResult:
+    shell_script_path = Path(__file__).resolve().parent / 'venv.sh'
+    shutil.copy(shell_script_path, evaluation_dir)
+    # a requeued solution keeps its directory, a crashed attempt must not report the results
+    # of the previous one
+    for file_name in [REPORT_FILE, PROGRESS_FILE]:
+        for path in [evaluation_dir / file_name, (evaluation_dir / file_name).with_suffix('.tmp')]:
+            path.unlink(missing_ok=True)
+
+    resources = RunResources(f'{os.getpid()}-{evaluation_dir.name}')
+    timed_out, returncode, limit_exceeded = False, None, None
+    try:
+        with metrics.stage('run'):
+            returncode = run_solution(evaluation_dir, warm_pool, renew_lease, resources, run_log)
+    except subprocess.TimeoutExpired:
+        timed_out = True
+    except ResourceLimitExceeded as e:
+        limit_exceeded = str(e)
+    finally:
+        enforced_limit = resources.finish()
+        run_log.close()
+    # a limit hit by a process the solution could do without is not a failure
+    if limit_exceeded is None and returncode != 0 and not timed_out:
+        limit_exceeded = enforced_limit
+
+    progress = read_progress(evaluation_dir)
+    usage = dict(resources.usage)
+    if progress is not None and 'peak_gpu_memory_mb' in progress:
+        usage['peak_gpu_memory_mb'] = progress['peak_gpu_memory_mb']
+    return EvaluationResult(
+        timed_out,
+        returncode,
+        run_log.tail_text(),
+        progress,
+        read_report(evaluation_dir),
+        limit_exceeded,
+        usage,
+    )
+
+
+def claim_solution(notifications: Notifications, worker_id: str) -> Optional[Tuple[int, int, Path]]:
+    # returns the solution, its author and the evaluation directory, None if the queue is empty
+    lease_seconds = int(CONFIG['evaluation']['lease_timeout_seconds'])
+    failed_ids = mlcourse_database.requeue_expired_leases()
+    for failed_id in failed_ids:
+        remove_evaluation(failed_id)
+    if failed_ids:
+        notifications.status_changed.put(None)
+    try:
+        # at most every few minutes, whichever evaluator comes first
+        enforce_retention()
+    except Exception as e:
+        print(f'Store retention failed, will retry: {e}', file=sys.stderr)
+
+    while True:
+        next_solution = mlcourse_database.pull_next_solution(worker_id, lease_seconds)
+        if next_solution is None:
+            return None
+
+        solution_id, telegram_id, queued_at = next_solution
+        notifications.status_changed.put(telegram_id)
+        queue_wait = time.time() - queued_at
+        try:
+            started = time.perf_counter()
+            evaluation_dir = take_submission(solution_id)
+        except FileNotFoundError:
+            mlcourse_database.set_error_status(solution_id)
+            notifications.status_changed.put(telegram_id)
+            queue_message(
+                notifications,
                 telegram_id,
-                (
-                    'Последнее решение превысило допустимое время работы '
-                    f'в {run_timeout_minutes} минут!'
-                ),
+                'Файлы последнего решения не найдены, загрузи его заново!',
             )
-            return
-        finally:
-            shutil.rmtree(evaluation_dir)
-            shutil.rmtree(original_dir)
-
-        if completed.returncode != 0:
-            error_message = (
-                f'Последнее решение завершилось ошибкой (код {completed.returncode}). '
-                + 'Привожу stderr:\n\n'
-                + completed.stderr
+            continue
+
+        mlcourse_database.record_metrics(
+            solution_id,
+            {'queue_wait': queue_wait, 'stage.take_submission': time.perf_counter() - started},
+        )
+        return solution_id, telegram_id, evaluation_dir
+
+
+def finish_solution(
+    notifications: Notifications,
+    solution_id: int,
+    telegram_id: int,
+    result: EvaluationResult,
+    metrics: Metrics,
+) -> None:
+    for name, value in result.report['metrics'].items():
+        metrics.add(name, value)
+    for name, value in result.usage.items():
+        metrics.set_max(name, value)
+    usage_message = describe_usage(result.usage)
+
+    if result.limit_exceeded is not None:
+        mlcourse_database.set_error_status(solution_id)
+        notifications.status_changed.put(telegram_id)
+        metrics.save()
+        queue_message(
+            notifications,
+            telegram_id,
+            (
+                f'Последнее решение превысило {result.limit_exceeded} и было остановлено!\n\n'
+                + describe_progress(result.progress)
+                + '\n'
+                + usage_message
+                + LOG_HINT
+            ),
+        )
+    elif result.timed_out:
+        # partial accuracies are kept for statistics, they never get to the leaderboard
+        for subset, counts in (result.progress or {}).get('subsets', {}).items():
+            if counts['processed'] > 0:
+                metrics.add(f'partial.{subset}.accuracy', counts['correct'] / counts['processed'])
+                metrics.add(f'partial.{subset}.fraction', counts['processed'] / counts['total'])
+        mlcourse_database.set_error_status(solution_id)
+        notifications.status_changed.put(telegram_id)
+        metrics.save()
+        run_timeout_minutes = int(CONFIG['evaluation']['run_timeout_minutes'])
+        queue_message(
+            notifications,
+            telegram_id,
+            (
+                'Последнее решение превысило допустимое время работы '
+                f'в {run_timeout_minutes} минут!\n\n'
+                + describe_progress(result.progress)
+                + '\n'
+                + usage_message
+                + LOG_HINT
+            ),
+        )
+    elif result.returncode != 0:
+        error_message = (
+            f'Последнее решение завершилось ошибкой (код {result.returncode}). '
+            + describe_progress(result.progress)
+            + '\n'
+            + usage_message
+            + LOG_HINT
+            + '\n\nПривожу конец stderr:\n\n'
+            + result.stderr_tail
+        )
+        with metrics.stage('db.finish'):
+            mlcourse_database.set_error_status(solution_id)
+        notifications.status_changed.put(telegram_id)
+        metrics.save()
+        queue_message(notifications, telegram_id, error_message)
+    else:
+        scores = {
+            task: tuple(result.report['scores'][task])
+            for task in ['badnets', 'lira']
+            if task in result.report['scores']
+        }
+        with metrics.stage('db.finish'):
+            mlcourse_database.set_scores(solution_id, scores)
+        metrics.save()
+
+        notifications.status_changed.put(telegram_id)
+        notifications.leaderboard_changed.set()
+
+        queue_message(notifications, telegram_id, 'Последнее решение проверено! Нажми /status')
+
+
+def evaluate_solution(
+    notifications: Notifications,
+    warm_pool: WarmPool,
+    worker_id: str,
+    solution_id: int,
+    telegram_id: int,
+    evaluation_dir: Path,
+) -> None:
+    lease_seconds = int(CONFIG['evaluation']['lease_timeout_seconds'])
+    metrics = Metrics(solution_id)
+    run_log = RunLog(
+        f'{os.getpid()}-{solution_id}',
+        lambda line: queue_message(notifications, telegram_id, PROGRESS_PREFIX + line, 'progress'),
+    )
+    try:
+        result = run_evaluation(
+            evaluation_dir,
+            metrics,
+            warm_pool,
+            lambda: mlcourse_database.renew_lease(solution_id, worker_id, lease_seconds),
+            run_log,
+        )
+        run_log.publish(solution_id)
+    except LeaseLost:
+        # the solution has been requeued, its files belong to another worker now
+        return
+    finally:
+        run_log.discard()
+
+    remove_evaluation(solution_id)
+    finish_solution(notifications, solution_id, telegram_id, result, metrics)
+
+
+def evaluation_worker(worker_index: int, notifications: Notifications) -> None:
+    worker_id = f'{socket.gethostname()}:{os.getpid()}:{worker_index}'
+    warm_pool = WarmPool(int(CONFIG.get('evaluation', 'warm_pool_size', fallback='0')))
+    warm_pool.fill()
+
+    while True:
+        # cleared before looking at the queue, so a submission made right after the check
+        # still interrupts the wait below
+        notifications.solution_submitted.clear()
+        claimed = claim_solution(notifications, worker_id)
+        if claimed is None:
+            # polling is only a fallback in case a notification gets lost
+            notifications.solution_submitted.wait(
+                int(CONFIG['evaluation']['sleep_no_solutions_minutes']) * 60
             )
-            mlcourse_database.set_error_status(telegram_id)
-            bot.send_message(telegram_id, error_message)
-        else:
-            # FIXME: leaderboard gets updated too often this way but I'm lazy
-            update_leaderboard()
+            continue
+
+        solution_id, telegram_id, evaluation_dir = claimed
+        evaluate_solution(
+            notifications, warm_pool, worker_id, solution_id, telegram_id, evaluation_dir
+        )
+
+
+def supervise_workers(target: Callable[..., None], *args: Any) -> None:
+    # keeps [evaluation] num_workers processes running target(worker_index, *args)
+    num_workers = int(CONFIG['evaluation']['num_workers'])
+    if num_workers == 0:
+        # everything is evaluated by remote workers
+        return
+
+    prepare_test_caches()
+    workers: Dict[int, mp.Process] = {}
+    while True:
+        for worker_index in range(num_workers):
+            if worker_index not in workers or not workers[worker_index].is_alive():
+                workers[worker_index] = mp.Process(target=target, args=(worker_index, *args))
+                workers[worker_index].start()
+
+        # wakes up as soon as any worker dies, so that it gets restarted
+        mp.connection.wait([worker.sentinel for worker in workers.values()])
+
 
-            bot.send_message(telegram_id, 'Последнее решение проверено! Нажми /status')
+def check_process(notifications: Notifications):
+    supervise_workers(evaluation_worker, notifications)
@@ -1,9 +1,18 @@
 import argparse
 import configparser
+import os
+from pathlib import Path
 
 
 _parser = argparse.ArgumentParser()
-_parser.add_argument('-c', '--config', default='/etc/mlcourse.conf')
+# the environment variable reaches the evaluator subprocesses, which get no arguments
+_parser.add_argument(
+    '-c', '--config', default=os.environ.get('MLCOURSE_CONFIG', '/etc/mlcourse.conf')
+)
 
 CONFIG = configparser.ConfigParser()
-CONFIG.read(_parser.parse_args().config)
+# unknown arguments are left to the command line tools that import the config
+CONFIG.read(_parser.parse_known_args()[0].config)
+
+DATA_DIR = Path(CONFIG.get('paths', 'data_dir', fallback='/data'))
+SOLUTIONS_DIR = Path(CONFIG.get('paths', 'solutions_dir', fallback='/solutions'))
@@ -0,0 +1,190 @@
+import hmac
+import json
+import os
+import re
+import shutil
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional
+
+from mlcourse_prac.check_process import (
+    claim_solution,
+    EvaluationResult,
+    finish_solution,
+    PROGRESS_PREFIX,
+)
+from mlcourse_prac.config import CONFIG
+from mlcourse_prac.db import mlcourse_database
+from mlcourse_prac.metrics import Metrics
+from mlcourse_prac.notifications import Notifications
+from mlcourse_prac.outbox import queue_message
+from mlcourse_prac.run_log import store_log
+from mlcourse_prac.submissions import archive_evaluation, remove_evaluation
+
+JOB_PATH_RE = re.compile(r'^/jobs/(\d+)/(archive|heartbeat|log|progress|result)$')
+MAX_CLAIM_WAIT_SECONDS = 60
+# the token is all that guards the archives of the students and their scores
+MIN_TOKEN_LENGTH = 32
+
+
+class Coordinator:
+    # hands out leased solutions to mlcourse-worker processes on other machines, which
+    # have no access to the database and the solutions directory
+    def __init__(self, notifications: Notifications) -> None:
+        self.notifications = notifications
+        self.lease_seconds = int(CONFIG['evaluation']['lease_timeout_seconds'])
+
+    def claim(self, worker_id: str, wait_seconds: float) -> Dict[str, Any]:
+        # long polling: waits for a submission up to wait_seconds
+        deadline = time.monotonic() + min(wait_seconds, MAX_CLAIM_WAIT_SECONDS)
+        while True:
+            self.notifications.solution_submitted.clear()
+            claimed = claim_solution(self.notifications, worker_id)
+            if claimed is not None:
+                return {'solution_id': claimed[0]}
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self.notifications.solution_submitted.wait(remaining):
+                return {'solution_id': None}
+
+    def heartbeat(self, solution_id: int, worker_id: str) -> Dict[str, Any]:
+        renewed = mlcourse_database.renew_lease(solution_id, worker_id, self.lease_seconds)
+        return {'renewed': renewed}
+
+    def progress(self, solution_id: int, worker_id: str, line: str) -> Dict[str, Any]:
+        # already throttled by the worker
+        if not mlcourse_database.renew_lease(solution_id, worker_id, self.lease_seconds):
+            return {'renewed': False}
+        telegram_id = mlcourse_database.get_solution_owner(solution_id)
+        queue_message(self.notifications, telegram_id, PROGRESS_PREFIX + line, 'progress')
+        return {'renewed': True}
+
+    def result(self, solution_id: int, worker_id: str, body: Dict[str, Any]) -> Dict[str, Any]:
+        # a worker that has lost its lease is too late, the solution is someone else's now
+        if not mlcourse_database.renew_lease(solution_id, worker_id, self.lease_seconds):
+            return {'accepted': False}
+        telegram_id = mlcourse_database.get_solution_owner(solution_id)
+
+        metrics = Metrics(solution_id)
+        for name, value in body['metrics'].items():
+            metrics.add(name, value)
+        remove_evaluation(solution_id)
+        finish_solution(
+            self.notifications,
+            solution_id,
+            telegram_id,
+            EvaluationResult(**body['result']),
+            metrics,
+        )
+        return {'accepted': True}
+
+
+def make_handler(coordinator: Coordinator) -> type:
+    token = CONFIG['coordinator']['token']
+    # a worker keeps the current part of the log and one rotated part
+    max_log_bytes = 2 * float(CONFIG.get('evaluation', 'log_max_size_mb', fallback='10')) * 2**20
+
+    class Handler(BaseHTTPRequestHandler):
+        def authorized(self) -> bool:
+            return hmac.compare_digest(self.headers.get('Authorization', ''), f'Bearer {token}')
+
+        def read_json(self) -> Dict[str, Any]:
+            return json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+
+        def respond_json(self, status: int, content: Optional[Dict[str, Any]]) -> None:
+            body = json.dumps(content).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            match = JOB_PATH_RE.match(self.path.split('?')[0])
+            if not self.authorized():
+                self.respond_json(401, {'error': 'unauthorized'})
+                return
+            if match is None or match.group(2) != 'archive':
+                self.respond_json(404, {'error': 'not found'})
+                return
+
+            solution_id = int(match.group(1))
+            worker_id = self.headers.get('X-Worker-Id', '')
+            if not coordinator.heartbeat(solution_id, worker_id)['renewed']:
+                self.respond_json(409, {'error': 'lease lost'})
+                return
+
+            archive_path = archive_evaluation(solution_id)
+            try:
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/zip')
+                self.send_header('Content-Length', str(archive_path.stat().st_size))
+                self.end_headers()
+                with open(archive_path, 'rb') as f:
+                    shutil.copyfileobj(f, self.wfile)
+            finally:
+                os.unlink(archive_path)
+
+        def do_POST(self):
+            if not self.authorized():
+                self.respond_json(401, {'error': 'unauthorized'})
+                return
+            match = JOB_PATH_RE.match(self.path)
+            if match is not None and match.group(2) == 'log':
+                self.receive_log(int(match.group(1)))
+                return
+            body = self.read_json()
+            worker_id = body['worker_id']
+
+            if self.path == '/jobs/claim':
+                self.respond_json(200, coordinator.claim(worker_id, body.get('wait_seconds', 0)))
+                return
+            if match is None or match.group(2) == 'archive':
+                self.respond_json(404, {'error': 'not found'})
+            elif match.group(2) == 'heartbeat':
+                self.respond_json(200, coordinator.heartbeat(int(match.group(1)), worker_id))
+            elif match.group(2) == 'progress':
+                self.respond_json(
+                    200, coordinator.progress(int(match.group(1)), worker_id, body['line'])
+                )
+            else:
+                self.respond_json(200, coordinator.result(int(match.group(1)), worker_id, body))
+
+        def receive_log(self, solution_id: int) -> None:
+            # the body is the log itself, it may take tens of megabytes
+            size = int(self.headers.get('Content-Length', 0))
+            worker_id = self.headers.get('X-Worker-Id', '')
+            if size > max_log_bytes:
+                self.respond_json(413, {'error': 'log is too large'})
+            elif not coordinator.heartbeat(solution_id, worker_id)['renewed']:
+                self.respond_json(409, {'error': 'lease lost'})
+            else:
+                store_log(solution_id, self.rfile, size)
+                self.respond_json(200, {'stored': True})
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def coordinator_process(notifications: Notifications) -> None:
+    token = CONFIG.get('coordinator', 'token', fallback='')
+    if token == '<>' or len(token) < MIN_TOKEN_LENGTH:
+        print(
+            f'Coordinator is not started: its token must be at least {MIN_TOKEN_LENGTH} '
+            + 'random characters',
+            file=sys.stderr,
+        )
+        return
+
+    coordinator = Coordinator(notifications)
+    server = ThreadingHTTPServer(
+        (
+            CONFIG.get('coordinator', 'host', fallback='0.0.0.0'),
+            int(CONFIG['coordinator']['port']),
+        ),
+        make_handler(coordinator),
+    )
+    server.daemon_threads = True
+    server.serve_forever()
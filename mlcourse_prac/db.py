@@ -1,9 +1,25 @@
+import os
 import sqlite3
+import threading
+import time
 from datetime import datetime
-from typing import Any, List, Optional, Tuple
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Set, Tuple
 
 from zoneinfo import ZoneInfo
 
+from mlcourse_prac.config import SOLUTIONS_DIR
+from mlcourse_prac.scheduler import (
+    Candidate,
+    fair_share_window_seconds,
+    runtime_history_size,
+    schedule,
+)
+
+
+BUSY_TIMEOUT_SECONDS = 30
+
+sqlite3.register_converter('DATETIME', lambda value: datetime.fromisoformat(value.decode()))
+
 
 def transaction(method):
     def wrapped(obj, *args, **kwargs):
@@ -16,37 +32,327 @@ def transaction(method):
     return wrapped
 
 
+def add_missing_columns(cursor: sqlite3.Cursor, table: str, columns: List[Tuple[str, str]]):
+    existing_columns = [row[1] for row in cursor.execute(f'PRAGMA table_info({table});')]
+    for column, column_type in columns:
+        if column not in existing_columns:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type};')
+
+
+def create_tables(cursor: sqlite3.Cursor) -> None:
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS students(
+        telegram_id INTEGER PRIMARY KEY,
+        full_name TEXT,
+        student_id INTEGER
+    );
+    """
+    )
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS solutions(
+        solution_id INTEGER PRIMARY KEY,
+        telegram_id INTEGER,
+        time_sent DATETIME,
+        status TEXT,
+        badnets_clean REAL,
+        badnets_poisoned REAL,
+        lira_clean REAL,
+        lira_poisoned REAL,
+        FOREIGN KEY(telegram_id) REFERENCES students(telegram_id)
+    );
+    """
+    )
+
+
+def add_lease_columns(cursor: sqlite3.Cursor) -> None:
+    add_missing_columns(
+        cursor,
+        'solutions',
+        [('worker_id', 'TEXT'), ('lease_expires', 'REAL'), ('heartbeat', 'REAL')],
+    )
+
+
+def create_indexes(cursor: sqlite3.Cursor) -> None:
+    cursor.execute('CREATE INDEX IF NOT EXISTS solutions_status ON solutions(status, time_sent);')
+    cursor.execute(
+        'CREATE INDEX IF NOT EXISTS solutions_student ON solutions(telegram_id, status);'
+    )
+    for task in ['badnets', 'lira']:
+        cursor.execute(
+            f"""CREATE INDEX IF NOT EXISTS solutions_{task}_score
+            ON solutions(telegram_id, {task}_poisoned);"""
+        )
+
+
+def fill_leaderboard(cursor: sqlite3.Cursor, task: str) -> None:
+    cursor.execute(
+        f"""INSERT INTO leaderboard
+        (task, telegram_id, solution_id, poisoned, clean, time_sent, solution_count)
+        WITH task_solutions AS
+        (
+            SELECT solution_id, telegram_id, time_sent, {task}_clean, {task}_poisoned
+            FROM solutions WHERE {task}_poisoned IS NOT NULL
+        ),
+        solution_ranks AS
+        (
+            SELECT solution_id,
+            ROW_NUMBER() OVER (
+                PARTITION BY telegram_id ORDER BY {task}_poisoned DESC, solution_id
+            ) AS rn
+            FROM task_solutions
+        ),
+        solution_counts AS
+        (
+            SELECT telegram_id, COUNT(*) AS solution_count FROM task_solutions
+            GROUP BY telegram_id
+        )
+        SELECT ?, task_solutions.telegram_id, task_solutions.solution_id, {task}_poisoned,
+            {task}_clean, time_sent, solution_count
+        FROM task_solutions
+            JOIN solution_ranks ON task_solutions.solution_id=solution_ranks.solution_id
+            JOIN solution_counts ON task_solutions.telegram_id=solution_counts.telegram_id
+        WHERE rn=1;""",
+        (task,),
+    )
+
+
+def create_leaderboard(cursor: sqlite3.Cursor) -> None:
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS leaderboard(
+        task TEXT,
+        telegram_id INTEGER,
+        solution_id INTEGER,
+        poisoned REAL,
+        clean REAL,
+        time_sent DATETIME,
+        solution_count INTEGER,
+        PRIMARY KEY(task, telegram_id),
+        FOREIGN KEY(telegram_id) REFERENCES students(telegram_id),
+        FOREIGN KEY(solution_id) REFERENCES solutions(solution_id)
+    );
+    """
+    )
+    cursor.execute(
+        'CREATE INDEX IF NOT EXISTS leaderboard_rank ON leaderboard(task, poisoned DESC);'
+    )
+    for task in ['badnets', 'lira']:
+        fill_leaderboard(cursor, task)
+
+
+def add_content_hash_columns(cursor: sqlite3.Cursor) -> None:
+    add_missing_columns(cursor, 'solutions', [('content_hash', 'TEXT'), ('cached_from', 'INTEGER')])
+    cursor.execute(
+        'CREATE INDEX IF NOT EXISTS solutions_content ON solutions(telegram_id, content_hash);'
+    )
+
+
+def create_metrics_tables(cursor: sqlite3.Cursor) -> None:
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS solution_metrics(
+        solution_id INTEGER,
+        name TEXT,
+        value REAL,
+        recorded_at REAL,
+        FOREIGN KEY(solution_id) REFERENCES solutions(solution_id)
+    );
+    """
+    )
+    cursor.execute(
+        'CREATE INDEX IF NOT EXISTS solution_metrics_time ON solution_metrics(recorded_at);'
+    )
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS queue_depth(
+        recorded_at REAL,
+        depth INTEGER
+    );
+    """
+    )
+    cursor.execute('CREATE INDEX IF NOT EXISTS queue_depth_time ON queue_depth(recorded_at);')
+
+
+def add_queued_at_column(cursor: sqlite3.Cursor) -> None:
+    add_missing_columns(cursor, 'solutions', [('queued_at', 'REAL')])
+    # epoch seconds, time_sent is stored in ISO format with the offset
+    cursor.execute(
+        """UPDATE solutions SET queued_at=(julianday(time_sent) - 2440587.5) * 86400
+        WHERE queued_at IS NULL;"""
+    )
+    cursor.execute(
+        """CREATE INDEX IF NOT EXISTS solution_metrics_solution
+        ON solution_metrics(solution_id, name);"""
+    )
+
+
+def create_outbox(cursor: sqlite3.Cursor) -> None:
+    # messages to students waiting for mlcourse_prac.outbox to send them
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS outbox(
+        message_id INTEGER PRIMARY KEY,
+        telegram_id INTEGER,
+        kind TEXT,
+        text TEXT,
+        queued_at REAL,
+        next_attempt REAL,
+        attempts INTEGER DEFAULT 0
+    );
+    """
+    )
+    cursor.execute('CREATE INDEX IF NOT EXISTS outbox_chat ON outbox(telegram_id, message_id);')
+
+
+def use_autoincrement_solution_ids(cursor: sqlite3.Cursor) -> None:
+    # a resubmission deletes the queued solution it replaces, and a plain INTEGER PRIMARY KEY
+    # would give its id to the next upload while the files, logs, metrics and manifest named
+    # after that id still exist. SQLite can't alter a primary key, the table is rebuilt
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(solutions);')]
+    cursor.execute(
+        """CREATE TABLE solutions_autoincrement(
+        solution_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        telegram_id INTEGER,
+        time_sent DATETIME,
+        status TEXT,
+        badnets_clean REAL,
+        badnets_poisoned REAL,
+        lira_clean REAL,
+        lira_poisoned REAL,
+        worker_id TEXT,
+        lease_expires REAL,
+        heartbeat REAL,
+        content_hash TEXT,
+        cached_from INTEGER,
+        queued_at REAL,
+        FOREIGN KEY(telegram_id) REFERENCES students(telegram_id)
+    );
+    """
+    )
+    cursor.execute(
+        f"""INSERT INTO solutions_autoincrement({', '.join(columns)})
+        SELECT {', '.join(columns)} FROM solutions;"""
+    )
+    cursor.execute('DROP TABLE solutions;')
+    cursor.execute('ALTER TABLE solutions_autoincrement RENAME TO solutions;')
+    # ids already deleted from the table may still name metrics
+    cursor.execute('DELETE FROM sqlite_sequence WHERE name=?;', ('solutions',))
+    cursor.execute(
+        """INSERT INTO sqlite_sequence(name, seq) SELECT ?, COALESCE(MAX(solution_id), 0) FROM
+        (SELECT solution_id FROM solutions UNION ALL SELECT solution_id FROM solution_metrics);""",
+        ('solutions',),
+    )
+    # the indexes are dropped with the old table
+    create_indexes(cursor)
+    add_content_hash_columns(cursor)
+
+
+def create_meta(cursor: sqlite3.Cursor) -> None:
+    # counters of the database as a whole, e.g. scores_version is bumped by the command line
+    # tools that change scores, which can't reach the notifications of the server
+    cursor.execute('CREATE TABLE IF NOT EXISTS meta(name TEXT PRIMARY KEY, value INTEGER);')
+    cursor.execute('INSERT OR IGNORE INTO meta(name, value) VALUES (?,?);', ('scores_version', 0))
+
+
+# user_version of the database is the number of migrations applied to it,
+# new migrations are only ever appended to the list
+MIGRATIONS = [
+    create_tables,
+    add_lease_columns,
+    create_indexes,
+    create_leaderboard,
+    add_content_hash_columns,
+    create_metrics_tables,
+    add_queued_at_column,
+    create_outbox,
+    use_autoincrement_solution_ids,
+    create_meta,
+]
+
+
+class StatusSnapshot(NamedTuple):
+    full_name: str
+    student_id: Optional[int]
+    unchecked_status: Optional[str]
+    cache_hits: int
+    cache_misses: int
+    # (time_sent, clean, poisoned) by (task, 'latest' or 'best')
+    top_solutions: Dict[Tuple[str, str], Optional[Tuple[datetime, float, float]]]
+
+
+class OutboxMessage(NamedTuple):
+    message_id: int
+    telegram_id: int
+    text: str
+    queued_at: float
+    attempts: int
+
+
+def status_snapshot_query() -> str:
+    columns, joins = [], []
+    for task in ['badnets', 'lira']:
+        for best_or_latest, order_by in [('latest', 'time_sent'), ('best', f'{task}_poisoned')]:
+            alias = f'{task}_{best_or_latest}'
+            columns.append(f'{alias}.time_sent, {alias}.{task}_clean, {alias}.{task}_poisoned')
+            joins.append(
+                f"""LEFT JOIN solutions AS {alias} ON {alias}.solution_id=(
+                SELECT solution_id FROM solutions WHERE telegram_id=students.telegram_id
+                AND {task}_poisoned IS NOT NULL ORDER BY {order_by} DESC LIMIT 1)"""
+            )
+    return f"""SELECT students.full_name, students.student_id,
+        (SELECT status FROM solutions WHERE telegram_id=students.telegram_id
+        AND (status='new' OR status='in_progress') LIMIT 1),
+        (SELECT COUNT(cached_from) FROM solutions WHERE telegram_id=students.telegram_id),
+        (SELECT COUNT(content_hash) - COUNT(cached_from) FROM solutions
+        WHERE telegram_id=students.telegram_id),
+        {', '.join(columns)}
+        FROM students {' '.join(joins)} WHERE students.telegram_id=?;"""
+
+
+STATUS_SNAPSHOT_QUERY = status_snapshot_query()
+
+
 class MlcourseDatabase:
     def __init__(self, db_file_path: str) -> None:
-        self.connection: sqlite3.Connection = sqlite3.connect(db_file_path, check_same_thread=False)
-        self.cursor: Optional[sqlite3.Cursor] = None
+        self.db_file_path = db_file_path
+        self._local = threading.local()
+        self._migrated_pid: Optional[int] = None
 
-        self.create_tables()
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # connections are opened lazily and never shared between threads or across fork
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.connection = self.connect()
+            self._local.pid = os.getpid()
+        return self._local.connection
 
-    @transaction
-    def create_tables(self) -> None:
-        self.cursor.execute(
-            """CREATE TABLE IF NOT EXISTS students(
-            telegram_id INTEGER PRIMARY KEY,
-            full_name TEXT,
-            student_id INTEGER
-        );
-        """
-        )
-        self.cursor.execute(
-            """CREATE TABLE IF NOT EXISTS solutions(
-            solution_id INTEGER PRIMARY KEY,
-            telegram_id INTEGER,
-            time_sent DATETIME,
-            status TEXT,
-            badnets_clean REAL,
-            badnets_poisoned REAL,
-            lira_clean REAL,
-            lira_poisoned REAL,
-            FOREIGN KEY(telegram_id) REFERENCES students(telegram_id)
-        );
-        """
+    @property
+    def cursor(self) -> Optional[sqlite3.Cursor]:
+        return getattr(self._local, 'cursor', None)
+
+    @cursor.setter
+    def cursor(self, cursor: sqlite3.Cursor) -> None:
+        self._local.cursor = cursor
+
+    def connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(
+            self.db_file_path, timeout=BUSY_TIMEOUT_SECONDS, detect_types=sqlite3.PARSE_DECLTYPES
         )
+        # readers don't block the writer in WAL mode, and NORMAL is durable enough with it
+        connection.execute('PRAGMA journal_mode=WAL;')
+        connection.execute('PRAGMA synchronous=NORMAL;')
+        if self._migrated_pid != os.getpid():
+            self.migrate(connection)
+            self._migrated_pid = os.getpid()
+        return connection
+
+    @staticmethod
+    def migrate(connection: sqlite3.Connection) -> None:
+        with connection:
+            cursor = connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE;')
+            version = cursor.execute('PRAGMA user_version;').fetchone()[0]
+            for new_version, migration in enumerate(MIGRATIONS, start=1):
+                if new_version > version:
+                    migration(cursor)
+                    cursor.execute(f'PRAGMA user_version={new_version};')
+            cursor.close()
 
     @transaction
     def set_student_full_name(self, telegram_id: int, full_name: str) -> None:
@@ -73,49 +379,300 @@ class MlcourseDatabase:
         ).fetchone()
         return row
 
-    @transaction
-    def submit_solution(self, telegram_id: int) -> None:
-        now = datetime.now(tz=ZoneInfo('Europe/Moscow'))
+    def _record_queue_depth(self) -> None:
+        self.cursor.execute(
+            """INSERT INTO queue_depth(recorded_at, depth)
+            SELECT ?, COUNT(*) FROM solutions WHERE status=?;""",
+            (time.time(), 'new'),
+        )
+
+    def _remove_new_solutions(self, telegram_id: int) -> List[int]:
+        superseded_ids = [
+            row[0]
+            for row in self.cursor.execute(
+                'SELECT solution_id FROM solutions WHERE telegram_id=? AND status=?;',
+                (telegram_id, 'new'),
+            ).fetchall()
+        ]
         self.cursor.execute(
             'DELETE FROM solutions WHERE telegram_id=? AND status=?;', (telegram_id, 'new')
         )
+        return superseded_ids
+
+    @transaction
+    def submit_solution(
+        self, telegram_id: int, content_hash: str, store_files: Callable[[int], None]
+    ) -> Tuple[int, List[int]]:
+        now = datetime.now(tz=ZoneInfo('Europe/Moscow'))
+        # a resubmission takes over the place of the upload it replaces
+        queued_at = self.cursor.execute(
+            'SELECT COALESCE(MIN(queued_at), ?) FROM solutions WHERE telegram_id=? AND status=?;',
+            (now.timestamp(), telegram_id, 'new'),
+        ).fetchone()[0]
+        superseded_ids = self._remove_new_solutions(telegram_id)
         self.cursor.execute(
-            'INSERT INTO solutions(telegram_id, time_sent, status) VALUES (?,?,?);',
-            (telegram_id, now, 'new'),
+            """INSERT INTO solutions(telegram_id, time_sent, status, content_hash, queued_at)
+            VALUES (?,?,?,?,?);""",
+            (telegram_id, now, 'new', content_hash, queued_at),
         )
+        solution_id = self.cursor.lastrowid
+        self._record_queue_depth()
+
+        # evaluators can't see the new row before commit, so its files are always in place
+        store_files(solution_id)
+        return solution_id, superseded_ids
 
     @transaction
-    def pull_oldest_new_solution(self) -> Optional[Tuple[int, datetime]]:
-        row = self.cursor.execute(
-            """SELECT solution_id, telegram_id, time_sent FROM solutions
-            WHERE status=? ORDER BY time_sent;""",
-            ('new',),
+    def submit_cached_solution(
+        self, telegram_id: int, content_hash: str
+    ) -> Optional[Tuple[int, List[int]]]:
+        # scores of the latest scored solution with the same content are reused
+        cached = self.cursor.execute(
+            """SELECT solution_id, badnets_clean, badnets_poisoned, lira_clean, lira_poisoned
+            FROM solutions WHERE telegram_id=? AND content_hash=? AND status=?
+            AND (badnets_poisoned IS NOT NULL OR lira_poisoned IS NOT NULL)
+            ORDER BY time_sent DESC LIMIT 1;""",
+            (telegram_id, content_hash, 'done'),
         ).fetchone()
-        if not row:
+        if cached is None:
             return None
 
-        solution_id, telegram_id, time_sent = row
+        cached_from, badnets_clean, badnets_poisoned, lira_clean, lira_poisoned = cached
+        now = datetime.now(tz=ZoneInfo('Europe/Moscow'))
+        superseded_ids = self._remove_new_solutions(telegram_id)
+        self.cursor.execute(
+            """INSERT INTO solutions(telegram_id, time_sent, status, content_hash, cached_from,
+            badnets_clean, badnets_poisoned, lira_clean, lira_poisoned)
+            VALUES (?,?,?,?,?,?,?,?,?);""",
+            (
+                telegram_id,
+                now,
+                'done',
+                content_hash,
+                cached_from,
+                badnets_clean,
+                badnets_poisoned,
+                lira_clean,
+                lira_poisoned,
+            ),
+        )
+        solution_id = self.cursor.lastrowid
+        if badnets_poisoned is not None:
+            self._update_leaderboard_entry('badnets', solution_id, badnets_clean, badnets_poisoned)
+        if lira_poisoned is not None:
+            self._update_leaderboard_entry('lira', solution_id, lira_clean, lira_poisoned)
+        return solution_id, superseded_ids
+
+    @transaction
+    def get_cache_stats(self, telegram_id: int) -> Tuple[int, int]:
+        hits, misses = self.cursor.execute(
+            """SELECT COUNT(cached_from), COUNT(content_hash) - COUNT(cached_from)
+            FROM solutions WHERE telegram_id=?;""",
+            (telegram_id,),
+        ).fetchone()
+        return hits, misses
+
+    @transaction
+    def pull_next_solution(
+        self, worker_id: str, lease_seconds: float
+    ) -> Optional[Tuple[int, int, float]]:
+        # solutions of students who already have one in progress are left in the queue
+        now = time.time()
+        candidates = [
+            Candidate(*row)
+            for row in self.cursor.execute(
+                """SELECT solution_id, telegram_id, queued_at,
+                (SELECT COUNT(*) FROM solutions AS runs JOIN solution_metrics
+                    ON solution_metrics.solution_id=runs.solution_id
+                    WHERE runs.telegram_id=queue.telegram_id AND name=? AND recorded_at>=?),
+                (SELECT AVG(value) FROM (SELECT value FROM solutions AS runs JOIN solution_metrics
+                    ON solution_metrics.solution_id=runs.solution_id
+                    WHERE runs.telegram_id=queue.telegram_id AND name=?
+                    ORDER BY recorded_at DESC LIMIT ?))
+                FROM solutions AS queue
+                WHERE status=? AND telegram_id NOT IN
+                    (SELECT telegram_id FROM solutions WHERE status=?);""",
+                (
+                    'stage.run',
+                    now - fair_share_window_seconds(),
+                    'stage.run',
+                    runtime_history_size(),
+                    'new',
+                    'in_progress',
+                ),
+            ).fetchall()
+        ]
+
+        # the claim is a conditional UPDATE, so concurrent workers never get the same solution
+        for candidate in schedule(candidates, now):
+            row = self.cursor.execute(
+                """UPDATE solutions SET status=?, worker_id=?, lease_expires=?, heartbeat=?
+                WHERE solution_id=? AND status=? AND telegram_id NOT IN
+                    (SELECT telegram_id FROM solutions WHERE status=?)
+                RETURNING solution_id, telegram_id, queued_at;""",
+                (
+                    'in_progress',
+                    worker_id,
+                    now + lease_seconds,
+                    now,
+                    candidate.solution_id,
+                    'new',
+                    'in_progress',
+                ),
+            ).fetchone()
+            if row is not None:
+                self._record_queue_depth()
+                return row
+        return None
+
+    @transaction
+    def renew_lease(self, solution_id: int, worker_id: str, lease_seconds: float) -> bool:
+        now = time.time()
         self.cursor.execute(
-            'UPDATE solutions SET status=? WHERE solution_id=?;', ('in_progress', solution_id)
+            """UPDATE solutions SET lease_expires=?, heartbeat=?
+            WHERE solution_id=? AND worker_id=? AND status=?;""",
+            (now + lease_seconds, now, solution_id, worker_id, 'in_progress'),
         )
-        return telegram_id, time_sent
+        return self.cursor.rowcount == 1
 
     @transaction
-    def set_badnets_scores(self, telegram_id: int, clean: float, poisoned: float) -> None:
+    def requeue_expired_leases(self) -> List[int]:
+        now = time.time()
+        # there is a newer upload of the same student in the queue already
+        failed_ids = [
+            row[0]
+            for row in self.cursor.execute(
+                """UPDATE solutions SET status=?
+                WHERE status=? AND (lease_expires IS NULL OR lease_expires<?)
+                AND telegram_id IN (SELECT telegram_id FROM solutions WHERE status=?)
+                RETURNING solution_id;""",
+                ('error', 'in_progress', now, 'new'),
+            ).fetchall()
+        ]
+        self.cursor.execute(
+            """UPDATE solutions SET status=?, worker_id=NULL, lease_expires=NULL
+            WHERE status=? AND (lease_expires IS NULL OR lease_expires<?);""",
+            ('new', 'in_progress', now),
+        )
+        return failed_ids
+
+    def _update_leaderboard_entry(
+        self, task: str, solution_id: int, clean: float, poisoned: float
+    ) -> None:
+        # the best solution is replaced only by a strictly better one, like in fill_leaderboard
         self.cursor.execute(
-            """UPDATE solutions SET badnets_clean=?, badnets_poisoned=?, status=?
-            WHERE telegram_id=? AND status=?;""",
-            (clean, poisoned, 'done', telegram_id, 'in_progress'),
+            """INSERT INTO leaderboard
+            (task, telegram_id, solution_id, poisoned, clean, time_sent, solution_count)
+            SELECT ?, telegram_id, solution_id, ?, ?, time_sent, 1
+            FROM solutions WHERE solution_id=?
+            ON CONFLICT(task, telegram_id) DO UPDATE SET
+                solution_count=solution_count+1,
+                solution_id=iif(excluded.poisoned>poisoned, excluded.solution_id, solution_id),
+                clean=iif(excluded.poisoned>poisoned, excluded.clean, clean),
+                time_sent=iif(excluded.poisoned>poisoned, excluded.time_sent, time_sent),
+                poisoned=max(excluded.poisoned, poisoned);""",
+            (task, poisoned, clean, solution_id),
         )
 
     @transaction
-    def set_lira_scores(self, telegram_id: int, clean: float, poisoned: float) -> None:
+    def set_scores(self, solution_id: int, scores: Dict[str, Tuple[float, float]]) -> None:
+        # all tasks at once: the first one used to finish the solution and lock out the second
+        for task, (clean, poisoned) in scores.items():
+            self.cursor.execute(
+                f"""UPDATE solutions SET {task}_clean=?, {task}_poisoned=?
+                WHERE solution_id=? AND status=?;""",
+                (clean, poisoned, solution_id, 'in_progress'),
+            )
+            if self.cursor.rowcount == 1:
+                self._update_leaderboard_entry(task, solution_id, clean, poisoned)
+        # a solution without Model and BackdooredModel finishes successfully without scores
         self.cursor.execute(
-            """UPDATE solutions SET lira_clean=?, lira_poisoned=?, status=?
-            WHERE telegram_id=? AND status=?;""",
-            (clean, poisoned, 'done', telegram_id, 'in_progress'),
+            'UPDATE solutions SET status=? WHERE solution_id=? AND status=?;',
+            ('done' if scores else 'error', solution_id, 'in_progress'),
         )
 
+    @transaction
+    def get_solution_owner(self, solution_id: int) -> Optional[int]:
+        row = self.cursor.execute(
+            'SELECT telegram_id FROM solutions WHERE solution_id=?;', (solution_id,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    @transaction
+    def get_evaluated_solution_ids(self, telegram_id: int, limit: int = 10) -> List[int]:
+        # from the latest one, a cached solution stands for the solution it was evaluated as
+        rows = self.cursor.execute(
+            """SELECT COALESCE(cached_from, solution_id) FROM solutions
+            WHERE telegram_id=? AND (status=? OR status=?)
+            ORDER BY solution_id DESC LIMIT ?;""",
+            (telegram_id, 'done', 'error', limit),
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    @transaction
+    def get_protected_solution_ids(self) -> Set[int]:
+        # solutions whose files must be kept: on the leaderboard, the latest of every student
+        # and everything in the queue
+        rows = self.cursor.execute(
+            """SELECT solution_id FROM leaderboard
+            UNION SELECT MAX(solution_id) FROM solutions GROUP BY telegram_id
+            UNION SELECT solution_id FROM solutions WHERE status=? OR status=?;""",
+            ('new', 'in_progress'),
+        ).fetchall()
+        return {row[0] for row in rows}
+
+    @transaction
+    def get_rescore_candidates(self, selection: str) -> List[int]:
+        # leaderboard: the best solutions, latest: the latest evaluated solution of every student
+        if selection == 'leaderboard':
+            rows = self.cursor.execute(
+                'SELECT DISTINCT solution_id FROM leaderboard ORDER BY solution_id;'
+            ).fetchall()
+        else:
+            rows = self.cursor.execute(
+                """SELECT MAX(solution_id) FROM solutions WHERE status=? OR status=?
+                GROUP BY telegram_id ORDER BY 1;""",
+                ('done', 'error'),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    @transaction
+    def get_solution_scores(self, solution_id: int) -> Dict[str, Tuple[float, float]]:
+        row = self.cursor.execute(
+            """SELECT badnets_clean, badnets_poisoned, lira_clean, lira_poisoned FROM solutions
+            WHERE solution_id=?;""",
+            (solution_id,),
+        ).fetchone()
+        if row is None:
+            return {}
+        scores = {'badnets': row[:2], 'lira': row[2:]}
+        return {task: values for task, values in scores.items() if values[1] is not None}
+
+    @transaction
+    def replace_scores(self, scores: Dict[int, Dict[str, Tuple[float, float]]]) -> None:
+        # scores of re-evaluated solutions, the leaderboard is rebuilt from scratch since
+        # a score may also go down
+        for solution_id, solution_scores in scores.items():
+            for task, (clean, poisoned) in solution_scores.items():
+                self.cursor.execute(
+                    f"""UPDATE solutions SET {task}_clean=?, {task}_poisoned=?, status=?
+                    WHERE solution_id=? AND (status=? OR status=?);""",
+                    (clean, poisoned, 'done', solution_id, 'done', 'error'),
+                )
+        self.cursor.execute('DELETE FROM leaderboard;')
+        for task in ['badnets', 'lira']:
+            fill_leaderboard(self.cursor, task)
+        self._bump_scores_version()
+
+    def _bump_scores_version(self) -> None:
+        self.cursor.execute('UPDATE meta SET value=value+1 WHERE name=?;', ('scores_version',))
+
+    @transaction
+    def get_scores_version(self) -> int:
+        return self.cursor.execute(
+            'SELECT value FROM meta WHERE name=?;', ('scores_version',)
+        ).fetchone()[0]
+
     @transaction
     def get_top_solution(
         self, telegram_id: int, task: str = 'badnets', best_or_latest: str = 'best'
@@ -131,35 +688,29 @@ class MlcourseDatabase:
     @transaction
     def get_leaderboard(self, task: str = 'badnets') -> List[Tuple[Any, ...]]:
         return self.cursor.execute(
-            f"""WITH task_solutions AS
-            (
-                SELECT solution_id, telegram_id, time_sent, {task}_clean, {task}_poisoned
-                FROM solutions WHERE {task}_poisoned IS NOT NULL
-            ),
-            solution_ranks AS
-            (
-                SELECT solution_id,
-                ROW_NUMBER() OVER (PARTITION BY telegram_id ORDER BY {task}_poisoned DESC) AS rn
-                FROM task_solutions
-            ),
-            solution_counts AS
-            (
-                SELECT telegram_id, COUNT(*) AS solution_count FROM task_solutions
-                GROUP BY telegram_id
-            )
-            SELECT full_name, student_id, {task}_poisoned, {task}_clean, time_sent, solution_count
-            FROM students
-                JOIN task_solutions ON students.telegram_id=task_solutions.telegram_id
-                JOIN solution_ranks ON task_solutions.solution_id=solution_ranks.solution_id
-                JOIN solution_counts ON students.telegram_id=solution_counts.telegram_id
-            WHERE rn=1 ORDER BY {task}_poisoned DESC;"""
+            """SELECT full_name, student_id, poisoned, clean, time_sent, solution_count
+            FROM leaderboard JOIN students ON leaderboard.telegram_id=students.telegram_id
+            WHERE task=? ORDER BY poisoned DESC;""",
+            (task,),
         ).fetchall()
 
     @transaction
-    def set_error_status(self, telegram_id: int) -> None:
+    def rebuild_leaderboard(self) -> List[Tuple[Any, ...]]:
+        # returns the entries that differ from the incrementally maintained ones
+        previous = self.cursor.execute('SELECT * FROM leaderboard;').fetchall()
+        self.cursor.execute('DELETE FROM leaderboard;')
+        for task in ['badnets', 'lira']:
+            fill_leaderboard(self.cursor, task)
+        rebuilt = self.cursor.execute('SELECT * FROM leaderboard;').fetchall()
+        if set(previous) != set(rebuilt):
+            self._bump_scores_version()
+        return sorted(set(previous) ^ set(rebuilt))
+
+    @transaction
+    def set_error_status(self, solution_id: int) -> None:
         self.cursor.execute(
-            'UPDATE solutions SET status=? WHERE telegram_id=? AND status=?;',
-            ('error', telegram_id, 'in_progress'),
+            'UPDATE solutions SET status=? WHERE solution_id=? AND status=?;',
+            ('error', solution_id, 'in_progress'),
         )
 
     @transaction
@@ -171,8 +722,103 @@ class MlcourseDatabase:
 
         return None if new_or_in_progress is None else new_or_in_progress[0]
 
+    @transaction
+    def get_status_snapshot(self, telegram_id: int) -> Optional[StatusSnapshot]:
+        # everything /status shows, in a single query
+        row = self.cursor.execute(STATUS_SNAPSHOT_QUERY, (telegram_id,)).fetchone()
+        if row is None:
+            return None
+
+        full_name, student_id, unchecked_status, cache_hits, cache_misses = row[:5]
+        top_solutions = {}
+        offset = 5
+        for task in ['badnets', 'lira']:
+            for best_or_latest in ['latest', 'best']:
+                top_solution = row[offset : offset + 3]
+                top_solutions[task, best_or_latest] = (
+                    None if top_solution[2] is None else tuple(top_solution)
+                )
+                offset += 3
+        return StatusSnapshot(
+            full_name, student_id, unchecked_status, cache_hits, cache_misses, top_solutions
+        )
+
+    @transaction
+    def record_metrics(self, solution_id: Optional[int], values: Dict[str, float]) -> None:
+        now = time.time()
+        self.cursor.executemany(
+            """INSERT INTO solution_metrics(solution_id, name, value, recorded_at)
+            VALUES (?,?,?,?);""",
+            [(solution_id, name, value, now) for name, value in values.items()],
+        )
+
+    @transaction
+    def get_metrics(self, since: float) -> List[Tuple[str, float]]:
+        return self.cursor.execute(
+            'SELECT name, value FROM solution_metrics WHERE recorded_at>=?;', (since,)
+        ).fetchall()
+
+    @transaction
+    def get_queue_depth_history(self, since: float) -> List[Tuple[float, int]]:
+        return self.cursor.execute(
+            'SELECT recorded_at, depth FROM queue_depth WHERE recorded_at>=? ORDER BY recorded_at;',
+            (since,),
+        ).fetchall()
+
+    @transaction
+    def queue_messages(
+        self, telegram_id: int, texts: List[str], kind: str, superseded_kinds: List[str]
+    ) -> None:
+        # the parts of one message are queued together, unsent messages of superseded_kinds
+        # to the same student are dropped
+        self.cursor.executemany(
+            'DELETE FROM outbox WHERE telegram_id=? AND kind=?;',
+            [(telegram_id, superseded_kind) for superseded_kind in superseded_kinds],
+        )
+        now = time.time()
+        self.cursor.executemany(
+            """INSERT INTO outbox(telegram_id, kind, text, queued_at, next_attempt)
+            VALUES (?,?,?,?,?);""",
+            [(telegram_id, kind, text, now, now) for text in texts],
+        )
+
+    @transaction
+    def get_due_messages(self, limit: int) -> List[OutboxMessage]:
+        # only the oldest message of every student, so that a retried one is not overtaken
+        rows = self.cursor.execute(
+            """SELECT message_id, telegram_id, text, queued_at, attempts FROM outbox
+            WHERE message_id IN (SELECT MIN(message_id) FROM outbox GROUP BY telegram_id)
+            AND next_attempt<=? ORDER BY message_id LIMIT ?;""",
+            (time.time(), limit),
+        ).fetchall()
+        return [OutboxMessage(*row) for row in rows]
+
+    @transaction
+    def get_next_message_attempt(self) -> Optional[float]:
+        return self.cursor.execute(
+            """SELECT MIN(next_attempt) FROM outbox
+            WHERE message_id IN (SELECT MIN(message_id) FROM outbox GROUP BY telegram_id);"""
+        ).fetchone()[0]
+
+    @transaction
+    def retry_message(self, message_id: int, delay_seconds: float) -> None:
+        self.cursor.execute(
+            'UPDATE outbox SET attempts=attempts+1, next_attempt=? WHERE message_id=?;',
+            (time.time() + delay_seconds, message_id),
+        )
+
+    @transaction
+    def remove_message(self, message_id: int, telegram_id: int, chat_interval: float) -> None:
+        # the next message to the same student waits for the per-chat rate limit
+        self.cursor.execute('DELETE FROM outbox WHERE message_id=?;', (message_id,))
+        self.cursor.execute(
+            'UPDATE outbox SET next_attempt=MAX(next_attempt, ?) WHERE telegram_id=?;',
+            (time.time() + chat_interval, telegram_id),
+        )
+
     def __del__(self) -> None:
-        self.connection.close()
+        if getattr(self._local, 'pid', None) == os.getpid():
+            self._local.connection.close()
 
 
-mlcourse_database = MlcourseDatabase(db_file_path='/solutions/solutions.db')
+mlcourse_database = MlcourseDatabase(db_file_path=str(SOLUTIONS_DIR / 'solutions.db'))
@@ -1,96 +1,327 @@
+import multiprocessing as mp
 import os
+import queue
+import sys
+import time
+import traceback
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Any, Iterable
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
+import numpy as np
 import torch
-from torch.utils.data import DataLoader
-from torchvision import transforms
-from torchvision.datasets import ImageFolder
 
-from mlcourse_prac.config import CONFIG
-from mlcourse_prac.db import mlcourse_database
+from mlcourse_prac.config import CONFIG, DATA_DIR
+from mlcourse_prac.inference import (
+    batch_size,
+    configure_threads,
+    evaluation_device,
+    evaluation_option,
+    gpu_usage,
+    predict,
+    prepare_batch,
+)
+from mlcourse_prac.metrics import JOB_STARTED_VARIABLE, Metrics
+from mlcourse_prac.progress import Progress
+from mlcourse_prac.report import update_report
+from mlcourse_prac.test_cache import load_test_subset, normalize_batch, test_subset_dirs
 
-DATA_DIR = Path('/data')
 
+class SolutionError(Exception):
+    # the message is sent to the student as is
+    pass
+
+
+@contextmanager
+def evaluation_stage(name: str, metrics: Metrics, progress: Progress) -> Iterator[None]:
+    progress.set_stage(name)
+    with metrics.stage(name):
+        yield
 
-def test_batches(test_subset_dir: Path) -> Iterable[torch.Tensor]:
-    normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-    transform = transforms.Compose(
-        [
-            transforms.Resize(256),
-            transforms.CenterCrop(224),
-            transforms.ToTensor(),
-            normalize,
-        ]
-    )
-    dataset = ImageFolder(test_subset_dir, transform)
-    loader = DataLoader(
-        dataset,
-        batch_size=int(CONFIG['evaluation']['batch_size']),
-        shuffle=False,
-        num_workers=int(CONFIG['evaluation']['dataloader_num_workers']),
-        pin_memory=True,
-    )
 
-    for images, labels in loader:
-        yield images.cuda(), labels.cuda()
+def test_batches(
+    images: np.ndarray, labels: np.ndarray
+) -> Iterable[Tuple[torch.Tensor, torch.Tensor]]:
+    size = batch_size()
+    device = evaluation_device()
 
+    for start in range(0, len(labels), size):
+        batch_images = torch.from_numpy(np.array(images[start : start + size]))
+        batch_labels = torch.from_numpy(labels[start : start + size])
+        yield prepare_batch(normalize_batch(batch_images.to(device))), batch_labels.to(device)
 
-def compute_accuracy(model, test_subset_dir: Path) -> float:
+
+def compute_accuracy(
+    model, test_subset_dir: Path, progress: Optional[Progress] = None, subset: str = ''
+) -> float:
+    images, labels = load_test_subset(test_subset_dir)
     total, correct = 0, 0
 
-    for images, labels in test_batches(test_subset_dir):
-        predictions = model.predict(images).argmax(axis=1)
-        total += len(labels)
-        correct += torch.sum(predictions == labels).item()
+    for batch_images, batch_labels in test_batches(images, labels):
+        predictions = predict(model, batch_images)
+        check_predictions(predictions, batch_images)
+        predictions = predictions.argmax(axis=1)
+        total += len(batch_labels)
+        correct += torch.sum(predictions == batch_labels).item()
+        if progress is not None:
+            progress.update(subset, total, len(labels), correct)
 
     return correct / total
 
 
-def evaluate_badnets(telegram_id: int, model: Any) -> None:
-    model.train()
+def cpu_shards() -> int:
+    # forked processes share the trained model copy-on-write, which is impossible with CUDA
+    if evaluation_device().type != 'cpu':
+        return 1
+    return int(CONFIG.get('evaluation', 'cpu_shards', fallback='1'))
+
+
+def split_batches(subsets: Dict[str, Path], shards: int) -> List[List[Tuple[str, int, int]]]:
+    # contiguous runs of whole batches, so that predict sees exactly the batches
+    # of the sequential evaluation and the counts add up to the same accuracies
+    size = batch_size()
+    batches = []
+    for subset, test_subset_dir in subsets.items():
+        _, labels = load_test_subset(test_subset_dir)
+        batches += [(subset, start) for start in range(0, len(labels), size)]
+
+    work = []
+    for shard in range(shards):
+        shard_batches = batches[
+            len(batches) * shard // shards : len(batches) * (shard + 1) // shards
+        ]
+        ranges: List[Tuple[str, int, int]] = []
+        for subset, start in shard_batches:
+            if ranges and ranges[-1][0] == subset:
+                ranges[-1] = (subset, ranges[-1][1], start + size)
+            else:
+                ranges.append((subset, start, start + size))
+        work.append(ranges)
+    return work
+
+
+def evaluate_shard(
+    model, subsets: Dict[str, Path], ranges: List[Tuple[str, int, int]], results: mp.Queue
+) -> None:
+    # runs in a forked process, reports (subset, images, correct) after every batch
+    # and ('error', ...) when it fails
+    try:
+        threads = int(evaluation_option('cpu_threads', '0')) or os.cpu_count()
+        torch.set_num_threads(max(threads // cpu_shards(), 1))
+        for subset, start, stop in ranges:
+            images, labels = load_test_subset(subsets[subset])
+            for batch_images, batch_labels in test_batches(images[start:stop], labels[start:stop]):
+                predictions = predict(model, batch_images)
+                check_predictions(predictions, batch_images)
+                correct = torch.sum(predictions.argmax(axis=1) == batch_labels).item()
+                results.put((subset, len(batch_labels), correct))
+        results.put(None)
+    except SolutionError as e:
+        # the parent raises the same message as the sequential evaluation
+        results.put(('error', None, str(e)))
+    except BaseException:
+        results.put(('error', traceback.format_exc(), None))
+
+
+def compute_accuracies(
+    model, subsets: Dict[str, Path], progress: Progress, prefix: str
+) -> Dict[str, float]:
+    # the subsets are evaluated concurrently, every shard process takes a part of the batches
+    context = mp.get_context('fork')
+    results = context.Queue()
+    processes = [
+        context.Process(target=evaluate_shard, args=(model, subsets, ranges, results))
+        for ranges in split_batches(subsets, cpu_shards())
+    ]
+    for process in processes:
+        process.start()
+
+    sizes = {subset: len(load_test_subset(path)[1]) for subset, path in subsets.items()}
+    counts = {subset: [0, 0] for subset in subsets}
+    running = len(processes)
+    try:
+        while running > 0:
+            try:
+                message = results.get(timeout=1)
+            except queue.Empty:
+                if not any(process.is_alive() for process in processes):
+                    raise SolutionError(
+                        'Процесс проверки аварийно завершился во время model.predict.'
+                    )
+                continue
+            if message is None:
+                running -= 1
+                continue
+
+            subset, total, correct = message
+            if subset == 'error':
+                # (error, traceback, None) or (error, None, message of a SolutionError)
+                if correct is not None:
+                    raise SolutionError(correct)
+                print(total, file=sys.stderr)
+                raise SolutionError('model.predict завершился ошибкой, см. stderr.')
+            counts[subset][0] += total
+            counts[subset][1] += correct
+            progress.update(
+                f'{prefix}.{subset}', counts[subset][0], sizes[subset], counts[subset][1]
+            )
+    finally:
+        for process in processes:
+            process.kill()
+            process.join()
+
+    return {subset: correct / total for subset, (total, correct) in counts.items()}
+
 
+def test_accuracies(
+    model, test_dir: Path, task: str, metrics: Metrics, progress: Progress
+) -> Tuple[float, float]:
+    if cpu_shards() > 1:
+        with evaluation_stage(f'{task}.test', metrics, progress):
+            accuracies = compute_accuracies(
+                model,
+                {'clean': test_dir / 'clean', 'poisoned': test_dir / 'poisoned'},
+                progress,
+                task,
+            )
+        return accuracies['clean'], accuracies['poisoned']
+
+    with evaluation_stage(f'{task}.clean', metrics, progress):
+        clean_accuracy = compute_accuracy(model, test_dir / 'clean', progress, f'{task}.clean')
+    with evaluation_stage(f'{task}.poisoned', metrics, progress):
+        poisoned_accuracy = compute_accuracy(
+            model, test_dir / 'poisoned', progress, f'{task}.poisoned'
+        )
+    return clean_accuracy, poisoned_accuracy
+
+
+def check_predictions(predictions: Any, batch_images: torch.Tensor) -> None:
+    if (
+        not isinstance(predictions, torch.Tensor)
+        or predictions.ndim != 2
+        or len(predictions) != len(batch_images)
+    ):
+        shape = tuple(predictions.shape) if hasattr(predictions, 'shape') else None
+        raise SolutionError(
+            'model.predict должен возвращать тензор размера (число картинок, число '
+            + f'классов), а вернул {type(predictions).__name__} размера {shape} '
+            + f'для {len(batch_images)} картинок.'
+        )
+    if predictions.device != batch_images.device:
+        raise SolutionError(
+            f'model.predict вернул тензор на {predictions.device}, '
+            + f'а картинки были на {batch_images.device}.'
+        )
+
+
+def smoke_test(model, test_dir: Path) -> None:
+    # a few batches of every subset right after the training, so that a broken predict fails
+    # with a clear message before the test processes are forked; the model may be built
+    # by train, nothing is predicted before it
+    smoke_batches = int(CONFIG.get('evaluation', 'smoke_batches', fallback='2'))
+    for subset in ['clean', 'poisoned']:
+        images, labels = load_test_subset(test_dir / subset)
+        for batch_index, (batch_images, _) in enumerate(test_batches(images, labels)):
+            if batch_index == smoke_batches:
+                break
+            try:
+                predictions = predict(model, batch_images)
+            except Exception:
+                traceback.print_exc()
+                raise SolutionError('model.predict завершился ошибкой на пробных картинках.')
+            check_predictions(predictions, batch_images)
+
+
+def evaluate_badnets(
+    evaluation_dir: Path, model: Any, metrics: Metrics, progress: Progress
+) -> None:
     test_dir = DATA_DIR / CONFIG['badnets']['test_dir']
-    clean_accuracy = compute_accuracy(model, test_dir / 'clean')
-    poisoned_accuracy = compute_accuracy(model, test_dir / 'poisoned')
+    with evaluation_stage('badnets.train', metrics, progress):
+        model.train()
+
+    with evaluation_stage('badnets.smoke', metrics, progress):
+        smoke_test(model, test_dir)
+
+    clean_accuracy, poisoned_accuracy = test_accuracies(
+        model, test_dir, 'badnets', metrics, progress
+    )
 
-    mlcourse_database.set_badnets_scores(telegram_id, clean_accuracy, poisoned_accuracy)
+    with metrics.stage('badnets.report'):
+        update_report(evaluation_dir, scores={'badnets': [clean_accuracy, poisoned_accuracy]})
 
 
 def load_backdoored_net(path: str) -> torch.nn.Module:
     raise NotImplementedError('Проверка второй части задания пока недоступна.')
 
 
-def evaluate_lira(telegram_id: int, model: Any) -> None:
-    model.prepare()
-
+def evaluate_lira(evaluation_dir: Path, model: Any, metrics: Metrics, progress: Progress) -> None:
     test_dir = DATA_DIR / CONFIG['lira']['test_dir']
-    clean_accuracy = compute_accuracy(model, test_dir / 'clean')
-    poisoned_accuracy = compute_accuracy(model, test_dir / 'poisoned')
+    with evaluation_stage('lira.prepare', metrics, progress):
+        model.prepare()
 
-    mlcourse_database.set_lira_scores(telegram_id, clean_accuracy, poisoned_accuracy)
+    # never sharded and never smoke-tested: predict may gather statistics over the test
+    # batches in their order, compute_accuracy checks the predictions of every batch instead
+    with evaluation_stage('lira.clean', metrics, progress):
+        clean_accuracy = compute_accuracy(model, test_dir / 'clean', progress, 'lira.clean')
+    with evaluation_stage('lira.poisoned', metrics, progress):
+        poisoned_accuracy = compute_accuracy(
+            model, test_dir / 'poisoned', progress, 'lira.poisoned'
+        )
 
+    with metrics.stage('lira.report'):
+        update_report(evaluation_dir, scores={'lira': [clean_accuracy, poisoned_accuracy]})
 
-def main():
-    import sys
 
+def preload() -> None:
+    # everything that doesn't depend on the solution, done by warm evaluators before the job
+    configure_threads()
+    device = evaluation_device()
+    if device.type == 'cuda':
+        # creates the CUDA context
+        torch.empty(1, device=device)
+    for test_subset_dir in test_subset_dirs():
+        images, labels = load_test_subset(test_subset_dir)
+        next(iter(test_batches(images, labels)))
+
+
+def main():
+    configure_threads()
     sys.path.append(os.getcwd())
 
-    telegram_id = int(Path(os.getcwd()).name)
+    evaluation_dir = Path(os.getcwd())
+    metrics = Metrics(report_dir=evaluation_dir)
+    progress = Progress(evaluation_dir, gpu_usage)
+    progress.write_periodically()
+
+    if JOB_STARTED_VARIABLE in os.environ:
+        # from the handover to the evaluator up to the first line of the solution
+        metrics.add('startup_overhead', time.time() - float(os.environ[JOB_STARTED_VARIABLE]))
 
     try:
-        from solution import Model
+        try:
+            from solution import Model
 
-        model = Model(DATA_DIR / CONFIG['badnets']['train_dir'])
-        evaluate_badnets(telegram_id, model)
-    except ImportError:
-        pass
+            with evaluation_stage('badnets.model_init', metrics, progress):
+                model = Model(DATA_DIR / CONFIG['badnets']['train_dir'])
+            evaluate_badnets(evaluation_dir, model, metrics, progress)
+        except ImportError:
+            pass
+
+        try:
+            from solution import BackdooredModel
+
+            net = load_backdoored_net(DATA_DIR / CONFIG['lira']['model_path'])
+            with evaluation_stage('lira.model_init', metrics, progress):
+                backdoored_model = BackdooredModel(net, DATA_DIR / CONFIG['lira']['clean_dir'])
+            evaluate_lira(evaluation_dir, backdoored_model, metrics, progress)
+        except ImportError:
+            pass
+    except SolutionError as e:
+        print(str(e), file=sys.stderr)
+        sys.exit(1)
+    finally:
+        metrics.save()
 
-    try:
-        from solution import BackdooredModel
 
-        net = load_backdoored_net(DATA_DIR / CONFIG['lira']['model_path'])
-        backdoored_model = BackdooredModel(net, DATA_DIR / CONFIG['lira']['clean_dir'])
-        evaluate_lira(telegram_id, backdoored_model)
-    except ImportError:
-        pass
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+import functools
+import hashlib
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import mlcourse_prac
+from mlcourse_prac.config import CONFIG, DATA_DIR
+from mlcourse_prac.venv_cache import normalize_requirements
+
+# files that can't influence the evaluation result
+IGNORED_DIRS = {'__MACOSX', '__pycache__', '.git', '.ipynb_checkpoints', '.idea', '.vscode'}
+IGNORED_SUFFIXES = {'.pyc', '.md', '.ipynb'}
+IGNORED_NAMES = {'.DS_Store', 'Thumbs.db', '.gitignore'}
+
+# modules of mlcourse-evaluate and the options of the evaluation section that change scores
+EVALUATOR_MODULES = ['evaluate.py', 'inference.py', 'test_cache.py']
+INFERENCE_OPTIONS = [
+    'device',
+    'batch_size',
+    'max_batch_size',
+    'memory_per_image_mb',
+    'inference_mode',
+    'channels_last',
+    'bfloat16',
+    'cpu_shards',
+]
+
+
+def directory_fingerprint(directory: Path) -> str:
+    digest = hashlib.sha256()
+    for path in sorted(path for path in directory.rglob('*') if path.is_file()):
+        stat = path.stat()
+        relative_path = path.relative_to(directory).as_posix()
+        digest.update(f'{relative_path}\0{stat.st_size}\0{stat.st_mtime_ns}\n'.encode())
+    return digest.hexdigest()
+
+
+def data_paths() -> List[Tuple[str, Path]]:
+    # the training data and the backdoored model influence the scores as much as the test data
+    return [
+        (f'{section}.{key}', DATA_DIR / CONFIG[section][key])
+        for section, key in [
+            ('badnets', 'train_dir'),
+            ('badnets', 'test_dir'),
+            ('lira', 'clean_dir'),
+            ('lira', 'test_dir'),
+            ('lira', 'model_path'),
+        ]
+    ]
+
+
+def data_fingerprint() -> str:
+    # the trees are walked again only when the modification time of one of the paths changes,
+    # i.e. a file is added, removed or renamed right in it. Files edited in place or changes
+    # in nested directories are noticed after a restart of the server
+    mtimes = []
+    for _, path in data_paths():
+        try:
+            mtimes.append(path.stat().st_mtime_ns)
+        except FileNotFoundError:
+            mtimes.append(None)
+    return walk_data(tuple(mtimes))
+
+
+@functools.lru_cache(maxsize=1)
+def walk_data(mtimes: Tuple[Optional[int], ...]) -> str:
+    digest = hashlib.sha256()
+    for name, path in data_paths():
+        if path.is_dir():
+            fingerprint = directory_fingerprint(path)
+        elif path.is_file():
+            fingerprint = f'{path.stat().st_size}\0{path.stat().st_mtime_ns}'
+        else:
+            fingerprint = 'missing'
+        digest.update(f'{name}\0{fingerprint}\n'.encode())
+    return digest.hexdigest()
+
+
+def evaluator_fingerprint() -> str:
+    # the code and the inference settings the scores are computed with
+    digest = hashlib.sha256(f'{mlcourse_prac.__version__}\n'.encode())
+    for module in EVALUATOR_MODULES:
+        module_hash = hashlib.sha256((Path(__file__).parent / module).read_bytes()).hexdigest()
+        digest.update(f'{module}\0{module_hash}\n'.encode())
+    for key in INFERENCE_OPTIONS:
+        value = CONFIG.get('evaluation', key, fallback='')
+        digest.update(f'{key}\0{value}\n'.encode())
+    return digest.hexdigest()
+
+
+def is_ignored(relative_path: Path) -> bool:
+    return (
+        any(part in IGNORED_DIRS for part in relative_path.parts[:-1])
+        or relative_path.suffix in IGNORED_SUFFIXES
+        or relative_path.name in IGNORED_NAMES
+    )
+
+
+def submission_fingerprint(submission_dir: Path) -> str:
+    digest = hashlib.sha256()
+    digest.update(f'evaluator {evaluator_fingerprint()}\n'.encode())
+    digest.update(f'data {data_fingerprint()}\n'.encode())
+
+    for path in sorted(submission_dir.rglob('*')):
+        relative_path = path.relative_to(submission_dir)
+        if not path.is_file() or is_ignored(relative_path):
+            continue
+
+        content = path.read_bytes()
+        if relative_path == Path('requirements.txt'):
+            requirements = normalize_requirements(content.decode(errors='replace'))
+            if requirements is not None:
+                content = '\n'.join(requirements).encode()
+        digest.update(f'{relative_path.as_posix()}\0{len(content)}\0'.encode())
+        digest.update(content)
+    return digest.hexdigest()
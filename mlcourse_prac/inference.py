@@ -0,0 +1,89 @@
+import functools
+import os
+from contextlib import ExitStack
+from typing import Any, Dict
+
+import torch
+
+from mlcourse_prac.config import CONFIG
+
+# the student's predict has to fit next to the model, which is not counted here
+AUTOTUNE_MEMORY_FRACTION = 0.5
+
+
+def evaluation_option(key: str, fallback: str) -> str:
+    return CONFIG.get('evaluation', key, fallback=fallback)
+
+
+def evaluation_flag(key: str) -> bool:
+    return CONFIG.getboolean('evaluation', key, fallback=False)
+
+
+@functools.lru_cache(maxsize=None)
+def evaluation_device() -> torch.device:
+    # auto lets the same config run on GPU machines and on CPU-only overflow nodes
+    device = evaluation_option('device', 'cuda')
+    if device == 'auto':
+        return torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    return torch.device(device)
+
+
+@functools.lru_cache(maxsize=None)
+def configure_threads() -> None:
+    # once per process: inter-op threads can't be changed after the first parallel operation
+    threads = int(evaluation_option('cpu_threads', '0'))
+    interop_threads = int(evaluation_option('cpu_interop_threads', '0'))
+    if threads > 0:
+        torch.set_num_threads(threads)
+    if interop_threads > 0:
+        torch.set_num_interop_threads(interop_threads)
+
+
+def available_memory() -> int:
+    if evaluation_device().type == 'cuda':
+        free, _ = torch.cuda.mem_get_info(evaluation_device())
+        return free
+
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) * 1024
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+
+
+@functools.lru_cache(maxsize=None)
+def batch_size() -> int:
+    configured = evaluation_option('batch_size', '64')
+    if configured != 'auto':
+        return int(configured)
+
+    # powers of two, so that the same machine always gives the solutions the same batches
+    max_batch_size = int(evaluation_option('max_batch_size', '256'))
+    image_bytes = float(evaluation_option('memory_per_image_mb', '32')) * 2**20
+    budget = available_memory() * AUTOTUNE_MEMORY_FRACTION
+    size = 1
+    while size * 2 <= max_batch_size and size * 2 * image_bytes <= budget:
+        size *= 2
+    return size
+
+
+def prepare_batch(images: torch.Tensor) -> torch.Tensor:
+    if evaluation_flag('channels_last'):
+        return images.contiguous(memory_format=torch.channels_last)
+    return images
+
+
+def predict(model: Any, images: torch.Tensor) -> Any:
+    # every call of the student's predict goes through here, the smoke test included
+    with ExitStack() as stack:
+        if evaluation_flag('inference_mode'):
+            stack.enter_context(torch.inference_mode())
+        if evaluation_flag('bfloat16'):
+            stack.enter_context(torch.autocast(evaluation_device().type, dtype=torch.bfloat16))
+        return model.predict(images)
+
+
+def gpu_usage() -> Dict[str, float]:
+    if evaluation_device().type != 'cuda':
+        return {}
+    return {'peak_gpu_memory_mb': torch.cuda.max_memory_reserved(evaluation_device()) / 2**20}
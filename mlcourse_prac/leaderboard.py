@@ -1,29 +1,75 @@
 import base64
+import hashlib
+import sys
+import time
+from functools import lru_cache
 from pathlib import Path
+from typing import Callable, Optional
 
 import requests
+from requests.adapters import HTTPAdapter
 from tabulate import tabulate
+from urllib3.util.retry import Retry
 
 from mlcourse_prac.config import CONFIG
 from mlcourse_prac.db import mlcourse_database
+from mlcourse_prac.metrics import Metrics
+from mlcourse_prac.notifications import Notifications
 
+SCORES_VERSION_CHECK_SECONDS = 60
 
-def wordpress_request(leaderboard_html: str) -> None:
-    username = CONFIG['wordpress']['username']
-    password = CONFIG['wordpress']['password']
-    page_id = CONFIG['wordpress']['page_id']
+TASK_TITLES = {
+    'badnets': 'Первая часть задания',
+    'lira': 'Вторая часть задания',
+}
 
-    url = 'https://mlcourse.at.ispras.ru/wp-json/wp/v2/pages/' + page_id
-    token = base64.b64encode(f'{username}:{password}'.encode()).decode()
-    header = {'Authorization': 'Basic ' + token}
-    payload = {'content': leaderboard_html}
 
-    requests.post(url, headers=header, json=payload)
+class WordpressPublisher:
+    def __init__(self) -> None:
+        username = CONFIG['wordpress']['username']
+        password = CONFIG['wordpress']['password']
+        base_url = CONFIG.get(
+            'wordpress', 'url', fallback='https://mlcourse.at.ispras.ru/wp-json/wp/v2/pages/'
+        )
+        self.url = base_url + CONFIG['wordpress']['page_id']
+        self.timeout = float(CONFIG.get('wordpress', 'request_timeout_seconds', fallback='30'))
+        self.last_published_hash: Optional[str] = None
+
+        token = base64.b64encode(f'{username}:{password}'.encode()).decode()
+        retry = Retry(
+            total=int(CONFIG.get('wordpress', 'max_retries', fallback='5')),
+            backoff_factor=1,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=None,
+        )
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = 'Basic ' + token
+        self.session.mount('http://', HTTPAdapter(max_retries=retry))
+        self.session.mount('https://', HTTPAdapter(max_retries=retry))
 
+    def publish(self, leaderboard_html: str) -> bool:
+        # returns False if the page already has this content and nothing was sent
+        html_hash = hashlib.sha256(leaderboard_html.encode()).hexdigest()
+        if html_hash == self.last_published_hash:
+            return False
+
+        response = self.session.post(
+            self.url, json={'content': leaderboard_html}, timeout=self.timeout
+        )
+        response.raise_for_status()
+        self.last_published_hash = html_hash
+        return True
 
-def update_leaderboard() -> None:
-    # FIXME: only 'badnets' leaderboard is generated for now
-    leaderboard = mlcourse_database.get_leaderboard()
+
+@lru_cache(maxsize=None)
+def leaderboard_style() -> str:
+    style_path = Path(__file__).resolve().parent / 'style.css'
+    with style_path.open() as f:
+        return '<style>' + f.read() + '</style>'
+
+
+def render_leaderboard_table(task: str) -> str:
+    leaderboard = mlcourse_database.get_leaderboard(task)
 
     headers = [
         'Место',
@@ -49,16 +95,68 @@ def update_leaderboard() -> None:
                 count,
             ]
         )
-    table = tabulate(tabular_data, headers=headers, tablefmt='html', stralign='center')
+    return tabulate(tabular_data, headers=headers, tablefmt='html', stralign='center')
 
-    paragraph = (
-        '<!-- wp:paragraph --><p>Выводятся результаты лучшего решения!</p><!-- /wp:paragraph -->'
-    )
+
+def render_leaderboard() -> str:
+    html = '<!-- wp:paragraph --><p>Выводятся результаты лучшего решения!</p><!-- /wp:paragraph -->'
     block_start = '<!-- wp:code --><pre class="wp-block-code"><code>'
-    style_path = Path(__file__).resolve().parent / 'style.css'
-    with style_path.open() as f:
-        style = '<style>' + f.read() + '</style>'
     block_end = '</code></pre><!-- /wp:code -->'
-    html = paragraph + block_start + style + table + block_end
+    style = leaderboard_style()
+    for task, title in TASK_TITLES.items():
+        html += f'<!-- wp:heading --><h2>{title}</h2><!-- /wp:heading -->'
+        html += block_start + style + render_leaderboard_table(task) + block_end
+        # the style applies to the whole page, it is enough to include it once
+        style = ''
+    return html
+
+
+def run_publisher(
+    changed, render: Callable[[], str], publisher: WordpressPublisher, debounce_seconds: float
+) -> None:
+    published_version = None
+    while True:
+        # mlcourse-rescore can't set changed, it bumps the scores version in the database
+        if not changed.wait(SCORES_VERSION_CHECK_SECONDS):
+            try:
+                if mlcourse_database.get_scores_version() == published_version:
+                    continue
+            except Exception as e:
+                print(f'Checking the scores version failed: {e}', file=sys.stderr)
+                continue
+        # every change made during the debounce window ends up in a single request
+        time.sleep(debounce_seconds)
+        changed.clear()
+
+        metrics = Metrics()
+        try:
+            with metrics.stage('publish.render'):
+                scores_version = mlcourse_database.get_scores_version()
+                html = render()
+            with metrics.stage('publish.post'):
+                metrics.add('publish.sent' if publisher.publish(html) else 'publish.unchanged')
+            published_version = scores_version
+        except Exception as e:
+            print(f'Leaderboard publishing failed, will retry: {e}', file=sys.stderr)
+            metrics.add('publish.failed')
+            changed.set()
+        metrics.save()
+
+
+def publisher_process(notifications: Notifications):
+    # publish once on start since the page may be stale after a restart
+    notifications.leaderboard_changed.set()
+    run_publisher(
+        notifications.leaderboard_changed,
+        render_leaderboard,
+        WordpressPublisher(),
+        float(CONFIG['wordpress']['publish_debounce_seconds']),
+    )
+
 
-    wordpress_request(html)
+def rebuild_main():
+    mismatches = mlcourse_database.rebuild_leaderboard()
+    for row in mismatches:
+        print(*row, sep='\t')
+    print(f'Leaderboard rebuilt, {len(mismatches)} rows differed from the maintained ones')
+    sys.exit(1 if mismatches else 0)
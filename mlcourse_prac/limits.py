@@ -0,0 +1,163 @@
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from mlcourse_prac.config import CONFIG
+
+PAGE_SIZE_KB = os.sysconf('SC_PAGE_SIZE') // 1024
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+CPU_PERIOD_MICROSECONDS = 100000
+CGROUP_REMOVAL_ATTEMPTS = 10
+
+
+def session_usage(session_id: int) -> Tuple[float, int, float]:
+    # memory in MB, number of processes and CPU seconds of a whole session: evaluations run
+    # in their own session, so this covers bash, pip and every python process
+    total_kb, processes, total_ticks = 0, 0, 0
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                # the command name may contain spaces, the fields after it don't
+                fields = f.read().rsplit(')', 1)[1].split()
+            if int(fields[3]) != session_id:
+                continue
+            memory_kb = proportional_memory_kb(pid)
+        except OSError:
+            continue
+        total_kb += memory_kb if memory_kb is not None else int(fields[21]) * PAGE_SIZE_KB
+        processes += 1
+        # utime, stime and the same for the waited children
+        total_ticks += sum(int(field) for field in fields[11:15])
+    return total_kb / 1024, processes, total_ticks / CLOCK_TICKS
+
+
+def proportional_memory_kb(pid: str) -> Optional[int]:
+    # PSS splits the pages shared between processes, e.g. the forked shards of the first part,
+    # among them; summing RSS would count them once per process. None before Linux 4.14
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1])
+    except FileNotFoundError:
+        return None
+    return None
+
+
+def read_keyed_file(path: Path) -> Dict[str, int]:
+    # memory.events, cpu.stat and the like
+    try:
+        return {key: int(value) for key, value in (line.split() for line in path.open())}
+    except (OSError, ValueError):
+        return {}
+
+
+class RunResources:
+    # limits and usage of one evaluation run. With a delegated cgroup v2 subtree the kernel
+    # enforces the limits, otherwise memory and processes are checked every sample
+    def __init__(self, name: str) -> None:
+        self.memory_limit_mb = (
+            float(CONFIG.get('evaluation', 'memory_limit_gb', fallback='0')) * 1024
+        )
+        self.cpu_limit = float(CONFIG.get('evaluation', 'cpu_limit', fallback='0'))
+        self.max_processes = int(CONFIG.get('evaluation', 'max_processes', fallback='0'))
+        self.usage: Dict[str, float] = {'peak_rss_mb': 0.0, 'cpu_seconds': 0.0}
+        self.cgroup = self.create_cgroup(name)
+
+    def create_cgroup(self, name: str) -> Optional[Path]:
+        root = Path(CONFIG.get('evaluation', 'cgroup_root', fallback='/sys/fs/cgroup/mlcourse'))
+        if not (root / 'cgroup.controllers').exists():
+            return None
+
+        cgroup = root / name
+        try:
+            # the controllers have to be enabled for the children of the root
+            (root / 'cgroup.subtree_control').write_text('+memory +cpu +pids')
+            cgroup.mkdir(exist_ok=True)
+            if self.memory_limit_mb > 0:
+                (cgroup / 'memory.max').write_text(str(int(self.memory_limit_mb * 2**20)))
+                (cgroup / 'memory.swap.max').write_text('0')
+            if self.cpu_limit > 0:
+                quota = int(self.cpu_limit * CPU_PERIOD_MICROSECONDS)
+                (cgroup / 'cpu.max').write_text(f'{quota} {CPU_PERIOD_MICROSECONDS}')
+            if self.max_processes > 0:
+                (cgroup / 'pids.max').write_text(str(self.max_processes))
+        except OSError as e:
+            print(f'cgroup {cgroup} is unavailable, limits are checked by sampling: {e}')
+            shutil.rmtree(cgroup, ignore_errors=True)
+            return None
+        return cgroup
+
+    def attach(self, pid: int) -> None:
+        if self.cgroup is not None:
+            (self.cgroup / 'cgroup.procs').write_text(str(pid))
+
+    def sample(self, session_id: int) -> Optional[str]:
+        # returns the description of the exceeded limit, None if everything is within limits
+        rss_mb, processes, cpu_seconds = session_usage(session_id)
+        self.usage['peak_rss_mb'] = max(self.usage['peak_rss_mb'], rss_mb)
+        self.usage['cpu_seconds'] = max(self.usage['cpu_seconds'], cpu_seconds)
+        if self.cgroup is not None:
+            return None
+
+        if 0 < self.memory_limit_mb < rss_mb:
+            return self.memory_limit_description()
+        if 0 < self.max_processes < processes:
+            return f'лимит числа процессов {self.max_processes}'
+        return None
+
+    def memory_limit_description(self) -> str:
+        return f'лимит памяти {self.memory_limit_mb:.0f} MB'
+
+    def kill(self) -> None:
+        # also gets the processes that have left the session
+        if self.cgroup is not None:
+            try:
+                (self.cgroup / 'cgroup.kill').write_text('1')
+            except OSError:
+                pass
+
+    def finish(self) -> Optional[str]:
+        # final usage from the cgroup, returns the description of a limit the kernel has enforced
+        if self.cgroup is None:
+            return None
+
+        exceeded = None
+        if read_keyed_file(self.cgroup / 'memory.events').get('oom_kill', 0) > 0:
+            exceeded = self.memory_limit_description()
+        elif read_keyed_file(self.cgroup / 'pids.events').get('max', 0) > 0:
+            exceeded = f'лимит числа процессов {self.max_processes}'
+
+        cpu_microseconds = read_keyed_file(self.cgroup / 'cpu.stat').get('usage_usec')
+        if cpu_microseconds is not None:
+            self.usage['cpu_seconds'] = cpu_microseconds / 10**6
+        try:
+            peak_bytes = int((self.cgroup / 'memory.peak').read_text())
+            self.usage['peak_rss_mb'] = max(self.usage['peak_rss_mb'], peak_bytes / 2**20)
+        except (OSError, ValueError):
+            # memory.peak appeared in Linux 5.19
+            pass
+
+        self.kill()
+        for _ in range(CGROUP_REMOVAL_ATTEMPTS):
+            try:
+                self.cgroup.rmdir()
+                break
+            except OSError:
+                # the killed processes are still exiting
+                time.sleep(0.1)
+        return exceeded
+
+
+def describe_usage(usage: Dict[str, float]) -> str:
+    result = (
+        f'Использовано: память до {usage.get("peak_rss_mb", 0):.0f} MB, '
+        + f'процессорное время {usage.get("cpu_seconds", 0):.0f} с'
+    )
+    if 'peak_gpu_memory_mb' in usage:
+        result += f', память GPU до {usage["peak_gpu_memory_mb"]:.0f} MB'
+    return result + '.'
@@ -0,0 +1,85 @@
+import argparse
+import math
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+from tabulate import tabulate
+
+from mlcourse_prac.db import mlcourse_database
+from mlcourse_prac.report import update_report
+
+# wall clock time when the job was handed to an evaluator, for the startup overhead
+JOB_STARTED_VARIABLE = 'MLCOURSE_JOB_STARTED'
+
+
+class Metrics:
+    # collects stage timings, counters and gauges of one solution, saved with a single write
+    # into the database, or into the report of the evaluation directory for evaluators
+    def __init__(
+        self, solution_id: Optional[int] = None, report_dir: Optional[Path] = None
+    ) -> None:
+        self.solution_id = solution_id
+        self.report_dir = report_dir
+        self.values: Dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(f'stage.{name}', time.perf_counter() - started)
+
+    def add(self, name: str, value: float = 1) -> None:
+        self.values[name] = self.values.get(name, 0) + value
+
+    def set_max(self, name: str, value: float) -> None:
+        self.values[name] = max(self.values.get(name, value), value)
+
+    def save(self) -> None:
+        if self.values and self.report_dir is not None:
+            update_report(self.report_dir, metrics=self.values)
+        elif self.values:
+            mlcourse_database.record_metrics(self.solution_id, self.values)
+        self.values = {}
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    index = max(math.ceil(q / 100 * len(sorted_values)) - 1, 0)
+    return sorted_values[index]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-stage statistics of evaluated solutions')
+    parser.add_argument('--hours', type=float, default=24 * 7, help='look back this many hours')
+    args, _ = parser.parse_known_args()
+    since = time.time() - args.hours * 3600
+
+    metrics = defaultdict(list)
+    for name, value in mlcourse_database.get_metrics(since):
+        metrics[name].append(value)
+
+    rows = []
+    for name in sorted(metrics):
+        values = sorted(metrics[name])
+        rows.append(
+            [name, len(values)]
+            + [percentile(values, q) for q in [50, 90, 99]]
+            + [values[-1], sum(values)]
+        )
+    print(tabulate(rows, headers=['metric', 'count', 'p50', 'p90', 'p99', 'max', 'total']))
+    print()
+
+    depth_by_hour = defaultdict(list)
+    for recorded_at, depth in mlcourse_database.get_queue_depth_history(since):
+        hour = datetime.fromtimestamp(recorded_at).strftime('%d.%m %H:00')
+        depth_by_hour[hour].append(depth)
+    rows = [
+        [hour, max(depths), sum(depths) / len(depths), len(depths)]
+        for hour, depths in depth_by_hour.items()
+    ]
+    print(tabulate(rows, headers=['hour', 'max queue', 'mean queue', 'samples'], floatfmt='.1f'))
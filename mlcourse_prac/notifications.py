@@ -0,0 +1,12 @@
+import multiprocessing as mp
+
+
+class Notifications:
+    # created in the server process before forking, shared by the bot and the evaluators
+    def __init__(self) -> None:
+        self.solution_submitted = mp.Event()
+        self.leaderboard_changed = mp.Event()
+        # a message has been put into the outbox table
+        self.message_queued = mp.Event()
+        # telegram_id of a student whose /status has changed, None if it's unknown whose
+        self.status_changed = mp.Queue()
@@ -0,0 +1,134 @@
+import sys
+import time
+from typing import List, Optional
+
+import requests
+from telebot import TeleBot
+from telebot.apihelper import ApiException, ApiTelegramException
+
+from mlcourse_prac.config import CONFIG
+from mlcourse_prac.db import mlcourse_database, OutboxMessage
+from mlcourse_prac.metrics import Metrics
+from mlcourse_prac.notifications import Notifications
+from mlcourse_prac.telebot import init_telebot, MESSAGE_LIMIT
+
+# a newer progress message replaces an unsent one, the final message makes it pointless
+SUPERSEDED_KINDS = {'progress': ['progress'], 'result': ['progress']}
+DUE_MESSAGES_BATCH = 100
+MAX_RETRY_DELAY_SECONDS = 600
+OUTBOX_ERROR_DELAY_SECONDS = 5
+# Telegram will never deliver these: the student has blocked the bot or the chat is gone,
+# other 400 errors are retried
+UNDELIVERABLE_ERROR_CODES = [403]
+UNDELIVERABLE_DESCRIPTIONS = ['chat not found', 'bot was blocked', 'user is deactivated']
+
+
+def split_message(text: str) -> List[str]:
+    # at line breaks where possible, so that a traceback stays readable
+    parts = []
+    while len(text) > MESSAGE_LIMIT:
+        cut = text.rfind('\n', 0, MESSAGE_LIMIT)
+        if cut <= 0:
+            cut = MESSAGE_LIMIT
+        parts.append(text[:cut])
+        text = text[cut:].lstrip('\n')
+    parts.append(text)
+    return parts
+
+
+def is_undeliverable(error: ApiTelegramException) -> bool:
+    description = str(error.description).lower()
+    return error.error_code in UNDELIVERABLE_ERROR_CODES or any(
+        undeliverable in description for undeliverable in UNDELIVERABLE_DESCRIPTIONS
+    )
+
+
+def queue_message(
+    notifications: Notifications, telegram_id: int, text: str, kind: str = 'result'
+) -> None:
+    # the message survives restarts and Telegram outages, the caller never waits for Telegram
+    mlcourse_database.queue_messages(
+        telegram_id, split_message(text), kind, SUPERSEDED_KINDS.get(kind, [])
+    )
+    notifications.message_queued.set()
+
+
+class OutboxSender:
+    # sends the queued messages within the rate limits of Telegram: about 30 messages a second
+    # in total and one a second per chat, the direct replies of the bot need some of it too
+    def __init__(self, bot: TeleBot) -> None:
+        self.bot = bot
+        self.send_interval = 1 / float(
+            CONFIG.get('telebot', 'outbox_messages_per_second', fallback='20')
+        )
+        self.chat_interval = float(
+            CONFIG.get('telebot', 'outbox_chat_interval_seconds', fallback='1')
+        )
+        self.max_attempts = int(CONFIG.get('telebot', 'outbox_max_attempts', fallback='10'))
+        self.next_send = 0.0
+
+    def send_due(self, metrics: Metrics) -> Optional[float]:
+        # returns how long to wait for the next due message, None if the outbox is empty
+        for message in mlcourse_database.get_due_messages(DUE_MESSAGES_BATCH):
+            time.sleep(max(self.next_send - time.monotonic(), 0))
+            self.send(message, metrics)
+
+        next_attempt = mlcourse_database.get_next_message_attempt()
+        if next_attempt is None:
+            return None
+        return max(next_attempt - time.time(), self.next_send - time.monotonic(), 0)
+
+    def send(self, message: OutboxMessage, metrics: Metrics) -> None:
+        self.next_send = time.monotonic() + self.send_interval
+        try:
+            self.bot.send_message(message.telegram_id, message.text)
+        except ApiTelegramException as e:
+            if e.error_code == 429:
+                # flood control holds back the whole bot, the message stays first in its chat
+                retry_after = e.result_json.get('parameters', {}).get('retry_after', 1)
+                self.next_send = time.monotonic() + retry_after
+                metrics.add('outbox.rate_limited')
+            elif is_undeliverable(e):
+                self.drop(message, e, metrics)
+            else:
+                self.retry(message, e, metrics)
+            return
+        except (ApiException, requests.RequestException) as e:
+            self.retry(message, e, metrics)
+            return
+
+        mlcourse_database.remove_message(
+            message.message_id, message.telegram_id, self.chat_interval
+        )
+        metrics.add('outbox.sent')
+        metrics.set_max('outbox.max_delay', time.time() - message.queued_at)
+
+    def retry(self, message: OutboxMessage, error: Exception, metrics: Metrics) -> None:
+        if message.attempts + 1 >= self.max_attempts:
+            self.drop(message, error, metrics)
+            return
+        delay_seconds = min(2**message.attempts, MAX_RETRY_DELAY_SECONDS)
+        mlcourse_database.retry_message(message.message_id, delay_seconds)
+        metrics.add('outbox.retried')
+
+    def drop(self, message: OutboxMessage, error: Exception, metrics: Metrics) -> None:
+        print(f'Message to {message.telegram_id} is dropped: {error}', file=sys.stderr)
+        mlcourse_database.remove_message(message.message_id, message.telegram_id, 0)
+        metrics.add('outbox.dropped')
+
+
+def outbox_process(notifications: Notifications):
+    bot, _ = init_telebot()
+    sender = OutboxSender(bot)
+    while True:
+        # cleared before looking at the outbox, so a message queued during sending is not missed
+        notifications.message_queued.clear()
+        metrics = Metrics()
+        try:
+            wait_seconds = sender.send_due(metrics)
+        except Exception as e:
+            # e.g. the database is locked for too long
+            print(f'Sending messages failed, will retry: {e}', file=sys.stderr)
+            wait_seconds = OUTBOX_ERROR_DELAY_SECONDS
+        metrics.save()
+        notifications.message_queued.wait(wait_seconds)
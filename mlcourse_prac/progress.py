@@ -0,0 +1,77 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+
+PROGRESS_FILE = 'progress.json'
+CHECKPOINT_INTERVAL_SECONDS = 5
+
+
+class Progress:
+    # written by the evaluator into its working directory, read by the checker;
+    # usage() is sampled on every write, e.g. GPU memory that only the evaluator can see
+    def __init__(
+        self, evaluation_dir: Path, usage: Optional[Callable[[], Dict[str, float]]] = None
+    ) -> None:
+        self.path = evaluation_dir / PROGRESS_FILE
+        self.usage = usage
+        self.state: Dict[str, Any] = {'stage': None, 'subsets': {}}
+        self.last_written = 0.0
+        self.lock = threading.Lock()
+
+    def set_stage(self, stage: str) -> None:
+        self.state['stage'] = stage
+        self.write()
+
+    def update(self, subset: str, processed: int, total: int, correct: int) -> None:
+        self.state['subsets'][subset] = {'processed': processed, 'total': total, 'correct': correct}
+        if (
+            processed == total
+            or time.monotonic() - self.last_written >= CHECKPOINT_INTERVAL_SECONDS
+        ):
+            self.write()
+
+    def write(self) -> None:
+        with self.lock:
+            if self.usage is not None:
+                self.state.update(self.usage())
+            # the reader never sees a half-written file
+            tmp_path = self.path.with_suffix('.tmp')
+            tmp_path.write_text(json.dumps(self.state))
+            os.replace(tmp_path, self.path)
+            self.last_written = time.monotonic()
+
+    def write_periodically(self) -> None:
+        # keeps the usage fresh during long stages like training, runs in a daemon thread
+        def loop():
+            while True:
+                time.sleep(CHECKPOINT_INTERVAL_SECONDS)
+                if time.monotonic() - self.last_written >= CHECKPOINT_INTERVAL_SECONDS:
+                    self.write()
+
+        threading.Thread(target=loop, daemon=True).start()
+
+
+def read_progress(evaluation_dir: Path) -> Optional[Dict[str, Any]]:
+    try:
+        return json.loads((evaluation_dir / PROGRESS_FILE).read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def describe_progress(progress: Optional[Dict[str, Any]]) -> str:
+    if progress is None or progress['stage'] is None:
+        return 'Проверка не успела начаться.'
+
+    result = f'Последний этап: {progress["stage"]}.'
+    for subset, counts in progress['subsets'].items():
+        if counts['processed'] == 0:
+            continue
+        accuracy = counts['correct'] / counts['processed']
+        result += (
+            f'\n{subset}: точность {accuracy:.4f} на {counts["processed"]} '
+            + f'из {counts["total"]} картинок'
+        )
+    return result
@@ -0,0 +1,33 @@
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+REPORT_FILE = 'report.json'
+
+
+def read_report(evaluation_dir: Path) -> Dict[str, Any]:
+    # scores and metrics written by the evaluator, everything it managed to write before exiting
+    try:
+        report = json.loads((evaluation_dir / REPORT_FILE).read_text())
+    except (OSError, ValueError):
+        report = {}
+    report.setdefault('scores', {})
+    report.setdefault('metrics', {})
+    return report
+
+
+def update_report(
+    evaluation_dir: Path,
+    scores: Optional[Dict[str, Any]] = None,
+    metrics: Optional[Dict[str, float]] = None,
+) -> None:
+    # the evaluator writes no database, so that it can run on a machine without one
+    report = read_report(evaluation_dir)
+    report['scores'].update(scores or {})
+    for name, value in (metrics or {}).items():
+        report['metrics'][name] = report['metrics'].get(name, 0) + value
+
+    tmp_path = (evaluation_dir / REPORT_FILE).with_suffix('.tmp')
+    tmp_path.write_text(json.dumps(report))
+    os.replace(tmp_path, evaluation_dir / REPORT_FILE)
@@ -0,0 +1,135 @@
+import argparse
+import os
+import shutil
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from tabulate import tabulate
+
+from mlcourse_prac.check_process import run_evaluation, WarmPool
+from mlcourse_prac.config import SOLUTIONS_DIR
+from mlcourse_prac.db import mlcourse_database
+from mlcourse_prac.metrics import Metrics
+from mlcourse_prac.run_log import RunLog
+from mlcourse_prac.store import enforce_retention, load_manifest, restore_submission
+from mlcourse_prac.test_cache import prepare_test_caches
+
+RESCORE_DIR = SOLUTIONS_DIR / 'rescore'
+TASKS = ['badnets', 'lira']
+
+Scores = Dict[str, Tuple[float, float]]
+
+
+def rescore_solution(solution_id: int) -> Tuple[Optional[Scores], str]:
+    # returns the new scores, None if the evaluation has failed, and the outcome for the table
+    evaluation_dir = RESCORE_DIR / f'{os.getpid()}-{solution_id}'
+    shutil.rmtree(evaluation_dir, ignore_errors=True)
+    evaluation_dir.mkdir(parents=True)
+    run_log = RunLog(f'rescore-{os.getpid()}-{solution_id}')
+    try:
+        restore_submission(solution_id, evaluation_dir)
+        result = run_evaluation(
+            evaluation_dir, Metrics(solution_id), WarmPool(0), lambda: True, run_log
+        )
+    finally:
+        run_log.discard()
+        shutil.rmtree(evaluation_dir, ignore_errors=True)
+
+    if result.limit_exceeded is not None:
+        return None, f'stopped at {result.limit_exceeded}'
+    if result.timed_out:
+        return None, 'timed out'
+    if result.returncode != 0:
+        last_line = (result.stderr_tail.strip().splitlines() or [''])[-1]
+        return None, f'exit code {result.returncode}: {last_line}'
+    scores = {
+        task: tuple(result.report['scores'][task])
+        for task in TASKS
+        if task in result.report['scores']
+    }
+    return scores, 'evaluated'
+
+
+def format_scores(scores: Optional[Scores], task: str) -> str:
+    if scores is None or task not in scores:
+        return '-'
+    clean, poisoned = scores[task]
+    return f'{poisoned:.4f} / {clean:.4f}'
+
+
+def select_solutions(args: argparse.Namespace) -> List[int]:
+    solution_ids = set(args.solution_ids)
+    if args.leaderboard:
+        solution_ids.update(mlcourse_database.get_rescore_candidates('leaderboard'))
+    if args.latest:
+        solution_ids.update(mlcourse_database.get_rescore_candidates('latest'))
+    return sorted(solution_ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Re-evaluate stored solutions without students uploading them again'
+    )
+    parser.add_argument('solution_ids', nargs='*', type=int, help='solutions to re-evaluate')
+    parser.add_argument(
+        '--leaderboard', action='store_true', help='the solutions on the leaderboard'
+    )
+    parser.add_argument(
+        '--latest', action='store_true', help='the latest evaluated solution of every student'
+    )
+    parser.add_argument(
+        '--jobs', type=int, default=1, help='evaluations in parallel, they share the GPUs'
+    )
+    parser.add_argument(
+        '--apply',
+        action='store_true',
+        help='write the new scores into the database and rebuild the leaderboard',
+    )
+    parser.add_argument(
+        '--retention', action='store_true', help='only apply the retention policy of the store'
+    )
+    args, _ = parser.parse_known_args()
+
+    if args.retention:
+        removed_ids = enforce_retention(force=True)
+        print(f'Removed {len(removed_ids)} stored solutions: {removed_ids}')
+        return
+
+    # solutions with the same content are evaluated once
+    solution_ids = select_solutions(args)
+    same_content = defaultdict(list)
+    outcomes = {}
+    for solution_id in solution_ids:
+        try:
+            same_content[load_manifest(solution_id)['content_hash']].append(solution_id)
+        except FileNotFoundError:
+            outcomes[solution_id] = (None, 'files are not stored')
+
+    prepare_test_caches()
+    representatives = [group[0] for group in same_content.values()]
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        for group, outcome in zip(
+            same_content.values(), executor.map(rescore_solution, representatives)
+        ):
+            for solution_id in group:
+                outcomes[solution_id] = outcome
+    print(f'{len(representatives)} evaluations for {len(solution_ids)} solutions')
+
+    rows = []
+    for solution_id in solution_ids:
+        old_scores = mlcourse_database.get_solution_scores(solution_id)
+        new_scores, outcome = outcomes[solution_id]
+        rows.append(
+            [solution_id]
+            + [format_scores(scores, task) for task in TASKS for scores in [old_scores, new_scores]]
+            + [outcome]
+        )
+    headers = ['solution', 'badnets before', 'badnets after', 'lira before', 'lira after', '']
+    print(tabulate(rows, headers=headers))
+
+    new_scores = {solution_id: scores for solution_id, (scores, _) in outcomes.items() if scores}
+    if args.apply:
+        mlcourse_database.replace_scores(new_scores)
+        # the server notices the new scores version, drops /status snapshots and republishes
+        print(f'Scores of {len(new_scores)} solutions written, the leaderboard is rebuilt')
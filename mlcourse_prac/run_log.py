@@ -0,0 +1,166 @@
+import os
+import re
+import shutil
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import BinaryIO, Callable, Deque, IO, List, Optional
+
+from mlcourse_prac.config import CONFIG, SOLUTIONS_DIR
+
+# full logs of finished solutions, fetched by students with /log
+LOGS_DIR = SOLUTIONS_DIR / 'logs'
+# logs being written, a solution gets its log in LOGS_DIR only while its lease is held
+RUNNING_LOGS_DIR = SOLUTIONS_DIR / 'running_logs'
+
+# a line without newlines, e.g. a progress bar, is split into pieces of this size
+MAX_LINE_CHARS = 2**16
+MAX_RELAYED_LINE_CHARS = 200
+COPY_CHUNK_SIZE = 2**16
+
+
+def log_path(solution_id: int) -> Path:
+    return LOGS_DIR / f'{solution_id}.log'
+
+
+class RunLog:
+    # output of one evaluation run: stdout and stderr are streamed into a rotating file,
+    # only the tail of stderr stays in memory. The latest progress line, e.g. an epoch of
+    # the student's training, is passed to relay at most once per progress_relay_minutes
+    def __init__(self, name: str, relay: Optional[Callable[[str], None]] = None) -> None:
+        RUNNING_LOGS_DIR.mkdir(parents=True, exist_ok=True)
+        self.path = RUNNING_LOGS_DIR / f'{name}.log'
+        self.rotated_path = self.path.with_suffix('.log.1')
+        self.max_file_bytes = int(
+            float(CONFIG.get('evaluation', 'log_max_size_mb', fallback='10')) * 2**20
+        )
+        self.max_tail_chars = int(CONFIG.get('evaluation', 'log_tail_chars', fallback='2000'))
+        progress_pattern = CONFIG.get('evaluation', 'progress_pattern', fallback=r'(?i)\bepoch\b')
+        self.progress_re = (
+            re.compile(progress_pattern) if progress_pattern and relay is not None else None
+        )
+        self.relay_seconds = (
+            float(CONFIG.get('evaluation', 'progress_relay_minutes', fallback='5')) * 60
+        )
+        self.relay = relay
+
+        # the locale of the container may be C, student output is anything
+        self.file: IO[str] = self.path.open('w', encoding='utf-8', errors='replace')
+        self.file_bytes = 0
+        self.tail: Deque[str] = deque()
+        self.tail_chars = 0
+        self.progress_line: Optional[str] = None
+        self.last_relayed = time.monotonic()
+        self.lock = threading.Lock()
+
+    def write(self, line: str, to_tail: bool = False) -> None:
+        with self.lock:
+            # a reader may still be draining the pipe of an escaped process
+            if self.file.closed:
+                return
+            line_bytes = len(line.encode('utf-8', errors='replace'))
+            if self.file_bytes > 0 and self.file_bytes + line_bytes > self.max_file_bytes:
+                # one previous part is kept, the log never takes more than twice the size
+                self.file.close()
+                os.replace(self.path, self.rotated_path)
+                self.file = self.path.open('w', encoding='utf-8', errors='replace')
+                self.file_bytes = 0
+            self.file.write(line)
+            self.file_bytes += line_bytes
+
+            if to_tail:
+                self.tail.append(line)
+                self.tail_chars += len(line)
+                while self.tail_chars > self.max_tail_chars and len(self.tail) > 1:
+                    self.tail_chars -= len(self.tail.popleft())
+            if self.progress_re is not None and self.progress_re.search(line):
+                self.progress_line = line.strip()
+
+    def follow(self, pipe: IO[str], to_tail: bool = False) -> threading.Thread:
+        # reads the pipe until the end in a daemon thread
+        def read():
+            for line in iter(lambda: pipe.readline(MAX_LINE_CHARS), ''):
+                self.write(line, to_tail)
+
+        thread = threading.Thread(target=read, daemon=True)
+        thread.start()
+        return thread
+
+    def relay_progress(self) -> None:
+        # called by the run loop, the relay happens outside of the reader threads
+        if self.progress_line is None or time.monotonic() - self.last_relayed < self.relay_seconds:
+            return
+        with self.lock:
+            line, self.progress_line = self.progress_line, None
+        self.last_relayed = time.monotonic()
+        try:
+            self.relay(line[:MAX_RELAYED_LINE_CHARS])
+        except Exception as e:
+            # a failed notification is no reason to stop the evaluation
+            print(f'progress relay failed: {e}')
+
+    def tail_text(self) -> str:
+        with self.lock:
+            text = ''.join(self.tail)
+        return text[-self.max_tail_chars :]
+
+    def close(self) -> None:
+        with self.lock:
+            self.file.close()
+
+    def copy_to(self, f: BinaryIO) -> None:
+        # the rotated part first, the log reads as one file
+        for path in [self.rotated_path, self.path]:
+            if path.exists():
+                with path.open('rb') as part:
+                    shutil.copyfileobj(part, f, COPY_CHUNK_SIZE)
+
+    def publish(self, solution_id: int) -> None:
+        LOGS_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_path = log_path(solution_id).with_suffix('.tmp')
+        with tmp_path.open('wb') as f:
+            self.copy_to(f)
+        os.replace(tmp_path, log_path(solution_id))
+        remove_expired_logs()
+
+    def discard(self) -> None:
+        self.close()
+        for path in [self.rotated_path, self.path]:
+            path.unlink(missing_ok=True)
+
+
+def store_log(solution_id: int, f: BinaryIO, size: int) -> None:
+    # a log uploaded by a remote worker
+    LOGS_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_path = log_path(solution_id).with_suffix('.tmp')
+    with tmp_path.open('wb') as tmp:
+        while size > 0:
+            chunk = f.read(min(size, COPY_CHUNK_SIZE))
+            if not chunk:
+                break
+            tmp.write(chunk)
+            size -= len(chunk)
+    os.replace(tmp_path, log_path(solution_id))
+    remove_expired_logs()
+
+
+def remove_expired_logs() -> None:
+    # also removes logs left in RUNNING_LOGS_DIR by workers that have died
+    retention_seconds = float(CONFIG.get('evaluation', 'log_retention_days', fallback='30')) * 86400
+    expired = time.time() - retention_seconds
+    for logs_dir in [LOGS_DIR, RUNNING_LOGS_DIR]:
+        for path in logs_dir.glob('*'):
+            try:
+                if path.stat().st_mtime < expired:
+                    path.unlink()
+            except OSError:
+                pass
+
+
+def find_latest_log(solution_ids: List[int]) -> Optional[Path]:
+    # solution_ids from the latest one, cached solutions have the log of their original
+    for solution_id in solution_ids:
+        if log_path(solution_id).exists():
+            return log_path(solution_id)
+    return None
@@ -0,0 +1,61 @@
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from mlcourse_prac.config import CONFIG
+
+
+class Candidate(NamedTuple):
+    solution_id: int
+    telegram_id: int
+    # when the student got the place in the queue, resubmissions keep it
+    queued_at: float
+    # evaluations of the student that finished within the fair share window
+    recent_runs: int
+    # mean duration of the student's latest evaluations, None without history
+    mean_runtime: Optional[float]
+
+
+def scheduler_option(key: str, fallback: str) -> str:
+    return CONFIG.get('scheduler', key, fallback=fallback)
+
+
+def fair_share_window_seconds() -> float:
+    return float(scheduler_option('fair_share_window_hours', '24')) * 3600
+
+
+def runtime_history_size() -> int:
+    return int(scheduler_option('runtime_history_size', '5'))
+
+
+def fifo_key(candidate: Candidate) -> Tuple[float, ...]:
+    return (candidate.queued_at,)
+
+
+def fair_share_key(candidate: Candidate) -> Tuple[float, ...]:
+    # every recent run moves the student back in the queue as if they had submitted later
+    penalty_seconds = float(scheduler_option('fair_share_penalty_minutes', '10')) * 60
+    return (candidate.queued_at + candidate.recent_runs * penalty_seconds,)
+
+
+def shortest_expected_job_key(candidate: Candidate) -> Tuple[float, ...]:
+    expected_runtime = candidate.mean_runtime
+    if expected_runtime is None:
+        expected_runtime = float(scheduler_option('default_runtime_minutes', '10')) * 60
+    return (expected_runtime, candidate.queued_at)
+
+
+POLICIES: Dict[str, Callable[[Candidate], Tuple[float, ...]]] = {
+    'fifo': fifo_key,
+    'fair_share': fair_share_key,
+    'sejf': shortest_expected_job_key,
+}
+
+
+def schedule(candidates: List[Candidate], now: float) -> List[Candidate]:
+    # returns the candidates in the order they should be tried
+    policy = POLICIES[scheduler_option('policy', 'fifo')]
+    max_wait_seconds = float(scheduler_option('max_wait_minutes', '180')) * 60
+
+    # starvation guard: whoever has waited too long goes first, regardless of the policy
+    starving = [c for c in candidates if now - c.queued_at > max_wait_seconds]
+    others = [c for c in candidates if now - c.queued_at <= max_wait_seconds]
+    return sorted(starving, key=fifo_key) + sorted(others, key=policy)
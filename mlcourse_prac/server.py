@@ -1,12 +1,22 @@
 import multiprocessing as mp
 
 from mlcourse_prac.check_process import check_process
+from mlcourse_prac.config import CONFIG
+from mlcourse_prac.coordinator import coordinator_process
+from mlcourse_prac.leaderboard import publisher_process
+from mlcourse_prac.notifications import Notifications
+from mlcourse_prac.outbox import outbox_process
 from mlcourse_prac.submit_process import submit_process
 
 
 def main():
-    mp.Process(target=check_process).start()
-    mp.Process(target=submit_process).start()
+    notifications = Notifications()
+    mp.Process(target=check_process, args=(notifications,)).start()
+    mp.Process(target=submit_process, args=(notifications,)).start()
+    mp.Process(target=publisher_process, args=(notifications,)).start()
+    mp.Process(target=outbox_process, args=(notifications,)).start()
+    if CONFIG.has_option('coordinator', 'port'):
+        mp.Process(target=coordinator_process, args=(notifications,)).start()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,92 @@
+import queue
+import threading
+import time
+from typing import Dict, Optional
+
+from mlcourse_prac.db import mlcourse_database, StatusSnapshot
+from mlcourse_prac.notifications import Notifications
+
+# how soon the scores changed by mlcourse-rescore show up in /status
+SCORES_VERSION_CHECK_SECONDS = 10
+
+
+class StatusCache:
+    # lives in the bot process; other processes put the telegram_id of every student whose
+    # status they change into notifications.status_changed, or None to drop everything
+    def __init__(self, notifications: Notifications) -> None:
+        self.changes = notifications.status_changed
+        self.snapshots: Dict[int, StatusSnapshot] = {}
+        self.lock = threading.Lock()
+        # counts applied changes, a snapshot read while one happened may be stale already
+        self.version = 0
+        # the command line tools bump the scores version in the database instead
+        self.scores_version: Optional[int] = None
+        self.scores_version_checked = 0.0
+
+    def scores_version_due(self) -> bool:
+        return time.monotonic() - self.scores_version_checked >= SCORES_VERSION_CHECK_SECONDS
+
+    def check_scores_version(self) -> None:
+        if not self.scores_version_due():
+            return
+        self.scores_version_checked = time.monotonic()
+        scores_version = mlcourse_database.get_scores_version()
+        if scores_version != self.scores_version:
+            self.scores_version = scores_version
+            self.version += 1
+            self.snapshots.clear()
+
+    def apply_change(self, telegram_id: Optional[int]) -> None:
+        self.version += 1
+        if telegram_id is None:
+            self.snapshots.clear()
+        else:
+            self.snapshots.pop(telegram_id, None)
+
+    def apply_changes(self) -> None:
+        while True:
+            try:
+                telegram_id = self.changes.get_nowait()
+            except queue.Empty:
+                return
+            self.apply_change(telegram_id)
+
+    def receive_changes(self) -> None:
+        # drains the queue in a daemon thread, so that it doesn't grow while nobody asks
+        # for /status, the requests still apply the changes that have just arrived
+        def loop():
+            while True:
+                telegram_id = self.changes.get()
+                with self.lock:
+                    self.apply_change(telegram_id)
+
+        threading.Thread(target=loop, daemon=True).start()
+
+    def invalidate(self, telegram_id: int) -> None:
+        with self.lock:
+            self.version += 1
+            self.snapshots.pop(telegram_id, None)
+
+    def get_cached(self, telegram_id: int) -> Optional[StatusSnapshot]:
+        # never touches the database, the scores version is left to get
+        with self.lock:
+            self.apply_changes()
+            if self.scores_version_due():
+                return None
+            return self.snapshots.get(telegram_id)
+
+    def get(self, telegram_id: int) -> Optional[StatusSnapshot]:
+        with self.lock:
+            self.check_scores_version()
+            self.apply_changes()
+            snapshot = self.snapshots.get(telegram_id)
+            if snapshot is not None:
+                return snapshot
+            version = self.version
+
+        snapshot = mlcourse_database.get_status_snapshot(telegram_id)
+        with self.lock:
+            self.apply_changes()
+            if snapshot is not None and self.version == version:
+                self.snapshots[telegram_id] = snapshot
+        return snapshot
@@ -0,0 +1,180 @@
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import time
+import zlib
+from pathlib import Path
+from typing import Any, Dict, List, Set
+
+from mlcourse_prac.config import CONFIG, SOLUTIONS_DIR
+from mlcourse_prac.db import mlcourse_database
+from mlcourse_prac.fingerprints import is_ignored
+
+# files of every submission, kept after the evaluation for re-scoring: compressed objects named
+# by the hash of their content, so that identical files of different submissions are stored once,
+# and a manifest per solution
+STORE_DIR = SOLUTIONS_DIR / 'store'
+OBJECTS_DIR = STORE_DIR / 'objects'
+MANIFESTS_DIR = STORE_DIR / 'manifests'
+
+CHUNK_SIZE = 2**20
+COMPRESSION_LEVEL = 6
+RETENTION_INTERVAL_SECONDS = 600
+# objects written by an upload whose manifest is not saved yet are not garbage
+ORPHAN_GRACE_SECONDS = 3600
+
+
+def object_path(content_hash: str) -> Path:
+    return OBJECTS_DIR / content_hash[:2] / content_hash
+
+
+def manifest_path(solution_id: int) -> Path:
+    return MANIFESTS_DIR / f'{solution_id}.json'
+
+
+def store_file(path: Path) -> str:
+    # hashes and compresses in one pass, identical files end up in the same object
+    OBJECTS_DIR.mkdir(parents=True, exist_ok=True)
+    digest = hashlib.sha256()
+    compressor = zlib.compressobj(COMPRESSION_LEVEL)
+    fd, tmp_path = tempfile.mkstemp(dir=OBJECTS_DIR)
+    try:
+        with os.fdopen(fd, 'wb') as tmp, path.open('rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+                tmp.write(compressor.compress(chunk))
+            tmp.write(compressor.flush())
+
+        content_hash = digest.hexdigest()
+        object_path(content_hash).parent.mkdir(exist_ok=True)
+        # a stored copy is replaced by the same content, so that its fresh modification time
+        # keeps it from the garbage collection until the manifest is saved
+        os.replace(tmp_path, object_path(content_hash))
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return content_hash
+
+
+def store_files(directory: Path) -> Dict[str, List[Any]]:
+    # relative path -> [content hash, size, mode], called before the solution has an id
+    files = {}
+    for path in sorted(directory.rglob('*')):
+        relative_path = path.relative_to(directory)
+        if path.is_symlink() or not path.is_file() or is_ignored(relative_path):
+            continue
+        stat = path.stat()
+        files[relative_path.as_posix()] = [store_file(path), stat.st_size, stat.st_mode & 0o777]
+    return files
+
+
+def save_manifest(
+    solution_id: int, telegram_id: int, content_hash: str, files: Dict[str, List[Any]]
+) -> None:
+    MANIFESTS_DIR.mkdir(parents=True, exist_ok=True)
+    manifest = {
+        'solution_id': solution_id,
+        'telegram_id': telegram_id,
+        'content_hash': content_hash,
+        'stored_at': time.time(),
+        'files': files,
+    }
+    tmp_path = manifest_path(solution_id).with_suffix('.tmp')
+    tmp_path.write_text(json.dumps(manifest))
+    os.replace(tmp_path, manifest_path(solution_id))
+
+
+def load_manifest(solution_id: int) -> Dict[str, Any]:
+    # raises FileNotFoundError for solutions that have not been stored or have been removed
+    return json.loads(manifest_path(solution_id).read_text())
+
+
+def restore_submission(solution_id: int, target_dir: Path) -> None:
+    for relative_path, (content_hash, _, mode) in load_manifest(solution_id)['files'].items():
+        path = target_dir / relative_path
+        # the manifest is written by the server, still nothing is restored outside of target_dir
+        if not path.resolve().is_relative_to(target_dir.resolve()):
+            continue
+        path.parent.mkdir(parents=True, exist_ok=True)
+        decompressor = zlib.decompressobj()
+        with object_path(content_hash).open('rb') as f, path.open('wb') as out:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                out.write(decompressor.decompress(chunk))
+            out.write(decompressor.flush())
+        path.chmod(mode)
+
+
+def enforce_retention(force: bool = False) -> List[int]:
+    # removes the manifests older than retention_days, then the oldest ones until the objects
+    # fit into budget_gb, and finally the objects nothing refers to. The latest solution of every
+    # student, the leaderboard and the queue are always kept. Returns the removed solution ids
+    STORE_DIR.mkdir(parents=True, exist_ok=True)
+    with open(STORE_DIR / 'retention.lock', 'a+') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # another process is already at it
+            return []
+        # the time of the last run is kept in the lock file
+        lock_file.seek(0)
+        last_run = float(lock_file.read() or 0)
+        if not force and time.time() - last_run < RETENTION_INTERVAL_SECONDS:
+            return []
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(str(time.time()))
+        lock_file.flush()
+        return remove_expired_solutions()
+
+
+def remove_expired_solutions() -> List[int]:
+    budget_bytes = float(CONFIG.get('store', 'budget_gb', fallback='20')) * 2**30
+    retention_seconds = float(CONFIG.get('store', 'retention_days', fallback='365')) * 86400
+    protected_ids = mlcourse_database.get_protected_solution_ids()
+
+    manifests = []
+    for path in MANIFESTS_DIR.glob('*.json'):
+        try:
+            manifests.append(json.loads(path.read_text()))
+        except (OSError, ValueError):
+            continue
+    manifests.sort(key=lambda manifest: manifest['stored_at'])
+
+    references: Dict[str, int] = {}
+    for manifest in manifests:
+        for content_hash, _, _ in manifest['files'].values():
+            references[content_hash] = references.get(content_hash, 0) + 1
+    object_sizes = {}
+    for path in OBJECTS_DIR.glob('*/*'):
+        object_sizes[path.name] = path.stat().st_size
+    total_size = sum(object_sizes.get(content_hash, 0) for content_hash in references)
+
+    removed_ids = []
+    expired = time.time() - retention_seconds
+    for manifest in manifests:
+        if manifest['solution_id'] in protected_ids:
+            continue
+        if manifest['stored_at'] >= expired and total_size <= budget_bytes:
+            continue
+        manifest_path(manifest['solution_id']).unlink(missing_ok=True)
+        removed_ids.append(manifest['solution_id'])
+        for content_hash, _, _ in manifest['files'].values():
+            references[content_hash] -= 1
+            if references[content_hash] == 0:
+                total_size -= object_sizes.get(content_hash, 0)
+
+    remove_orphaned_objects({content_hash for content_hash, count in references.items() if count})
+    return removed_ids
+
+
+def remove_orphaned_objects(referenced: Set[str]) -> None:
+    orphaned = time.time() - ORPHAN_GRACE_SECONDS
+    for path in OBJECTS_DIR.glob('*/*'):
+        try:
+            if path.name not in referenced and path.stat().st_mtime < orphaned:
+                path.unlink()
+        except OSError:
+            pass
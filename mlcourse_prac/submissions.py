@@ -0,0 +1,127 @@
+import os
+import shutil
+import tempfile
+import zipfile
+from pathlib import Path
+
+import requests
+from telebot import apihelper
+
+from mlcourse_prac.config import CONFIG, SOLUTIONS_DIR
+
+SPOOL_DIR = SOLUTIONS_DIR / 'spool'
+SUBMISSIONS_DIR = SOLUTIONS_DIR / 'submissions'
+EVALUATION_DIR = SOLUTIONS_DIR / 'evaluation'
+
+DOWNLOAD_CHUNK_SIZE = 2**16
+REQUIRED_FILES = ['requirements.txt', 'solution.py']
+
+
+class InvalidSubmission(Exception):
+    # the message is sent to the student as is
+    pass
+
+
+def download_to_spool(token: str, file_path: str) -> Path:
+    max_solution_size_mb = int(CONFIG['telebot']['max_solution_size_mb'])
+    url = (apihelper.FILE_URL or 'https://api.telegram.org/file/bot{0}/{1}').format(
+        token, file_path
+    )
+
+    SPOOL_DIR.mkdir(parents=True, exist_ok=True)
+    fd, spool_path = tempfile.mkstemp(suffix='.zip', dir=SPOOL_DIR)
+    try:
+        with os.fdopen(fd, 'wb') as f, requests.get(
+            url, stream=True, timeout=60, proxies=apihelper.proxy
+        ) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                if f.tell() > max_solution_size_mb * (2**20):
+                    raise InvalidSubmission(
+                        f'Превышен максимальный размер файлов {max_solution_size_mb} MB!'
+                    )
+    except BaseException:
+        os.unlink(spool_path)
+        raise
+    return Path(spool_path)
+
+
+def extract_to_staging(spool_path: Path) -> Path:
+    max_entries = int(CONFIG['telebot']['max_archive_entries'])
+    max_uncompressed_size_mb = int(CONFIG['telebot']['max_uncompressed_size_mb'])
+
+    try:
+        # only the central directory is read here, entries are decompressed by extractall
+        zf = zipfile.ZipFile(spool_path)
+    except zipfile.BadZipFile:
+        raise InvalidSubmission('Файл не является корректным zip-архивом!')
+
+    with zf:
+        zf_infos = zf.infolist()
+        if len(zf_infos) > max_entries:
+            raise InvalidSubmission(f'В архиве больше {max_entries} файлов!')
+
+        # extraction never writes more than the sizes declared in the central directory
+        if sum(zf_info.file_size for zf_info in zf_infos) > max_uncompressed_size_mb * (2**20):
+            raise InvalidSubmission(
+                f'Размер распакованного архива превышает {max_uncompressed_size_mb} MB!'
+            )
+
+        zf_members = {zf_info.filename for zf_info in zf_infos}
+        for required_file in REQUIRED_FILES:
+            if required_file not in zf_members:
+                raise InvalidSubmission(
+                    'В архиве должны быть файлы requirements.txt и solution.py!'
+                )
+
+        staging_dir = Path(tempfile.mkdtemp(prefix='staging-', dir=SPOOL_DIR))
+        try:
+            zf.extractall(staging_dir)
+        except (zipfile.BadZipFile, zipfile.LargeZipFile, OSError):
+            shutil.rmtree(staging_dir)
+            raise InvalidSubmission('Файл не является корректным zip-архивом!')
+    return staging_dir
+
+
+def publish_submission(staging_dir: Path, solution_id: int) -> None:
+    SUBMISSIONS_DIR.mkdir(parents=True, exist_ok=True)
+    os.rename(staging_dir, SUBMISSIONS_DIR / str(solution_id))
+
+
+def remove_submission(solution_id: int) -> None:
+    shutil.rmtree(SUBMISSIONS_DIR / str(solution_id), ignore_errors=True)
+
+
+def take_submission(solution_id: int) -> Path:
+    # the evaluator takes ownership with a rename, the files are never copied
+    evaluation_dir = EVALUATION_DIR / str(solution_id)
+    EVALUATION_DIR.mkdir(parents=True, exist_ok=True)
+    try:
+        os.rename(SUBMISSIONS_DIR / str(solution_id), evaluation_dir)
+    except FileNotFoundError:
+        # the solution has been requeued after its previous evaluator died
+        if not evaluation_dir.exists():
+            raise
+    return evaluation_dir
+
+
+def remove_evaluation(solution_id: int) -> None:
+    shutil.rmtree(EVALUATION_DIR / str(solution_id), ignore_errors=True)
+
+
+def archive_evaluation(solution_id: int) -> Path:
+    # the files a remote worker needs, the caller removes the archive
+    SPOOL_DIR.mkdir(parents=True, exist_ok=True)
+    fd, archive_path = tempfile.mkstemp(suffix='.zip', dir=SPOOL_DIR)
+    evaluation_dir = EVALUATION_DIR / str(solution_id)
+    try:
+        with os.fdopen(fd, 'wb') as f, zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for root, _, file_names in os.walk(evaluation_dir):
+                for file_name in file_names:
+                    path = Path(root) / file_name
+                    zf.write(path, path.relative_to(evaluation_dir))
+    except BaseException:
+        os.unlink(archive_path)
+        raise
+    return Path(archive_path)
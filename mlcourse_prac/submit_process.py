@@ -1,33 +1,58 @@
-import io
+import asyncio
 import re
 import shutil
-import zipfile
+import sys
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 
 from mlcourse_prac.config import CONFIG
-from mlcourse_prac.db import mlcourse_database
-from mlcourse_prac.telebot import init_telebot
+from mlcourse_prac.db import mlcourse_database, StatusSnapshot
+from mlcourse_prac.fingerprints import submission_fingerprint
+from mlcourse_prac.metrics import Metrics
+from mlcourse_prac.notifications import Notifications
+from mlcourse_prac.run_log import find_latest_log
+from mlcourse_prac.status_cache import StatusCache
+from mlcourse_prac.store import save_manifest, store_files
+from mlcourse_prac.submissions import (
+    download_to_spool,
+    extract_to_staging,
+    InvalidSubmission,
+    publish_submission,
+    remove_submission,
+)
+from mlcourse_prac.telebot import init_async_telebot, init_telebot
 
+NO_LOG_MESSAGE = 'Вывод проверки не найден: решения ещё не проверялись или вывод уже удалён.'
 
-def get_solution_status_str(telegram_id: int) -> str:
+
+def get_solution_status_str(snapshot: StatusSnapshot) -> str:
     result = '*Статус очереди*\n'
-    status = mlcourse_database.get_unchecked_solution_status(telegram_id)
+    status = snapshot.unchecked_status
     if status is None:
         result += 'У тебя нет непроверенных решений.'
     elif status == 'new':
         result += 'Загруженное решение пока в очереди на проверку.'
     else:
         result += 'Загруженное решение проверяется прямо сейчас!'
+
+    hits, misses = snapshot.cache_hits, snapshot.cache_misses
+    if hits:
+        result += (
+            f'\nИз {hits + misses} отправленных решений {hits} совпали с уже проверенными, '
+            + 'их результаты взяты без перепроверки.'
+        )
     return result
 
 
-def get_task_status(telegram_id: int, task: str = 'badnets') -> str:
+def get_task_status(snapshot: StatusSnapshot, task: str = 'badnets') -> str:
     task_pretty = 'Первая' if task == 'badnets' else 'Вторая'
     result = f'*{task_pretty} часть задания*\n'
 
     result += 'Последнее решение: '
-    last_solution = mlcourse_database.get_top_solution(telegram_id, task, 'latest')
+    last_solution = snapshot.top_solutions[task, 'latest']
     if last_solution is None:
         result += 'отсутствует'
     else:
@@ -38,7 +63,7 @@ def get_task_status(telegram_id: int, task: str = 'badnets') -> str:
         )
 
     result += '\nЛучшее решение: '
-    best_solution = mlcourse_database.get_top_solution(telegram_id, task, 'best')
+    best_solution = snapshot.top_solutions[task, 'best']
     if best_solution is None:
         result += 'отсутствует'
     else:
@@ -50,8 +75,100 @@ def get_task_status(telegram_id: int, task: str = 'badnets') -> str:
     return result
 
 
-def submit_process():
+def get_status_response(snapshot: StatusSnapshot) -> str:
+    return (
+        get_solution_status_str(snapshot)
+        + '\n\n'
+        + get_task_status(snapshot, 'badnets')
+        + '\n\n'
+        + get_task_status(snapshot, 'lira')
+    )
+
+
+def latest_log(telegram_id: int) -> Optional[Path]:
+    return find_latest_log(mlcourse_database.get_evaluated_solution_ids(telegram_id))
+
+
+def log_caption(path: Path) -> str:
+    return f'Полный вывод проверки решения {path.stem}'
+
+
+def parse_full_name(text: str) -> str:
+    # raises ValueError with the message for the student
+    name_parts: List[str] = text.lower().split(' ')
+    if len(name_parts) not in [3, 2]:
+        raise ValueError('В ФИО должны быть 3 или 2 слова!')
+
+    all_russian = all([re.match('[а-яё]+', name_part) for name_part in name_parts])
+    if not all_russian:
+        raise ValueError('В ФИО должны быть только русские буквы!')
+
+    return ' '.join([name_part.capitalize() for name_part in name_parts])
+
+
+def accept_solution(
+    notifications: Notifications, metrics: Metrics, telegram_id: int, token: str, file_path: str
+) -> str:
+    # downloads, unpacks and queues the archive, returns the reply for the student
+    try:
+        with metrics.stage('download'):
+            spool_path = download_to_spool(token, file_path)
+        try:
+            with metrics.stage('extract'):
+                staging_dir = extract_to_staging(spool_path)
+        finally:
+            spool_path.unlink()
+    except InvalidSubmission as e:
+        return str(e)
+
+    try:
+        with metrics.stage('fingerprint'):
+            content_hash = submission_fingerprint(staging_dir)
+        with metrics.stage('store'):
+            stored_files = store_files(staging_dir)
+        with metrics.stage('db.submit'):
+            cached = mlcourse_database.submit_cached_solution(telegram_id, content_hash)
+            if cached is None:
+                solution_id, superseded_ids = mlcourse_database.submit_solution(
+                    telegram_id, content_hash, partial(publish_submission, staging_dir)
+                )
+            else:
+                solution_id, superseded_ids = cached
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    if cached is not None:
+        notifications.leaderboard_changed.set()
+        reply = 'Такое решение уже проверялось, его результаты засчитаны повторно. Нажми /status'
+    else:
+        notifications.solution_submitted.set()
+        reply = 'Решение принято! Напишу по окончании проверки :)'
+
+    # the solution is queued already, the rest must not keep the student without a reply
+    for superseded_id in superseded_ids:
+        remove_submission(superseded_id)
+    try:
+        # kept for re-scoring after the evaluation has removed the files
+        save_manifest(solution_id, telegram_id, content_hash, stored_files)
+    except OSError as e:
+        print(f'Solution {solution_id} is not stored for re-scoring: {e}', file=sys.stderr)
+
+    metrics.solution_id = solution_id
+    metrics.add('result_cache.hit' if cached is not None else 'result_cache.miss')
+    metrics.save()
+    return reply
+
+
+def file_size_error(file_size: Optional[int]) -> Optional[str]:
+    max_solution_size_mb = int(CONFIG['telebot']['max_solution_size_mb'])
+    if file_size is None or file_size > max_solution_size_mb * (2**20):
+        return f'Превышен максимальный размер файлов {max_solution_size_mb} MB!'
+    return None
+
+
+def sync_bot(notifications: Notifications):
     bot, markup = init_telebot()
+    status_cache = StatusCache(notifications)
+    status_cache.receive_changes()
 
     @bot.message_handler(commands=['start'])
     def handle_start(message):
@@ -62,18 +179,14 @@ def submit_process():
         bot.register_next_step_handler(message, handle_full_name)
 
     def handle_full_name(message):
-        name_parts: List[str] = message.text.lower().split(' ')
-        if len(name_parts) not in [3, 2]:
-            bot.reply_to(message, 'В ФИО должны быть 3 или 2 слова!')
-            return
-
-        all_russian = all([re.match('[а-яё]+', name_part) for name_part in name_parts])
-        if not all_russian:
-            bot.reply_to(message, 'В ФИО должны быть только русские буквы!')
+        try:
+            full_name = parse_full_name(message.text)
+        except ValueError as e:
+            bot.reply_to(message, str(e))
             return
 
-        full_name = ' '.join([name_part.capitalize() for name_part in name_parts])
         mlcourse_database.set_student_full_name(message.chat.id, full_name)
+        status_cache.invalidate(message.chat.id)
 
         bot.send_message(message.chat.id, 'Теперь введи номер студенческого')
         bot.register_next_step_handler(message, handle_student_id)
@@ -86,6 +199,7 @@ def submit_process():
             return
 
         mlcourse_database.set_student_id(message.chat.id, student_id)
+        status_cache.invalidate(message.chat.id)
         bot.send_message(message.chat.id, 'Теперь можно загружать zip-архив с решением')
 
     @bot.message_handler(content_types=['document'])
@@ -95,48 +209,163 @@ def submit_process():
             bot.reply_to(message, 'Необходимо пройти регистрацию, введи команду: /start')
             return
 
-        file_info = bot.get_file(message.document.file_id)
-        max_solution_size_mb = int(CONFIG['telebot']['max_solution_size_mb'])
-        if file_info.file_size is None or file_info.file_size > max_solution_size_mb * (2**20):
-            bot.reply_to(message, f'Превышен максимальный размер файлов {max_solution_size_mb} MB!')
+        metrics = Metrics()
+        with metrics.stage('get_file'):
+            file_info = bot.get_file(message.document.file_id)
+        error = file_size_error(file_info.file_size)
+        if error is not None:
+            bot.reply_to(message, error)
             return
 
-        downloaded_file: bytes = bot.download_file(file_info.file_path)
-        try:
-            zf = zipfile.ZipFile(io.BytesIO(downloaded_file))
-            zf_members = zf.namelist()
-        except zipfile.BadZipFile:
-            bot.reply_to(message, 'Файл не является корректным zip-архивом!')
+        reply = accept_solution(
+            notifications, metrics, message.chat.id, bot.token, file_info.file_path
+        )
+        status_cache.invalidate(message.chat.id)
+        bot.reply_to(message, reply)
+
+    @bot.message_handler(commands=['status'])
+    def handler_status(message):
+        snapshot = status_cache.get(message.chat.id)
+        if snapshot is None or snapshot.student_id is None:
+            bot.reply_to(message, 'Необходимо пройти регистрацию, введи команду: /start')
             return
 
-        for required_file in ['requirements.txt', 'solution.py']:
-            if required_file not in zf_members:
-                bot.reply_to(message, 'В архиве должны быть файлы requirements.txt и solution.py!')
-                return
+        response = get_status_response(snapshot)
+        bot.send_message(message.chat.id, response, reply_markup=markup, parse_mode='Markdown')
 
-        uncompressed_path = Path('/solutions') / str(message.chat.id)
-        if uncompressed_path.exists():
-            shutil.rmtree(uncompressed_path)
-        zf.extractall(uncompressed_path)
-        zf.close()
+    @bot.message_handler(commands=['log'])
+    def handle_log(message):
+        path = latest_log(message.chat.id)
+        if path is None:
+            bot.reply_to(message, NO_LOG_MESSAGE)
+            return
+        with open(path, 'rb') as f:
+            bot.send_document(message.chat.id, f, caption=log_caption(path))
 
-        mlcourse_database.submit_solution(message.chat.id)
-        bot.reply_to(message, 'Решение принято! Напишу по окончании проверки :)')
+    bot.infinity_polling()
 
-    @bot.message_handler(commands=['status'])
-    def handler_status(message):
-        student_info = mlcourse_database.get_student_info(message.chat.id)
+
+async def async_bot(notifications: Notifications):
+    from telebot import asyncio_filters
+
+    bot, markup = init_async_telebot()
+    status_cache = StatusCache(notifications)
+    status_cache.receive_changes()
+    bot.add_custom_filter(asyncio_filters.StateFilter(bot))
+    loop = asyncio.get_running_loop()
+
+    # uploads have their own pool, so that queries of /status never wait behind them
+    upload_executor = ThreadPoolExecutor(
+        max_workers=int(CONFIG['telebot']['upload_workers']), thread_name_prefix='upload'
+    )
+    db_executor = ThreadPoolExecutor(
+        max_workers=int(CONFIG['telebot']['db_workers']), thread_name_prefix='db'
+    )
+    max_uploads_per_user = int(CONFIG['telebot']['max_uploads_per_user'])
+    user_uploads = defaultdict(lambda: asyncio.Semaphore(max_uploads_per_user))
+
+    async def run_db(function, *args):
+        return await loop.run_in_executor(db_executor, function, *args)
+
+    async def is_registered(message) -> bool:
+        student_info = await run_db(mlcourse_database.get_student_info, message.chat.id)
         if student_info is None or student_info[1] is None:
-            bot.reply_to(message, 'Необходимо пройти регистрацию, введи команду: /start')
+            await bot.reply_to(message, 'Необходимо пройти регистрацию, введи команду: /start')
+            return False
+        return True
+
+    @bot.message_handler(commands=['start'])
+    async def handle_start(message):
+        await bot.send_message(
+            message.chat.id,
+            'Привет, {0.first_name}! Введи: Фамилию Имя Отчество'.format(message.from_user),
+        )
+        await bot.set_state(message.from_user.id, 'full_name', message.chat.id)
+
+    @bot.message_handler(commands=['status'])
+    async def handler_status(message):
+        # answered from the cache without a thread switch, unless the status has changed
+        snapshot = status_cache.get_cached(message.chat.id)
+        if snapshot is None:
+            snapshot = await run_db(status_cache.get, message.chat.id)
+        if snapshot is None or snapshot.student_id is None:
+            await bot.reply_to(message, 'Необходимо пройти регистрацию, введи команду: /start')
             return
 
-        response = (
-            get_solution_status_str(message.chat.id)
-            + '\n\n'
-            + get_task_status(message.chat.id, 'badnets')
-            + '\n\n'
-            + get_task_status(message.chat.id, 'lira')
+        response = get_status_response(snapshot)
+        await bot.send_message(
+            message.chat.id, response, reply_markup=markup, parse_mode='Markdown'
         )
-        bot.send_message(message.chat.id, response, reply_markup=markup, parse_mode='Markdown')
 
-    bot.infinity_polling()
+    @bot.message_handler(commands=['log'])
+    async def handle_log(message):
+        path = await run_db(latest_log, message.chat.id)
+        if path is None:
+            await bot.reply_to(message, NO_LOG_MESSAGE)
+            return
+        with open(path, 'rb') as f:
+            await bot.send_document(message.chat.id, f, caption=log_caption(path))
+
+    @bot.message_handler(state='full_name')
+    async def handle_full_name(message):
+        await bot.delete_state(message.from_user.id, message.chat.id)
+        try:
+            full_name = parse_full_name(message.text)
+        except ValueError as e:
+            await bot.reply_to(message, str(e))
+            return
+
+        await run_db(mlcourse_database.set_student_full_name, message.chat.id, full_name)
+        status_cache.invalidate(message.chat.id)
+
+        await bot.send_message(message.chat.id, 'Теперь введи номер студенческого')
+        await bot.set_state(message.from_user.id, 'student_id', message.chat.id)
+
+    @bot.message_handler(state='student_id')
+    async def handle_student_id(message):
+        await bot.delete_state(message.from_user.id, message.chat.id)
+        try:
+            student_id = int(message.text)
+        except ValueError:
+            await bot.reply_to(message, 'Номер студенческого должен быть целым числом!')
+            return
+
+        await run_db(mlcourse_database.set_student_id, message.chat.id, student_id)
+        status_cache.invalidate(message.chat.id)
+        await bot.send_message(message.chat.id, 'Теперь можно загружать zip-архив с решением')
+
+    @bot.message_handler(content_types=['document'])
+    async def handle_solution(message):
+        if not await is_registered(message):
+            return
+
+        metrics = Metrics()
+        with metrics.stage('get_file'):
+            file_info = await bot.get_file(message.document.file_id)
+        error = file_size_error(file_info.file_size)
+        if error is not None:
+            await bot.reply_to(message, error)
+            return
+
+        # archives of one student are processed one after another, the latest one wins
+        async with user_uploads[message.chat.id]:
+            reply = await loop.run_in_executor(
+                upload_executor,
+                accept_solution,
+                notifications,
+                metrics,
+                message.chat.id,
+                bot.token,
+                file_info.file_path,
+            )
+        status_cache.invalidate(message.chat.id)
+        await bot.reply_to(message, reply)
+
+    await bot.infinity_polling()
+
+
+def submit_process(notifications: Notifications):
+    if CONFIG.get('telebot', 'mode', fallback='sync') == 'async':
+        asyncio.run(async_bot(notifications))
+    else:
+        sync_bot(notifications)
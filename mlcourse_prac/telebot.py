@@ -1,17 +1,45 @@
-from typing import Tuple
+from typing import Any, Tuple
 
-from telebot import TeleBot
+from telebot import apihelper, TeleBot
 from telebot.types import InlineKeyboardButton, InlineKeyboardMarkup
 
 from mlcourse_prac.config import CONFIG
 
+# Telegram rejects longer messages
+MESSAGE_LIMIT = 4096
 
-def init_telebot() -> Tuple[TeleBot, InlineKeyboardMarkup]:
-    bot = TeleBot(CONFIG['telebot']['token'])
+
+def set_api_url() -> None:
+    api_url = CONFIG.get('telebot', 'api_url', fallback=None)
+    if api_url is not None:
+        # a local Bot API server, e.g. the one used by the load benchmarks
+        apihelper.API_URL = api_url.rstrip('/') + '/bot{0}/{1}'
+        apihelper.FILE_URL = api_url.rstrip('/') + '/file/bot{0}/{1}'
+
+
+def leaderboard_markup() -> InlineKeyboardMarkup:
     button = InlineKeyboardButton(
         'MLCourse Leaderboard', url='https://mlcourse.at.ispras.ru/leaderboard'
     )
     markup = InlineKeyboardMarkup()
     markup.add(button)
+    return markup
+
+
+def init_telebot() -> Tuple[TeleBot, InlineKeyboardMarkup]:
+    set_api_url()
+    bot = TeleBot(CONFIG['telebot']['token'])
+    return bot, leaderboard_markup()
+
+
+def init_async_telebot() -> Tuple[Any, InlineKeyboardMarkup]:
+    # aiohttp is an optional dependency, it is only needed in the async mode
+    from telebot import asyncio_helper
+    from telebot.async_telebot import AsyncTeleBot
 
-    return bot, markup
+    set_api_url()
+    if apihelper.API_URL is not None:
+        asyncio_helper.API_URL = apihelper.API_URL
+        asyncio_helper.FILE_URL = apihelper.FILE_URL
+    bot = AsyncTeleBot(CONFIG['telebot']['token'])
+    return bot, leaderboard_markup()
@@ -0,0 +1,121 @@
+import functools
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Iterable, Tuple
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from torchvision import transforms
+from torchvision.datasets import ImageFolder
+
+from mlcourse_prac.config import CONFIG, DATA_DIR, SOLUTIONS_DIR
+from mlcourse_prac.fingerprints import directory_fingerprint
+
+RESIZE_SIZE = 256
+CROP_SIZE = 224
+NORMALIZE_MEAN = [0.485, 0.456, 0.406]
+NORMALIZE_STD = [0.229, 0.224, 0.225]
+
+# only affects how fast the cache is built, the evaluation has its own batch size
+DECODE_BATCH_SIZE = 64
+
+# bump whenever the on-disk layout or the preprocessing pipeline changes
+CACHE_FORMAT_VERSION = 1
+
+
+def cache_key(test_subset_dir: Path) -> str:
+    params = f'v{CACHE_FORMAT_VERSION}-{RESIZE_SIZE}-{CROP_SIZE}'
+    return params + '-' + directory_fingerprint(test_subset_dir)
+
+
+def cache_root() -> Path:
+    return Path(
+        CONFIG.get('evaluation', 'test_cache_dir', fallback=str(SOLUTIONS_DIR / 'test_cache'))
+    )
+
+
+def build_test_subset_cache(test_subset_dir: Path, target_dir: Path) -> None:
+    transform = transforms.Compose(
+        [
+            transforms.Resize(RESIZE_SIZE),
+            transforms.CenterCrop(CROP_SIZE),
+            transforms.PILToTensor(),
+        ]
+    )
+    dataset = ImageFolder(test_subset_dir, transform)
+    loader = DataLoader(
+        dataset,
+        batch_size=DECODE_BATCH_SIZE,
+        shuffle=False,
+        num_workers=int(CONFIG['evaluation']['dataloader_num_workers']),
+    )
+
+    target_dir.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dir = Path(tempfile.mkdtemp(prefix='.tmp-', dir=target_dir.parent))
+    try:
+        images = np.lib.format.open_memmap(
+            tmp_dir / 'images.npy',
+            mode='w+',
+            dtype=np.uint8,
+            shape=(len(dataset), 3, CROP_SIZE, CROP_SIZE),
+        )
+        labels = np.empty(len(dataset), dtype=np.int64)
+
+        offset = 0
+        for batch_images, batch_labels in loader:
+            images[offset : offset + len(batch_labels)] = batch_images.numpy()
+            labels[offset : offset + len(batch_labels)] = batch_labels.numpy()
+            offset += len(batch_labels)
+
+        images.flush()
+        del images
+        np.save(tmp_dir / 'labels.npy', labels)
+
+        try:
+            os.rename(tmp_dir, target_dir)
+        except OSError:
+            # another process has built the same cache in the meantime
+            if not target_dir.exists():
+                raise
+    finally:
+        if tmp_dir.exists():
+            shutil.rmtree(tmp_dir)
+
+
+# memoized so that warm evaluators skip the fingerprinting when the job arrives
+@functools.lru_cache(maxsize=None)
+def load_test_subset(test_subset_dir: Path) -> Tuple[np.ndarray, np.ndarray]:
+    cache_dir = cache_root() / cache_key(test_subset_dir)
+    if not cache_dir.exists():
+        build_test_subset_cache(test_subset_dir, cache_dir)
+
+    images = np.load(cache_dir / 'images.npy', mmap_mode='r')
+    labels = np.load(cache_dir / 'labels.npy')
+    return images, labels
+
+
+def normalize_batch(images: torch.Tensor) -> torch.Tensor:
+    # same arithmetic as ToTensor() followed by Normalize(), but done on the target device
+    mean = torch.tensor(NORMALIZE_MEAN, device=images.device).view(1, -1, 1, 1)
+    std = torch.tensor(NORMALIZE_STD, device=images.device).view(1, -1, 1, 1)
+    return images.float().div_(255).sub_(mean).div_(std)
+
+
+def test_subset_dirs() -> Iterable[Path]:
+    for task in ['badnets', 'lira']:
+        test_dir = DATA_DIR / CONFIG[task]['test_dir']
+        for subset in ['clean', 'poisoned']:
+            if (test_dir / subset).is_dir():
+                yield test_dir / subset
+
+
+def prepare_test_caches() -> None:
+    for test_subset_dir in test_subset_dirs():
+        load_test_subset(test_subset_dir)
+
+
+def main():
+    prepare_test_caches()
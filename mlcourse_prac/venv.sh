@@ -1,11 +1,5 @@
 #!/bin/bash
-python3 -m venv --system-site-packages ./.venv
-. .venv/bin/activate
-pip install -r requirements.txt
-
-mlcourse-evaluate
-STATUS=$?
-
-deactivate
-rm -rf ./.venv
-exit $STATUS
+# builds or reuses a cached environment for requirements.txt and runs mlcourse-evaluate in it,
+# -I keeps the solution directory off the module search path, so that files of the student
+# can't replace the modules of the evaluator
+exec python3 -I -m mlcourse_prac.venv_cache
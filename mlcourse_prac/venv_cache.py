@@ -0,0 +1,302 @@
+import fcntl
+import hashlib
+import json
+import os
+import platform
+import re
+import shutil
+import site
+import stat
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from mlcourse_prac.config import CONFIG, SOLUTIONS_DIR
+from mlcourse_prac.metrics import Metrics
+
+REQUIREMENT_NAME_RE = re.compile(r'^([A-Za-z0-9][A-Za-z0-9._-]*)(.*)$')
+# installed by venv itself into every environment
+VENV_SEED_MODULES = {'pip', 'pkg_resources', 'setuptools', '_distutils_hack'}
+
+
+class VenvBuildError(Exception):
+    pass
+
+
+def cache_dir() -> Path:
+    return Path(
+        CONFIG.get('evaluation', 'venv_cache_dir', fallback=str(SOLUTIONS_DIR / 'venv_cache'))
+    )
+
+
+def normalize_requirements(text: str) -> Optional[List[str]]:
+    # returns None for requirements that depend on other files or pip options,
+    # such environments are built for every run without caching
+    requirements = set()
+    for line in text.splitlines():
+        line = re.sub(r'(^|\s)#.*$', '', line).strip()
+        if not line:
+            continue
+
+        match = REQUIREMENT_NAME_RE.match(line)
+        if match is None or 'file:' in line:
+            return None
+        name, spec = match.groups()
+        name = re.sub(r'[-_.]+', '-', name).lower()
+        requirements.add(name + ''.join(spec.split()))
+    return sorted(requirements)
+
+
+def requirements_key(requirements: List[str]) -> str:
+    digest = hashlib.sha256()
+    digest.update(f'python {platform.python_version()}\n'.encode())
+    digest.update('\n'.join(requirements).encode())
+    return digest.hexdigest()
+
+
+def build_venv(venv_dir: Path, requirements_path: Path) -> None:
+    subprocess.run(
+        [sys.executable, '-m', 'venv', '--system-site-packages', str(venv_dir)],
+        check=True,
+        capture_output=True,
+    )
+    if not requirements_path.read_text().strip():
+        return
+
+    environment = dict(os.environ, PIP_CACHE_DIR=str(cache_dir() / 'pip'))
+    completed = subprocess.run(
+        [str(venv_dir / 'bin' / 'pip'), 'install', '-r', str(requirements_path)],
+        capture_output=True,
+        text=True,
+        env=environment,
+    )
+    if completed.returncode != 0:
+        raise VenvBuildError(completed.stderr)
+
+
+def set_read_only(path: Path) -> None:
+    # protects from accidental writes only, root ignores the modes, so reuse relies on tree_digest
+    for root, dir_names, file_names in os.walk(path):
+        for name in file_names + dir_names:
+            entry_path = os.path.join(root, name)
+            if not os.path.islink(entry_path):
+                os.chmod(entry_path, os.stat(entry_path).st_mode & ~0o222)
+
+
+def remove_read_only(path: Path) -> None:
+    def make_writable_and_retry(function, failed_path, _):
+        os.chmod(os.path.dirname(failed_path), stat.S_IRWXU)
+        if os.path.isdir(failed_path) and not os.path.islink(failed_path):
+            os.chmod(failed_path, stat.S_IRWXU)
+        function(failed_path)
+
+    if path.exists():
+        shutil.rmtree(path, onerror=make_writable_and_retry)
+
+
+def directory_size(path: Path) -> int:
+    return sum(entry.lstat().st_size for entry in path.rglob('*'))
+
+
+def tree_digest(path: Path) -> str:
+    # names, modes and contents of everything in the environment, computed after the build
+    # and checked before every reuse, so that a solution that changed the environment
+    # doesn't affect the solutions evaluated in it later
+    digest = hashlib.sha256()
+    for entry in sorted(path.rglob('*')):
+        entry_stat = entry.lstat()
+        digest.update(f'{entry.relative_to(path)}\0{entry_stat.st_mode}\0'.encode())
+        if entry.is_symlink():
+            digest.update(os.readlink(entry).encode())
+        elif entry.is_file():
+            with open(entry, 'rb') as f:
+                for chunk in iter(lambda: f.read(2**20), b''):
+                    digest.update(chunk)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def venv_intact(envs_dir: Path, key: str) -> bool:
+    digest_path = envs_dir / f'{key}.sha256'
+    if not (envs_dir / f'{key}.size').exists() or not digest_path.exists():
+        return False
+    return tree_digest(envs_dir / key) == digest_path.read_text()
+
+
+def update_stats(hit: bool) -> Dict[str, int]:
+    stats_path = cache_dir() / 'stats.json'
+    with open(stats_path, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        content = f.read()
+        stats = json.loads(content) if content else {'hits': 0, 'misses': 0}
+        stats['hits' if hit else 'misses'] += 1
+        f.seek(0)
+        f.truncate()
+        json.dump(stats, f)
+    return stats
+
+
+def evict_least_recently_used(keep_key: str) -> List[str]:
+    budget_bytes = float(CONFIG.get('evaluation', 'venv_cache_budget_gb', fallback='50')) * 2**30
+    envs_dir = cache_dir() / 'envs'
+
+    entries: List[Tuple[float, int, str]] = []
+    for size_path in envs_dir.glob('*.size'):
+        key = size_path.stem
+        lock_path = envs_dir / f'{key}.lock'
+        last_used = lock_path.stat().st_mtime if lock_path.exists() else 0.0
+        entries.append((last_used, int(size_path.read_text()), key))
+
+    total_size = sum(size for _, size, _ in entries)
+    evicted = []
+    for _, size, key in sorted(entries):
+        if total_size <= budget_bytes:
+            break
+        if key == keep_key:
+            continue
+
+        with open(envs_dir / f'{key}.lock', 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # the environment is in use by a running evaluation
+                continue
+            (envs_dir / f'{key}.size').unlink()
+            (envs_dir / f'{key}.sha256').unlink(missing_ok=True)
+            (envs_dir / f'{key}.txt').unlink(missing_ok=True)
+            remove_read_only(envs_dir / key)
+        total_size -= size
+        evicted.append(key)
+    return evicted
+
+
+@contextmanager
+def solution_venv(requirements_path: Path, metrics: Metrics) -> Iterator[Path]:
+    requirements = normalize_requirements(requirements_path.read_text())
+    if requirements is None:
+        print('venv cache: requirements.txt is not cacheable, building a private environment')
+        venv_dir = requirements_path.parent / '.venv'
+        build_venv(venv_dir, requirements_path)
+        yield venv_dir
+        return
+
+    key = requirements_key(requirements)
+    envs_dir = cache_dir() / 'envs'
+    envs_dir.mkdir(parents=True, exist_ok=True)
+    venv_dir = envs_dir / key
+    size_path = envs_dir / f'{key}.size'
+
+    with open(envs_dir / f'{key}.lock', 'a') as lock_file:
+        # a shared lock is held while the environment is used, eviction needs an exclusive one
+        hit = True
+        while True:
+            fcntl.flock(lock_file, fcntl.LOCK_SH)
+            if venv_intact(envs_dir, key):
+                break
+
+            hit = False
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if not venv_intact(envs_dir, key):
+                if size_path.exists():
+                    print(f'venv cache: environment {key[:12]} was modified, rebuilding')
+                    size_path.unlink()
+                remove_read_only(venv_dir)
+                normalized_path = envs_dir / f'{key}.txt'
+                normalized_path.write_text('\n'.join(requirements) + '\n')
+                try:
+                    build_venv(venv_dir, normalized_path)
+                except Exception:
+                    remove_read_only(venv_dir)
+                    raise
+                set_read_only(venv_dir)
+                (envs_dir / f'{key}.sha256').write_text(tree_digest(venv_dir))
+                size_path.write_text(str(directory_size(venv_dir)))
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+        os.utime(lock_file.fileno())
+        metrics.add('venv_cache.hit' if hit else 'venv_cache.miss')
+        stats = update_stats(hit)
+        print(
+            f'venv cache {"hit" if hit else "miss"} {key[:12]}: '
+            + f'{stats["hits"]} hits, {stats["misses"]} misses in total'
+        )
+        for evicted_key in evict_least_recently_used(keep_key=key):
+            print(f'venv cache: evicted {evicted_key[:12]}')
+
+        yield venv_dir
+
+
+def venv_site_packages(venv_dir: Path) -> Path:
+    return next((venv_dir / 'lib').glob('python*/site-packages'))
+
+
+def shadows_loaded_modules(venv_dir: Path) -> bool:
+    # a package from requirements.txt can't replace a module that has already been imported
+    loaded = {name.split('.')[0] for name in sys.modules} - VENV_SEED_MODULES
+    for entry in venv_site_packages(venv_dir).iterdir():
+        # torch, numpy.py, _cffi_backend.cpython-310-x86_64-linux-gnu.so, but not *.dist-info
+        if entry.name.split('.')[0] in loaded:
+            return True
+    return False
+
+
+def activate(venv_dir: Path) -> None:
+    # the same module search path as in the venv interpreter: its packages, then the system ones
+    system_path = list(sys.path)
+    site.addsitedir(str(venv_site_packages(venv_dir)))
+    sys.path[:] = [path for path in sys.path if path not in system_path] + system_path
+    os.environ['VIRTUAL_ENV'] = str(venv_dir)
+    os.environ['PATH'] = str(venv_dir / 'bin') + os.pathsep + os.environ.get('PATH', '')
+
+
+def main(warm: bool = False):
+    # runs the evaluation of the solution in the current directory inside its environment,
+    # a warm evaluator runs it in its own interpreter with torch and the test data loaded
+    metrics = Metrics(report_dir=Path.cwd())
+    started = time.perf_counter()
+    try:
+        with solution_venv(Path('requirements.txt').resolve(), metrics) as venv_dir:
+            metrics.add('stage.venv', time.perf_counter() - started)
+            print(f'venv cache: environment ready in {metrics.values["stage.venv"]:.1f} s')
+
+            if warm and shadows_loaded_modules(venv_dir):
+                print('warm evaluator: requirements.txt replaces preloaded packages, cold start')
+                warm = False
+            metrics.add('evaluator.warm' if warm else 'evaluator.cold')
+            metrics.save()
+
+            if warm:
+                from mlcourse_prac import evaluate
+
+                activate(venv_dir)
+                sys.stdout.flush()
+                evaluate.main()
+                return
+
+            environment = dict(
+                os.environ,
+                VIRTUAL_ENV=str(venv_dir),
+                PATH=str(venv_dir / 'bin') + os.pathsep + os.environ.get('PATH', ''),
+            )
+            sys.stdout.flush()
+            # evaluate.main appends the solution directory after the evaluator modules itself
+            completed = subprocess.run(
+                [str(venv_dir / 'bin' / 'python'), '-I', '-m', 'mlcourse_prac.evaluate'],
+                env=environment,
+            )
+    except VenvBuildError as e:
+        metrics.add('stage.venv', time.perf_counter() - started)
+        metrics.save()
+        print('Не удалось установить пакеты из requirements.txt:\n\n' + str(e), file=sys.stderr)
+        sys.exit(1)
+
+    sys.exit(completed.returncode)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+import json
+import os
+import sys
+
+from mlcourse_prac import venv_cache
+from mlcourse_prac.evaluate import preload
+from mlcourse_prac.metrics import JOB_STARTED_VARIABLE
+
+
+def main():
+    # started by an evaluation worker ahead of time, evaluates exactly one solution and exits,
+    # so that nothing is shared between the solutions of different students
+    preload()
+    # the worker hands out only evaluators that got this far
+    print('ready', flush=True)
+
+    line = sys.stdin.readline()
+    if not line:
+        # the worker that started this evaluator has exited
+        return
+    job = json.loads(line)
+    os.chdir(job['evaluation_dir'])
+    os.environ[JOB_STARTED_VARIABLE] = str(job['started'])
+    venv_cache.main(warm=True)
+
+
+if __name__ == '__main__':
+    main()
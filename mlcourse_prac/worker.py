@@ -0,0 +1,151 @@
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import zipfile
+from functools import partial
+from pathlib import Path
+from typing import Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from mlcourse_prac.check_process import (
+    EvaluationResult,
+    LeaseLost,
+    run_evaluation,
+    supervise_workers,
+    WarmPool,
+)
+from mlcourse_prac.config import CONFIG, SOLUTIONS_DIR
+from mlcourse_prac.metrics import Metrics
+from mlcourse_prac.run_log import RunLog
+
+# separate from the evaluation directory of a coordinator running on the same machine
+REMOTE_DIR = SOLUTIONS_DIR / 'remote'
+
+
+class CoordinatorClient:
+    def __init__(self, worker_id: str) -> None:
+        self.url = CONFIG['coordinator']['url'].rstrip('/')
+        self.worker_id = worker_id
+        self.timeout = float(CONFIG.get('coordinator', 'request_timeout_seconds', fallback='30'))
+
+        # results are worth retrying, the evaluation can't be repeated cheaply
+        retry = Retry(
+            total=int(CONFIG.get('coordinator', 'max_retries', fallback='5')),
+            backoff_factor=1,
+            status_forcelist=[502, 503, 504],
+            allowed_methods=None,
+        )
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = 'Bearer ' + CONFIG['coordinator']['token']
+        self.session.headers['X-Worker-Id'] = worker_id
+        self.session.mount('http://', HTTPAdapter(max_retries=retry))
+        self.session.mount('https://', HTTPAdapter(max_retries=retry))
+
+    def post(self, path: str, timeout: float, **body) -> Dict:
+        response = self.session.post(
+            self.url + path, json={'worker_id': self.worker_id, **body}, timeout=timeout
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def claim(self, wait_seconds: float) -> Optional[int]:
+        response = self.post('/jobs/claim', self.timeout + wait_seconds, wait_seconds=wait_seconds)
+        return response['solution_id']
+
+    def download(self, solution_id: int, evaluation_dir: Path) -> None:
+        with tempfile.TemporaryFile() as f:
+            with self.session.get(
+                f'{self.url}/jobs/{solution_id}/archive', stream=True, timeout=self.timeout
+            ) as response:
+                if response.status_code == 409:
+                    raise LeaseLost(solution_id)
+                response.raise_for_status()
+                shutil.copyfileobj(response.raw, f)
+            with zipfile.ZipFile(f) as zf:
+                zf.extractall(evaluation_dir)
+
+    def heartbeat(self, solution_id: int) -> bool:
+        try:
+            return self.post(f'/jobs/{solution_id}/heartbeat', self.timeout)['renewed']
+        except requests.RequestException as e:
+            # the coordinator may be restarting, it decides about the lease when the result comes
+            print(f'heartbeat of solution {solution_id} failed: {e}', file=sys.stderr)
+            return True
+
+    def send_progress(self, solution_id: int, line: str) -> None:
+        self.post(f'/jobs/{solution_id}/progress', self.timeout, line=line)
+
+    def send_log(self, solution_id: int, run_log: RunLog) -> None:
+        with tempfile.TemporaryFile() as f:
+            run_log.copy_to(f)
+            f.seek(0)
+            response = self.session.post(
+                f'{self.url}/jobs/{solution_id}/log', data=f, timeout=self.timeout
+            )
+        if response.status_code == 409:
+            raise LeaseLost(solution_id)
+        response.raise_for_status()
+
+    def send_result(self, solution_id: int, result: EvaluationResult, metrics: Metrics) -> bool:
+        response = self.post(
+            f'/jobs/{solution_id}/result',
+            self.timeout,
+            result=result._asdict(),
+            metrics=metrics.values,
+        )
+        return response['accepted']
+
+
+def remote_worker(worker_index: int) -> None:
+    worker_id = f'{socket.gethostname()}:{os.getpid()}:{worker_index}'
+    client = CoordinatorClient(worker_id)
+    poll_interval_seconds = float(CONFIG.get('coordinator', 'poll_interval_seconds', fallback='30'))
+    warm_pool = WarmPool(int(CONFIG.get('evaluation', 'warm_pool_size', fallback='0')))
+    warm_pool.fill()
+
+    while True:
+        try:
+            solution_id = client.claim(poll_interval_seconds)
+        except requests.RequestException as e:
+            print(f'coordinator is unavailable: {e}', file=sys.stderr)
+            time.sleep(poll_interval_seconds)
+            continue
+        if solution_id is None:
+            continue
+
+        evaluation_dir = REMOTE_DIR / str(os.getpid()) / str(solution_id)
+        metrics = Metrics(solution_id)
+        run_log = RunLog(f'{os.getpid()}-{solution_id}', partial(client.send_progress, solution_id))
+        try:
+            with metrics.stage('download'):
+                client.download(solution_id, evaluation_dir)
+            result = run_evaluation(
+                evaluation_dir, metrics, warm_pool, lambda: client.heartbeat(solution_id), run_log
+            )
+            with metrics.stage('upload_log'):
+                client.send_log(solution_id, run_log)
+            if not client.send_result(solution_id, result, metrics):
+                print(f'solution {solution_id} has been given to another worker', file=sys.stderr)
+        except LeaseLost:
+            pass
+        except requests.RequestException as e:
+            # the lease expires and the coordinator gives the solution to another worker
+            print(f'solution {solution_id} is abandoned: {e}', file=sys.stderr)
+        finally:
+            run_log.discard()
+            shutil.rmtree(evaluation_dir, ignore_errors=True)
+
+
+def main():
+    # evaluates solutions handed out by the coordinator of mlcourse-server on another machine
+    supervise_workers(remote_worker)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import time
+
+import pytest
+from telebot.apihelper import ApiTelegramException
+
+from mlcourse_prac import outbox
+from mlcourse_prac.db import MlcourseDatabase
+from mlcourse_prac.metrics import Metrics
+from mlcourse_prac.notifications import Notifications
+from mlcourse_prac.outbox import OutboxSender, queue_message, split_message
+from mlcourse_prac.telebot import MESSAGE_LIMIT
+
+TELEGRAM_ID = 1
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    database = MlcourseDatabase(str(tmp_path / 'solutions.db'))
+    monkeypatch.setattr(outbox, 'mlcourse_database', database)
+    return database
+
+
+class FailingBot:
+    def __init__(self, error_code, description):
+        self.error = ApiTelegramException(
+            'sendMessage', None, {'error_code': error_code, 'description': description}
+        )
+
+    def send_message(self, telegram_id, text):
+        raise self.error
+
+
+def test_result_supersedes_queued_progress(database):
+    notifications = Notifications()
+    queue_message(notifications, TELEGRAM_ID, 'progress 10%', kind='progress')
+    queue_message(notifications, TELEGRAM_ID, 'progress 50%', kind='progress')
+    assert [message.text for message in database.get_due_messages(10)] == ['progress 50%']
+
+    queue_message(notifications, TELEGRAM_ID, 'result')
+    assert [message.text for message in database.get_due_messages(10)] == ['result']
+    assert notifications.message_queued.is_set()
+
+
+def test_split_message_at_line_breaks():
+    lines = [f'{index:05d} ' + 'x' * 94 for index in range(100)]
+    parts = split_message('\n'.join(lines))
+
+    assert len(parts) == 3
+    assert all(len(part) <= MESSAGE_LIMIT for part in parts)
+    assert [line for part in parts for line in part.split('\n')] == lines
+
+
+def test_split_message_without_line_breaks():
+    parts = split_message('x' * (2 * MESSAGE_LIMIT + 1))
+    assert [len(part) for part in parts] == [MESSAGE_LIMIT, MESSAGE_LIMIT, 1]
+
+
+@pytest.mark.parametrize(
+    'error_code, description',
+    [
+        (403, 'Forbidden: bot was blocked by the user'),
+        (403, 'Forbidden: user is deactivated'),
+        (400, 'Bad Request: chat not found'),
+    ],
+)
+def test_undeliverable_message_is_dropped(database, error_code, description):
+    database.queue_messages(TELEGRAM_ID, ['text'], 'result', [])
+    [message] = database.get_due_messages(10)
+    metrics = Metrics()
+
+    OutboxSender(FailingBot(error_code, description)).send(message, metrics)
+
+    assert database.get_next_message_attempt() is None
+    assert metrics.values['outbox.dropped'] == 1
+
+
+@pytest.mark.parametrize(
+    'error_code, description',
+    [(400, 'Bad Request: message text is empty'), (502, 'Bad Gateway')],
+)
+def test_failed_message_is_retried_with_backoff(database, error_code, description):
+    database.queue_messages(TELEGRAM_ID, ['text'], 'result', [])
+    [message] = database.get_due_messages(10)
+    sender = OutboxSender(FailingBot(error_code, description))
+    metrics = Metrics()
+
+    sender.send(message, metrics)
+    assert database.get_next_message_attempt() - time.time() == pytest.approx(1, abs=0.5)
+
+    sender.send(message._replace(attempts=3), metrics)
+    assert database.get_next_message_attempt() - time.time() == pytest.approx(8, abs=0.5)
+    assert metrics.values['outbox.retried'] == 2
@@ -0,0 +1,118 @@
+import configparser
+import json
+import os
+import time
+
+import pytest
+
+from mlcourse_prac import store
+from mlcourse_prac.db import MlcourseDatabase
+
+TELEGRAM_ID = 1
+DAY_SECONDS = 86400
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    monkeypatch.setattr(store, 'STORE_DIR', tmp_path / 'store')
+    monkeypatch.setattr(store, 'OBJECTS_DIR', tmp_path / 'store' / 'objects')
+    monkeypatch.setattr(store, 'MANIFESTS_DIR', tmp_path / 'store' / 'manifests')
+    config = configparser.ConfigParser()
+    config['store'] = {'retention_days': '365', 'budget_gb': '20'}
+    monkeypatch.setattr(store, 'CONFIG', config)
+    database = MlcourseDatabase(str(tmp_path / 'solutions.db'))
+    monkeypatch.setattr(store, 'mlcourse_database', database)
+    return database
+
+
+def save_solution(tmp_path, solution_id, contents, stored_at):
+    submission_dir = tmp_path / f'submission-{solution_id}'
+    submission_dir.mkdir()
+    for name, content in contents.items():
+        (submission_dir / name).write_bytes(content)
+    files = store.store_files(submission_dir)
+    store.save_manifest(solution_id, TELEGRAM_ID, f'hash-{solution_id}', files)
+
+    manifest = store.load_manifest(solution_id)
+    manifest['stored_at'] = stored_at
+    store.manifest_path(solution_id).write_text(json.dumps(manifest))
+    return {name: content_hash for name, (content_hash, _, _) in files.items()}
+
+
+def age_objects(seconds):
+    # as if the uploads had finished long ago
+    for path in store.OBJECTS_DIR.glob('*/*'):
+        past = path.stat().st_mtime - seconds
+        os.utime(path, (past, past))
+
+
+def stored_ids():
+    return sorted(int(path.stem) for path in store.MANIFESTS_DIR.glob('*.json'))
+
+
+def test_protected_solutions_are_kept(database, tmp_path):
+    store.CONFIG['store']['retention_days'] = '1'
+    latest_id, _ = database.submit_solution(TELEGRAM_ID, 'v1', lambda solution_id: None)
+    expired = time.time() - 2 * DAY_SECONDS
+    save_solution(tmp_path, 100, {'solution.py': b'old'}, expired)
+    save_solution(tmp_path, latest_id, {'solution.py': b'latest'}, expired)
+
+    assert store.enforce_retention(force=True) == [100]
+    assert stored_ids() == [latest_id]
+
+
+def test_budget_removes_oldest_first(database, tmp_path):
+    now = time.time()
+    for solution_id in [3, 1, 2]:
+        save_solution(tmp_path, solution_id, {'weights.bin': os.urandom(4096)}, now + solution_id)
+    object_size = max(path.stat().st_size for path in store.OBJECTS_DIR.glob('*/*'))
+    store.CONFIG['store']['budget_gb'] = str(2.5 * object_size / 2**30)
+
+    assert store.remove_expired_solutions() == [1]
+    assert stored_ids() == [2, 3]
+
+
+def test_shared_objects_survive_while_referenced(database, tmp_path):
+    store.CONFIG['store']['retention_days'] = '1'
+    latest_id, _ = database.submit_solution(TELEGRAM_ID, 'v2', lambda solution_id: None)
+    expired = time.time() - 2 * DAY_SECONDS
+    old_hashes = save_solution(
+        tmp_path, 100, {'weights.bin': b'shared', 'solution.py': b'v1'}, expired
+    )
+    save_solution(tmp_path, latest_id, {'weights.bin': b'shared', 'solution.py': b'v2'}, expired)
+    age_objects(2 * store.ORPHAN_GRACE_SECONDS)
+
+    assert store.remove_expired_solutions() == [100]
+    assert store.object_path(old_hashes['weights.bin']).exists()
+    assert not store.object_path(old_hashes['solution.py']).exists()
+    store.restore_submission(latest_id, tmp_path / 'restored')
+    assert (tmp_path / 'restored' / 'weights.bin').read_bytes() == b'shared'
+
+
+def test_orphaned_objects_are_removed_after_grace_period(database, tmp_path):
+    (tmp_path / 'upload.bin').write_bytes(b'manifest not saved yet')
+    content_hash = store.store_file(tmp_path / 'upload.bin')
+
+    store.remove_expired_solutions()
+    assert store.object_path(content_hash).exists()
+
+    age_objects(2 * store.ORPHAN_GRACE_SECONDS)
+    store.remove_expired_solutions()
+    assert not store.object_path(content_hash).exists()
+
+
+def test_restore_submission_keeps_modes(database, tmp_path):
+    submission_dir = tmp_path / 'submission'
+    (submission_dir / 'scripts').mkdir(parents=True)
+    (submission_dir / 'solution.py').write_text('class Model: pass\n')
+    (submission_dir / 'solution.py').chmod(0o600)
+    (submission_dir / 'scripts' / 'run.sh').write_text('#!/bin/sh\n')
+    (submission_dir / 'scripts' / 'run.sh').chmod(0o755)
+    store.save_manifest(1, TELEGRAM_ID, 'hash-1', store.store_files(submission_dir))
+
+    restored_dir = tmp_path / 'restored'
+    store.restore_submission(1, restored_dir)
+    for relative_path in ['solution.py', 'scripts/run.sh']:
+        original, restored = submission_dir / relative_path, restored_dir / relative_path
+        assert restored.read_bytes() == original.read_bytes()
+        assert restored.stat().st_mode & 0o777 == original.stat().st_mode & 0o777
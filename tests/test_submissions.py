@@ -0,0 +1,66 @@
+import sqlite3
+from functools import partial
+
+import pytest
+
+from mlcourse_prac import submissions
+from mlcourse_prac.db import MIGRATIONS, MlcourseDatabase, use_autoincrement_solution_ids
+from mlcourse_prac.submissions import publish_submission
+
+TELEGRAM_ID = 1
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    monkeypatch.setattr(submissions, 'SUBMISSIONS_DIR', tmp_path / 'submissions')
+    return MlcourseDatabase(str(tmp_path / 'solutions.db'))
+
+
+def make_staging_dir(tmp_path, name):
+    staging_dir = tmp_path / f'staging-{name}'
+    staging_dir.mkdir()
+    (staging_dir / 'solution.py').write_text(name)
+    return staging_dir
+
+
+def test_resubmit_while_queued(database, tmp_path):
+    first_id, _ = database.submit_solution(
+        TELEGRAM_ID, 'v1', partial(publish_submission, make_staging_dir(tmp_path, 'v1'))
+    )
+    # the files of the superseded solution are removed only after the commit
+    second_id, superseded_ids = database.submit_solution(
+        TELEGRAM_ID, 'v2', partial(publish_submission, make_staging_dir(tmp_path, 'v2'))
+    )
+
+    assert superseded_ids == [first_id]
+    assert second_id > first_id
+    assert (submissions.SUBMISSIONS_DIR / str(second_id) / 'solution.py').read_text() == 'v2'
+    assert database.get_unchecked_solution_status(TELEGRAM_ID) == 'new'
+    assert database.get_protected_solution_ids() == {second_id}
+
+
+def test_migrated_ids_are_not_reused(tmp_path):
+    db_file_path = str(tmp_path / 'solutions.db')
+    connection = sqlite3.connect(db_file_path)
+    with connection:
+        cursor = connection.cursor()
+        old_migrations = MIGRATIONS[: MIGRATIONS.index(use_autoincrement_solution_ids)]
+        for version, migration in enumerate(old_migrations, start=1):
+            migration(cursor)
+            cursor.execute(f'PRAGMA user_version={version};')
+        cursor.executemany(
+            'INSERT INTO solutions(solution_id, telegram_id, status) VALUES (?,?,?);',
+            [(1, TELEGRAM_ID, 'done'), (2, TELEGRAM_ID, 'new')],
+        )
+        # the upload metrics outlive the superseded solution
+        cursor.execute(
+            'INSERT INTO solution_metrics(solution_id, name, value) VALUES (?,?,?);',
+            (2, 'stage.store', 0.1),
+        )
+        cursor.execute('DELETE FROM solutions WHERE solution_id=2;')
+    connection.close()
+
+    database = MlcourseDatabase(db_file_path)
+    solution_id, _ = database.submit_solution(TELEGRAM_ID, 'v3', lambda solution_id: None)
+    assert solution_id == 3
+    assert database.get_rescore_candidates('latest') == [1]